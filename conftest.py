@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fixtures shared by the test modules."""
+
+import pytest
+
+import osm_benchmark
+
+
+@pytest.fixture
+def synthetic(tmp_path):
+    """Path of a synthetic OSM file (2000 nodes, 200 ways, 20 relations)."""
+    path = str(tmp_path / 'synthetic.osm')
+    osm_benchmark.generate_osm(path, nodes=2000, relations=20, seed=7)
+    return path
+
+
+def read_bytes(path):
+    with open(path, 'rb') as fi:
+        return fi.read()
@@ -11,10 +11,14 @@ Based on: https://github.com/jasonicarter/udacity/blob/master/P3_OpenStreeMap_Da
 #%% Some basic statements
 import xml.etree.cElementTree as ET
 from collections import defaultdict
+from contextlib import ExitStack
 import pprint
 import re
 import codecs
 import json
+import threading
+
+from osm_writers import JsonLinesWriter, output_path
 
 # Dataset file name:
 FILENAME = 'Missoes.osm'
@@ -108,56 +112,285 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 CREATED = ["version", "changeset", "timestamp", "user", "uid"]
 ATTRIB = ["id", "visible", "amenity", "cuisine", "name", "phone"]
 
+
+class Mapping(dict):
+    """A dict counting its changes in 'version', so the cleaners built from it see them."""
+    version = 0
+
+    def _changed(method):
+        def changed(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self.version += 1
+            return result
+        return changed
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    __ior__ = _changed(dict.__ior__)
+    clear = _changed(dict.clear)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    del _changed
+
+
 ## Street names
 ### IMPORTANT: Brazilian street types are in the beginning of the phrase:
 street_type_re = re.compile(r'^\b\S+\.?', re.IGNORECASE)
 
 expected = ["Rua", "Avenida", "Praça", "Via", "Estrada", "Travessa", "Linha", "Alameda", "Largo", "Parque", "Rodovia"]
 
-street_mapping = {'Av.': 'Avenida',
+street_mapping = Mapping({'Av.': 'Avenida',
            'BR ': 'BR-',
            'BR158': 'BR-158',
            'ERS-': 'RS-',
            'RS ': 'RS-'
-          }
+          })
 
 ## Cities names
 expected_cities = ['santa rosa', 'condor', 'ijuí', 'panambi', 'santo ângelo', 'três de maio',
             'santo cristo', 'eugênio de castro', 'santo augusto', 'cruz alta', 'vila sírio', 
             'cerro largo', 'são josé do mauá', 'são miguel das missões', 'horizontina']
 
-mapping_cities = {'ijui': 'ijuí',
+mapping_cities = Mapping({'ijui': 'ijuí',
                   'santo angelo': 'santo ângelo',
                   'panambi - rs': 'panambi'
-                 }
+                 })
 
 ## Postcodes:
 cep = re.compile(r"[0-9]{5}-[0-9]{3}") #Alternative: cep = re.compile('d{5}-d{3}')
-mapping_cep = {'98910000': '98910-000'}
+mapping_cep = Mapping({'98910000': '98910-000'})
+
+
+
+#%% Cleaning report
+class TopCounter(object):
+    """
+    Count items keeping at most 2 * capacity of them in memory.
+
+    When the table is full only the capacity most frequent items are kept, so the
+    counts of the top items are exact unless an item was dropped and seen again.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item, count=1):
+        self.counts[item] = self.counts.get(item, 0) + count
+        if len(self.counts) >= 2 * self.capacity:
+            self.counts = dict(self.most_common(self.capacity))
+
+    def update(self, counts):
+        for item, count in counts.items():
+            self.add(item, count)
 
+    def most_common(self, n=None):
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return items if n is None else items[:n]
 
-fixed_street_names = []
-fixed_city_names = []
-fixed_cep = []
-bad_postal_codes = []
+
+class CleaningReport(object):
+    """
+    Bounded summary of the cleaning done while shaping the data.
+
+    For each rule ('street', 'city', 'postcode' and 'bad_postcode') it keeps the
+    number of values fixed (or found), a sample of at most sample_size distinct
+    before -> after pairs and the top_size most frequent offending values.
+
+    Recording is thread safe, and reports from worker processes (they are picklable)
+    are combined with merge().
+    """
+
+    def __init__(self, sample_size=50, top_size=20):
+        self.sample_size = sample_size
+        self.top_size = top_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = defaultdict(int)
+        self.samples = defaultdict(dict)
+        self.offenders = defaultdict(lambda: TopCounter(10 * self.top_size))
+
+    def record(self, rule, before, after=None, count=1):
+        """Record that 'before' was fixed into 'after' (or only found, if after is None)."""
+        with self._lock:
+            self.counts[rule] += count
+            samples = self.samples[rule]
+            if before not in samples and len(samples) < self.sample_size:
+                samples[before] = after
+            self.offenders[rule].add(before, count)
+
+    def merge(self, other):
+        """Add the counts, samples and offenders of another report to this one."""
+        with self._lock:
+            for rule, count in other.counts.items():
+                self.counts[rule] += count
+            for rule, pairs in other.samples.items():
+                samples = self.samples[rule]
+                for before, after in pairs.items():
+                    if len(samples) >= self.sample_size:
+                        break
+                    samples.setdefault(before, after)
+            for rule, offenders in other.offenders.items():
+                self.offenders[rule].update(offenders.counts)
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            return dict((rule, {'count': self.counts[rule],
+                                'sample': self.samples[rule],
+                                'top': self.offenders[rule].most_common(self.top_size)})
+                        for rule in sorted(self.counts))
+
+    def state(self):
+        """Return the complete state of the report as a JSON serializable dict."""
+        with self._lock:
+            return {'counts': dict(self.counts),
+                    'samples': [[rule, list(pairs.items())] for rule, pairs in self.samples.items()],
+                    'offenders': [[rule, list(top.counts.items())]
+                                  for rule, top in self.offenders.items()]}
+
+    def load_state(self, state):
+        """Replace the content of the report with a state returned by state()."""
+        self.reset()
+        with self._lock:
+            self.counts.update(state['counts'])
+            for rule, pairs in state['samples']:
+                self.samples[rule] = dict(pairs)
+            for rule, counts in state['offenders']:
+                self.offenders[rule].counts = dict(counts)
+
+    def dump(self, file_out):
+        """Write the report as JSON."""
+        with codecs.open(file_out, 'w', encoding='utf-8') as fo:
+            json.dump(self.to_dict(), fo, indent=2, ensure_ascii=False)
+
+    def summary(self):
+        lines = []
+        for rule, info in self.to_dict().items():
+            top = ', '.join('{0!r} ({1})'.format(value, count) for value, count in info['top'][:5])
+            lines.append('{0}: {1} values, top: {2}'.format(rule, info['count'], top))
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['offenders'] = dict(self.offenders)
+        return state
+
+    def __setstate__(self, state):
+        offenders = state.pop('offenders')
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self.offenders = defaultdict(lambda: TopCounter(10 * self.top_size), offenders)
+
+
+# Cleaning done by the audit functions below
+report = CleaningReport()
+
+#%% Compiled mapping cleaners
+class MappingCleaner(object):
+    """
+    Apply a {pattern: replacement} mapping with the same results as update_street_name.
+
+    Every key is compiled once and all of them are joined in a single alternation,
+    so a value no key matches is skipped with one regex search. Matching values are
+    replaced key by key, in the mapping order, and the result of each distinct value
+    is cached (up to cache_size values).
+
+    The cleaner follows its mapping in O(1) per call: it is compiled again, and its
+    cache emptied, when another mapping is given to clean, when the size of the
+    mapping changed or, for a Mapping, when its version changed. Call
+    build_cleaners() after replacing a value in place in a plain dict.
+    """
+
+    def __init__(self, mapping, cache_size=100000):
+        self.cache_size = cache_size
+        self.compile(mapping)
+
+    def compile(self, mapping):
+        self.mapping = mapping
+        self.version = getattr(mapping, 'version', None)
+        self.size = len(mapping)
+        self.patterns = [(re.compile(key), replacement) for key, replacement in mapping.items()]
+        if mapping:
+            self.matcher = re.compile('|'.join('(?:{0})'.format(key) for key in mapping))
+        else:
+            self.matcher = None
+        self.cache = {}
+
+    def clean(self, value, mapping=None):
+        """Return the cleaned value and a tuple with the value after each applied key."""
+        mapping = self.mapping if mapping is None else mapping
+        if mapping is not self.mapping or len(mapping) != self.size or \
+                getattr(mapping, 'version', None) != self.version:
+            self.compile(mapping)
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+        name = value
+        fixes = []
+        if self.matcher is not None and self.matcher.search(name):
+            for pattern, replacement in self.patterns:
+                if pattern.search(name):
+                    name = pattern.sub(replacement, name)
+                    fixes.append(name)
+        result = (name, tuple(fixes))
+        if len(self.cache) < self.cache_size:
+            self.cache[value] = result
+        return result
+
+
+def build_cleaners():
+    """Build new street, city and postcode cleaners (with empty caches)."""
+    global street_cleaner, city_cleaner, cep_cleaner
+    street_cleaner = MappingCleaner(street_mapping)
+    city_cleaner = MappingCleaner(mapping_cities)
+    cep_cleaner = MappingCleaner(mapping_cep)
+
+build_cleaners()
+
+# Optional osm_fuzzy resolvers, used when the mappings leave a value unexpected
+city_resolver = None
+street_resolver = None
 
 #%% Fixing street names
-def audit_street_type(street_name):
-    """Return the fixed street name or return untouched street name if expected."""
+def audit_street_type(street_name, recorder=None):
+    """
+    Return the fixed street name or return untouched street name if expected.
+
+    The fixes are recorded in recorder, by default the cleaning report.
+    """
+    if recorder is None:
+        recorder = report
     match = street_type_re.search(street_name)
     if match:
         street_type = match.group()
         if street_type not in expected:
-            return update_street_name(street_name, street_mapping)
+            fixed, fixes = street_cleaner.clean(street_name, street_mapping)
+            if fixes:
+                recorder.record('street', street_name, fixed)
+            elif street_resolver is not None:
+                resolved = street_resolver.resolve(street_type)
+                if resolved is not None and resolved != street_type:
+                    fixed = resolved + street_name[len(street_type):]
+                    recorder.record('street_fuzzy', street_name, fixed)
+            return fixed
     return street_name
 
 
 def update_street_name(name, mapping):
     """Replace and return new name from street name mapping."""
+    original = name
     for key in mapping.keys():
         if re.search(key, name):
             name = re.sub(key, mapping[key], name)
-            fixed_street_names.append(name)
+    if name != original:
+        report.record('street', original, name)
     return name
 
 
@@ -165,43 +398,63 @@ def is_street_name(address_key):
     return address_key == 'addr:street'
 
 #%% Fixing cities names
-def audit_city_name(city_name):
+def audit_city_name(city_name, recorder=None):
+    """Return the fixed lower case city name, recording the fixes in recorder (or the report)."""
+    if recorder is None:
+        recorder = report
     city_name = city_name.lower()    
     if city_name in expected_cities:
         #print(city_name)
         return city_name
     else:
-        return update_city(city_name, mapping_cities)
+        fixed, fixes = city_cleaner.clean(city_name, mapping_cities)
+        if fixes:
+            recorder.record('city', city_name, fixed)
+        elif city_resolver is not None:
+            resolved = city_resolver.resolve(city_name)
+            if resolved is not None and resolved != city_name:
+                fixed = resolved
+                recorder.record('city_fuzzy', city_name, fixed)
+        return fixed
         
 def update_city(city_name, mapping_cities):
     """Replace and return new name from cities name mapping."""
+    original = city_name
     for key in mapping_cities.keys():
         if re.search(key, city_name):
             city_name = re.sub(key, mapping_cities[key], city_name)
-            fixed_city_names.append(city_name)
+    if city_name != original:
+        report.record('city', original, city_name)
     return city_name
 
 def is_city_name(city_name):
     return city_name == 'addr:city'
 
 #%% Fixing postal codes
-def audit_postal_code(postal_code):
-    """Return matched postal code and add bad ones to list."""
+def audit_postal_code(postal_code, recorder=None):
+    """Return matched postal code and record bad ones in recorder (or the report)."""
+    if recorder is None:
+        recorder = report
     if cep.match(postal_code):
         return postal_code
     else:
-        bad_postal_codes.append(postal_code)
-        return update_cep(postal_code, mapping_cep)
+        recorder.record('bad_postcode', postal_code)
+        fixed, fixes = cep_cleaner.clean(postal_code, mapping_cep)
+        if fixes:
+            recorder.record('postcode', postal_code, fixed)
+        return fixed
 
 #def is_cep(elem):
 #    return (elem.attrib['k'] == "addr:postcode")
         
 def update_cep(cep, mapping):
     """Replace and return new postcode from mapping."""
+    original = cep
     for key in mapping.keys():
         if re.search(key, cep):
             cep = re.sub(key, mapping[key], cep)
-            fixed_cep.append(cep)
+    if cep != original:
+        report.record('postcode', original, cep)
     return cep
 
 
@@ -209,13 +462,115 @@ def is_postal_code(address_key):
     return address_key == 'addr:postcode'
 
 #%% Shaping the data
-def shape_element(element):
+# Classification of the tag keys, decided once per distinct key by classify_key
+KEY_DROP, KEY_PLAIN, KEY_ADDRESS, KEY_CITY, KEY_STREET, KEY_POSTCODE = range(6)
+KEY_TABLE_SIZE = 100000
+key_table = {}
+
+# Tag values shared by the shaped documents (short ones only, up to VALUE_TABLE_SIZE)
+VALUE_TABLE_SIZE = 200000
+VALUE_MAX_LENGTH = 40
+value_table = {}
+
+
+def classify_key(k):
+    """
+    Return the (kind, key) of a tag key and remember it in key_table.
+
+    kind is KEY_DROP for keys with problem characters and 'addr:' keys with a second
+    ':', KEY_PLAIN for the other non address keys, and KEY_CITY, KEY_STREET,
+    KEY_POSTCODE or KEY_ADDRESS for the address keys, whose key is the one without
+    the 'addr:' prefix.
+    """
+    # Search for problem characters in 'k' and ignore them
+    if problemchars.search(k):
+        result = (KEY_DROP, None)
+    elif k.startswith('addr:'):
+        address = k.split(':')
+        if len(address) != 2:
+            result = (KEY_DROP, None)
+        elif is_city_name(k):
+            result = (KEY_CITY, address[1])
+        elif is_street_name(k):
+            result = (KEY_STREET, address[1])
+        elif is_postal_code(k):
+            result = (KEY_POSTCODE, address[1])
+        else:
+            result = (KEY_ADDRESS, address[1])
+    else:
+        result = (KEY_PLAIN, k)
+    if len(key_table) < KEY_TABLE_SIZE:
+        key_table[k] = result
+    return result
+
+
+def clear_tables():
+    """Forget the key classifications and shared values; call it after changing problemchars."""
+    key_table.clear()
+    value_table.clear()
+
+
+def shape_tags(element):
+    """
+    Yield the cleaned second level tags of an element as (is_address, key, value) tuples.
+
+    'addr:' keys are yielded with is_address=True and the key without its prefix, and
+    their city, street and postcode values are cleaned. Keys with problem characters
+    and 'addr:' keys with a second ':' are skipped.
+    """
+    keys = key_table
+    values = value_table
+    for tag in element.iter('tag'):
+        attrib = tag.attrib
+        k = attrib['k']
+        try:
+            kind, k = keys[k]
+        except KeyError:
+            kind, k = classify_key(k)
+        if kind == KEY_DROP:
+            continue
+        v = attrib['v']
+        if kind == KEY_CITY:
+            v = audit_city_name(v)
+        elif kind == KEY_STREET:
+            v = audit_street_type(v)
+        elif kind == KEY_POSTCODE:
+            v = audit_postal_code(v)
+        try:
+            v = values[v]
+        except KeyError:
+            if len(v) <= VALUE_MAX_LENGTH and len(values) < VALUE_TABLE_SIZE:
+                values[v] = v
+        yield kind != KEY_PLAIN, k, v
+
+
+def add_way_geometry(node, coords):
+    """Add the resolved node positions, bounding box and centroid to a shaped way."""
+    if not coords:
+        return
+    lats = [pos[0] for pos in coords]
+    lons = [pos[1] for pos in coords]
+    node['node_pos'] = coords
+    node['bbox'] = [min(lats), min(lons), max(lats), max(lons)]
+    node['centroid'] = [sum(lats) / len(lats), sum(lons) / len(lons)]
+
+
+def index_node(element, node_index):
+    """Add the position of a node to node_index without shaping it (e.g. when it is filtered out)."""
+    attrib = element.attrib
+    if element.tag == 'node' and 'lat' in attrib and 'lon' in attrib:
+        node_index.add(int(attrib['id']), float(attrib['lat']), float(attrib['lon']))
+
+
+def shape_element(element, node_index=None):
     """
     Parse, validate and format node and way xml elements.
     Return list of dictionaries
 
     Keyword arguments:
     element -- element object from xml element tree iterparse
+    node_index -- optional osm_geometry index; the positions of the nodes are added
+                  to it and the geometry of the ways is resolved from it
     """
     if element.tag == 'node' or element.tag == 'way':
 
@@ -238,26 +593,11 @@ def shape_element(element):
                 node[k] = element.attrib[k]
 
         # Deal with second level tag items
-        for tag in element.iter('tag'):
-            k = tag.attrib['k']
-            v = tag.attrib['v']
-
-            # Search for problem characters in 'k' and ignore them
-            if problemchars.search(k):
-                # Add to array to print out later
-                continue
-            elif k.startswith('addr:'):
-                address = k.split(':')
-                if len(address) == 2:
-                    if 'address' not in node:
-                        node['address'] = {}
-                    if is_city_name(k):
-                        v = audit_city_name(v)
-                    if is_street_name(k):
-                        v = audit_street_type(v)
-                    if is_postal_code(k):
-                        v = audit_postal_code(v)
-                    node['address'][address[1]] = v
+        for is_address, k, v in shape_tags(element):
+            if is_address:
+                if 'address' not in node:
+                    node['address'] = {}
+                node['address'][k] = v
             else:
                 node[k] = v
 
@@ -270,29 +610,206 @@ def shape_element(element):
         if len(node_refs) > 0:
             node['node_refs'] = node_refs
 
+        if node_index is not None:
+            if 'pos' in node:
+                node_index.add(int(element.attrib['id']), node['pos'][0], node['pos'][1])
+            elif node_refs:
+                add_way_geometry(node, node_index.lookup(node_refs))
+
         return node
     else:
         return None
 
 
-def process_map(file_in, pretty=False):
+def iter_elements(file_in, tags=('node', 'way')):
+    """
+    Yield the top level elements of an OSM file, freeing each subtree once consumed.
+
+    The element is cleared and detached from the root after the consumer resumes
+    the generator, so memory stays flat regardless of the input size.
+
+    Keyword arguments:
+    file_in -- path or file object of the OSM XML file ('.pbf' files are read
+               with osm_pbf)
+    tags -- top level tags to yield (None yields every top level element)
+    """
+    if isinstance(file_in, str) and file_in.endswith('.pbf'):
+        import osm_pbf
+        for element in osm_pbf.iter_pbf_elements(file_in, tags):
+            yield element
+        return
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(file_in, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if tags is None or element.tag in tags:
+                yield element
+            element.clear()
+            root.clear()
+
+
+def iter_shaped(file_in, node_index=None):
+    """Yield the shaped dictionary of every node and way in the OSM file."""
+    for element in iter_elements(file_in):
+        el = shape_element(element, node_index)
+        if el:
+            yield el
+
+
+def process_map(file_in, pretty=False, collect=False, workers=None, sinks=(),
+                encoder=None, compression=None, columnar=None, node_index=None,
+                instrument=None, element_filter=None, resume=False, checkpoint_every=None,
+                cache=None, stats=False, pipelined=False, dedup=None):
+    """
+    Shape the OSM file into JSON lines written to '<file_in>.json'.
+
+    Documents are streamed from iter_shaped, so nothing is kept in memory unless
+    collect=True, in which case the list of shaped dictionaries is returned.
+    The cleaning report is written to '<file_in>.json.report.json'.
+    With workers > 1 the file is shaped in parallel by osm_parallel (in input
+    order, byte identical output) and its throughput statistics are returned.
+
+    sinks -- extra outputs (e.g. osm_mongo.MongoSink) with write(doc) and close()
+             methods; every shaped document is also written to them.
+    encoder -- JSON encoder of osm_writers ('orjson', 'ujson', 'json'), by default
+               the fastest one installed
+    compression -- None, 'gzip' or 'zstd'; the output gets a '.gz' or '.zst' suffix
+    columnar -- directory where osm_columnar also writes the data as Parquet files
+    node_index -- osm_geometry node index used to add the geometry of the ways
+    instrument -- osm_metrics.Instrumentation timing every stage of the run; its
+                  metrics are written to '<file_in>.json.metrics.json'
+    element_filter -- osm_filters.ElementFilter; the elements it rejects are skipped
+                      before shape_element (the nodes still go to node_index)
+    checkpoint_every, resume -- write a checkpoint every checkpoint_every input bytes
+                                and/or resume from the last one, with osm_checkpoint
+    cache -- osm_cache.ResultCache; the parsed elements are read from it, and the
+             output is restored from it when the input and the cleaning configuration
+             did not change (not with collect, sinks, columnar, node_index,
+             instrument or element_filter)
+    stats -- keep the counts of osm_stats.StatsSink (documents, users, cities,
+             amenities) and write them to '<file_in>.json.stats.json'
+    pipelined -- read, shape and write in three threads with osm_pipeline, which
+                 also reads '.gz' and '.bz2' inputs (not PBF, not with instrument,
+                 cache or dedup)
+    dedup -- 'two-pass' (or True) or 'stream': keep the latest version of each node
+             and way only, with osm_dedup (for history files and merged extracts;
+             only 'two-pass' with workers, not with pipelined or checkpoints)
+    """
+    if dedup is True:
+        dedup = 'two-pass'
+    if workers and workers > 1:
+        if collect or sinks or columnar or stats or node_index is not None or \
+                instrument is not None or element_filter is not None or cache is not None or \
+                resume or checkpoint_every or pipelined:
+            raise ValueError('collect, sinks, columnar, stats, node_index, instrument, '
+                             'element_filter, cache, resume, checkpoint_every and pipelined '
+                             'are not supported with parallel workers')
+        if dedup not in (None, 'two-pass'):
+            raise ValueError('Only dedup="two-pass" is supported with parallel workers')
+        import osm_parallel
+        return osm_parallel.process_map_parallel(file_in, pretty, workers=workers,
+                                                 encoder=encoder, compression=compression,
+                                                 dedup=bool(dedup))
+
+    if resume or checkpoint_every:
+        if collect or sinks or columnar or stats or compression or node_index is not None or \
+                instrument is not None or element_filter is not None or dedup:
+            raise ValueError('Only pretty and encoder are supported with checkpoints')
+        import osm_checkpoint
+        return osm_checkpoint.process_map_resumable(
+            file_in, pretty, encoder, resume,
+            checkpoint_every or osm_checkpoint.CHECKPOINT_BYTES)
+
+    if pipelined and (instrument is not None or cache is not None or dedup):
+        raise ValueError('instrument, cache and dedup are not supported with pipelined')
+    if columnar:
+        import osm_columnar
+        sinks = list(sinks) + [osm_columnar.ParquetSink(columnar)]
+
     # Available from Udacity's repository
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
+    file_out = output_path(file_in, compression)
+    if stats:
+        import osm_stats
+        sinks = list(sinks) + [osm_stats.StatsSink("{0}.stats.json".format(file_out))]
+    if pipelined:
+        import osm_pipeline
+        return osm_pipeline.process_map_pipelined(file_in, pretty, collect, sinks, encoder,
+                                                  compression, node_index, element_filter)
+
+    data = [] if collect else None
+    report.reset()
+    output_key = None
+    if cache is not None and not (collect or sinks or node_index is not None or dedup or
+                                  instrument is not None or element_filter is not None):
+        output_key = cache.output_key(file_in, pretty, encoder, compression)
+        state = cache.restore_output(output_key, file_out)
+        if state is not None:
+            report.load_state(state)
+            report.dump("{0}.report.json".format(file_out))
+            print(report.summary())
+            return data
+    shape = shape_element
+    if cache is not None:
+        elements = cache.iter_elements(file_in)
+    else:
+        elements = iter_elements(file_in)
+    if instrument is not None:
+        if cache is None:
+            elements = iter_elements(instrument.open_input(file_in))
+        elements = instrument.iter_elements(elements)
+        shape = instrument.shaper(shape)
+    deduplicator = None
+    if dedup:
+        import osm_dedup
+        deduplicator = osm_dedup.Deduplicator(dedup)
+        if dedup == 'two-pass':
+            deduplicator.scan(cache.iter_elements(file_in) if cache is not None
+                              else iter_elements(file_in))
+    with ExitStack() as stack:
+        writer = stack.enter_context(JsonLinesWriter(file_out, pretty, encoder, compression))
+        # Closed even if shaping fails, so their last batch is written and their
+        # threads stop (the callbacks run in reverse order)
+        for sink in reversed(sinks):
+            stack.callback(sink.close)
+        if instrument is not None:
+            instrument.attach_writer(writer)
+            stack.enter_context(instrument.cleaners())
+            stack.callback(instrument.close)
+        if deduplicator is not None:
+            stack.callback(deduplicator.close)
+        for element in elements:
+            # Before element_filter, so the deduplicator sees every node and way
+            if deduplicator is not None and not deduplicator.accept(element):
+                continue
+            if element_filter is not None and not element_filter.accept(element):
+                # The ways kept may still reference the nodes filtered out
+                if node_index is not None:
+                    index_node(element, node_index)
+                continue
+            el = shape(element, node_index)
+            if not el:
+                continue
+            if collect:
                 data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2) + "\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-
-        # Keep track of things
-        print('Fixed street names:', fixed_street_names)
-        print('Fixed cities names:', fixed_city_names)
-        print('Bad postal code:', bad_postal_codes)
+            writer.write(el)
+            for sink in sinks:
+                sink.write(el)
+    if output_key is not None:
+        cache.store_output(output_key, file_out, report.state())
+
+    # Keep track of things
+    report.dump("{0}.report.json".format(file_out))
+    print(report.summary())
+    if deduplicator is not None:
+        print('Dropped {0} older or duplicate versions'.format(deduplicator.dropped))
+    if instrument is not None:
+        instrument.dump("{0}.metrics.json".format(file_out))
 
     return data
 
@@ -300,7 +817,8 @@ def process_map(file_in, pretty=False):
 def test():
     # call the process_map procedure with pretty=False. The pretty=True option adds
     # additional spaces to the output, making it significantly larger.
-    data = process_map('Missoes.osm', False)
+    # collect=True keeps every shaped element in memory, avoid it on large files.
+    data = process_map('Missoes.osm', False, collect=True)
     # pprint.pprint(data)
 
 #%% Running
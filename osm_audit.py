@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Single pass auditing of an OSM file.
+
+The exploration notebook runs count_tags, list_cities, audit_cities, audit (street
+types) and audit_cep, each one parsing the whole file again. Here every audit is
+an Auditor registered as a visitor in an AuditEngine, and the file is parsed once
+to produce one combined report:
+
+>engine = AuditEngine([TagCounter(), CityLister(), CityAuditor(),
+>                      StreetTypeAuditor(), PostcodeAuditor()])
+>report = engine.run('Missoes.osm')
+>report['street_types']
+
+For very large files, approximate_auditors() count the distinct users, cities and
+tag keys with HyperLogLog and find the most frequent unexpected street types, bad
+postcodes and tag values with Count-Min heavy hitters (see osm_sketch), in a fixed
+amount of memory. All of them (and their TagCounter) are mergeable, so audits of
+chunks of a file are combined with merge():
+
+>report = audit_file('planet.osm', approximate_auditors())
+"""
+
+#%% Some basic statements
+from collections import defaultdict
+
+from final_project_code import ET, expected, expected_cities, street_type_re, cep
+import osm_pbf
+from osm_sketch import HeavyHitters, HyperLogLog
+
+
+#%% Auditors
+class Auditor(object):
+    """
+    Base class of the audit visitors.
+
+    Subclasses set 'name' (the key of their result in the combined report) and
+    'tags' (the element tags they want to visit, None to visit every element),
+    and override visit() and report().
+    """
+    name = None
+    tags = None
+
+    def visit(self, element):
+        """Inspect one fully parsed element."""
+        raise NotImplementedError
+
+    def report(self):
+        """Return the result of the audit."""
+        raise NotImplementedError
+
+
+class TagCounter(Auditor):
+    """Count every element tag in the file (same as count_tags)."""
+    name = 'tags'
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def visit(self, element):
+        self.counts[element.tag] += 1
+
+    def merge(self, other):
+        """Add the counts of the same auditor run on another chunk of the data."""
+        for tag, count in other.counts.items():
+            self.counts[tag] += count
+        return self
+
+    def report(self):
+        return dict(self.counts)
+
+
+class CityLister(Auditor):
+    """List the distinct lower case 'addr:city' values (same as list_cities)."""
+    name = 'cities'
+    tags = ('tag',)
+
+    def __init__(self):
+        # A dict keeps the insertion order and gives O(1) membership
+        self.cities = {}
+
+    def visit(self, element):
+        if element.attrib['k'] == 'addr:city':
+            self.cities[element.attrib['v'].lower()] = None
+
+    def report(self):
+        return list(self.cities)
+
+
+class CityAuditor(Auditor):
+    """Collect the 'addr:city' values not in the expected cities (same as audit_cities)."""
+    name = 'unexpected_cities'
+    tags = ('tag',)
+
+    def __init__(self, expected_cities=expected_cities):
+        self.expected_cities = set(expected_cities)
+        self.weird = set()
+
+    def visit(self, element):
+        if element.attrib['k'] == 'addr:city':
+            v = element.attrib['v'].lower()
+            if v not in self.expected_cities:
+                self.weird.add(v)
+
+    def report(self):
+        return self.weird
+
+
+class StreetTypeAuditor(Auditor):
+    """Group the unexpected street types of nodes and ways (same as audit)."""
+    name = 'street_types'
+    tags = ('node', 'way')
+
+    def __init__(self, expected=expected):
+        self.expected = set(expected)
+        self.street_types = defaultdict(set)
+
+    def visit(self, element):
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == 'addr:street':
+                street_name = tag.attrib['v']
+                m = street_type_re.search(street_name)
+                if m:
+                    street_type = m.group()
+                    if street_type not in self.expected:
+                        self.street_types[street_type].add(street_name)
+
+    def report(self):
+        return dict(self.street_types)
+
+
+class PostcodeAuditor(Auditor):
+    """List the postcodes of nodes and ways not matching the CEP format (same as audit_cep)."""
+    name = 'bad_postcodes'
+    tags = ('node', 'way')
+
+    def __init__(self):
+        self.bad_cep = []
+
+    def visit(self, element):
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == 'addr:postcode':
+                v = tag.attrib['v']
+                if not cep.match(v):
+                    self.bad_cep.append(v)
+
+    def report(self):
+        return self.bad_cep
+
+
+def default_auditors():
+    """Return new instances of the auditors used in the exploration notebook."""
+    return [TagCounter(), CityLister(), CityAuditor(), StreetTypeAuditor(), PostcodeAuditor()]
+
+
+#%% Approximate auditors
+class SketchAuditor(Auditor):
+    """Base class of the auditors keeping an osm_sketch sketch in self.sketch."""
+
+    def merge(self, other):
+        """Combine the result of the same auditor run on another chunk of the data."""
+        self.sketch.merge(other.sketch)
+        return self
+
+    def report(self):
+        return self.sketch.report()
+
+
+class ApproxUserCounter(SketchAuditor):
+    """Estimate the number of distinct users of the nodes, ways and relations."""
+    name = 'distinct_users'
+    tags = ('node', 'way', 'relation')
+
+    def __init__(self, p=14):
+        self.sketch = HyperLogLog(p)
+
+    def visit(self, element):
+        user = element.attrib.get('user')
+        if user is not None:
+            self.sketch.add(user)
+
+
+class ApproxCityCounter(SketchAuditor):
+    """Estimate the number of distinct lower case 'addr:city' values (CityLister)."""
+    name = 'distinct_cities'
+    tags = ('tag',)
+
+    def __init__(self, p=14):
+        self.sketch = HyperLogLog(p)
+
+    def visit(self, element):
+        if element.attrib['k'] == 'addr:city':
+            self.sketch.add(element.attrib['v'].lower())
+
+
+class ApproxTagKeyCounter(SketchAuditor):
+    """Estimate the number of distinct tag keys."""
+    name = 'distinct_tag_keys'
+    tags = ('tag',)
+
+    def __init__(self, p=14):
+        self.sketch = HyperLogLog(p)
+
+    def visit(self, element):
+        self.sketch.add(element.attrib['k'])
+
+
+class ApproxStreetTypeAuditor(SketchAuditor):
+    """Most frequent unexpected street types (StreetTypeAuditor)."""
+    name = 'top_street_types'
+    tags = ('node', 'way')
+
+    def __init__(self, k=20, width=2048, depth=4, expected=expected):
+        self.expected = set(expected)
+        self.sketch = HeavyHitters(k, width, depth)
+
+    def visit(self, element):
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == 'addr:street':
+                m = street_type_re.search(tag.attrib['v'])
+                if m and m.group() not in self.expected:
+                    self.sketch.add(m.group())
+
+
+class ApproxPostcodeAuditor(SketchAuditor):
+    """Most frequent postcodes not matching the CEP format (PostcodeAuditor)."""
+    name = 'top_bad_postcodes'
+    tags = ('node', 'way')
+
+    def __init__(self, k=20, width=2048, depth=4):
+        self.sketch = HeavyHitters(k, width, depth)
+
+    def visit(self, element):
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == 'addr:postcode':
+                v = tag.attrib['v']
+                if not cep.match(v):
+                    self.sketch.add(v)
+
+
+class ApproxTagValueAuditor(SketchAuditor):
+    """Most frequent 'key=value' tags."""
+    name = 'top_tag_values'
+    tags = ('tag',)
+
+    def __init__(self, k=20, width=8192, depth=4):
+        self.sketch = HeavyHitters(k, width, depth)
+
+    def visit(self, element):
+        self.sketch.add('{0}={1}'.format(element.attrib['k'], element.attrib['v']))
+
+
+def approximate_auditors():
+    """Return new instances of the fixed memory auditors."""
+    return [TagCounter(), ApproxUserCounter(), ApproxCityCounter(), ApproxTagKeyCounter(),
+            ApproxStreetTypeAuditor(), ApproxPostcodeAuditor(), ApproxTagValueAuditor()]
+
+
+#%% Engine
+class AuditEngine(object):
+    """Run every registered auditor over a single parse of an OSM file."""
+
+    def __init__(self, auditors=None):
+        self.auditors = []
+        for auditor in auditors or []:
+            self.register(auditor)
+
+    def register(self, auditor):
+        """Add an auditor; its name must be unique in the engine."""
+        if auditor.name is None:
+            raise ValueError('Auditor {0!r} has no name'.format(auditor))
+        if any(a.name == auditor.name for a in self.auditors):
+            raise ValueError('Auditor {0!r} is already registered'.format(auditor.name))
+        self.auditors.append(auditor)
+        return auditor
+
+    def _dispatch_table(self):
+        """Map each element tag to its visitors; None holds the visitors of every tag."""
+        table = defaultdict(list)
+        for auditor in self.auditors:
+            if auditor.tags is None:
+                table[None].append(auditor.visit)
+            else:
+                for tag in auditor.tags:
+                    table[tag].append(auditor.visit)
+        return table
+
+    def run(self, file_in):
+        """Parse the file once and return a dict {auditor name: report}."""
+        table = self._dispatch_table()
+        visit_all = table.pop(None, [])
+        if osm_pbf.is_pbf(file_in):
+            # PBF elements are built whole, visit their children first as iterparse does
+            for element in osm_pbf.iter_pbf_elements(file_in, tags=None):
+                for child in list(element) + [element]:
+                    for visit in table.get(child.tag, ()):
+                        visit(child)
+                    for visit in visit_all:
+                        visit(child)
+            return self.report()
+        root = None
+        depth = 0
+        for event, element in ET.iterparse(file_in, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            for visit in table.get(element.tag, ()):
+                visit(element)
+            for visit in visit_all:
+                visit(element)
+            # Top level elements were visited with their children, free them
+            if depth == 1:
+                element.clear()
+                root.clear()
+        return self.report()
+
+    def report(self):
+        return dict((auditor.name, auditor.report()) for auditor in self.auditors)
+
+
+def audit_file(file_in, auditors=None):
+    """Audit the file in one pass with the given (or the default) auditors."""
+    return AuditEngine(auditors or default_auditors()).run(file_in)
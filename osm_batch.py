@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch cleaning of address values, and re-cleaning of exported data.
+
+clean_values cleans a whole column of 'addr:street', 'addr:city' or 'addr:postcode'
+values (a list, NumPy array or pandas Series) with the same results as the
+audit_street_type, audit_city_name and audit_postal_code calls of shape_element:
+
+- the column is factorized, so every distinct value is cleaned once;
+- the values left unchanged by the audit functions (expected street types and
+  cities, valid postcodes) are found with vectorized pandas string operations
+  (the audit functions are called for each of them when pandas is missing);
+- the other distinct values go through the audit functions, and the results are
+  mapped back to the rows.
+
+The cleaning report counts every row, as if the values had been cleaned one by one.
+
+After changing a mapping, the existing exports are re-cleaned in place without
+parsing the OSM file again (the values are the already cleaned ones, so only the
+new fixes apply):
+
+>reclean_jsonl('Missoes.osm.json')
+>reclean_parquet('Missoes_parquet')
+"""
+
+#%% Some basic statements
+import json
+import os
+
+import final_project_code
+from final_project_code import report
+from osm_writers import JsonLinesWriter, check_rewritable, detect_encoder
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# Audit function of each address field (looked up when called, like shape_tags does)
+FIELDS = {'street': 'audit_street_type',
+          'city': 'audit_city_name',
+          'postcode': 'audit_postal_code'}
+CHUNK_SIZE = 100000
+
+
+class _Recorder(object):
+    """Recorder given to the audit functions, keeping the records of one value."""
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, rule, before, after=None, count=1):
+        self.records.append((rule, before, after))
+
+
+def _field(field):
+    field = field[5:] if field.startswith('addr:') else field
+    if field not in FIELDS:
+        raise ValueError('Unknown address field {0!r}'.format(field))
+    return field
+
+
+def factorize(values):
+    """Return (codes, uniques) of a sequence; missing values (None, NaN) get code -1."""
+    if pandas is not None:
+        codes, uniques = pandas.factorize(pandas.Series(values, dtype=object))
+        return list(codes), list(uniques)
+    codes = []
+    index = {}
+    uniques = []
+    for value in values:
+        if value is None or value != value:
+            codes.append(-1)
+            continue
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(uniques)
+            uniques.append(value)
+        codes.append(code)
+    return codes, uniques
+
+
+def _unchanged(uniques, field):
+    """Return the cleaned values known without the audit functions, None for the others."""
+    fpc = final_project_code
+    if pandas is None:
+        return [None] * len(uniques)
+    values = pandas.Series(uniques, dtype=object)
+    if field == 'city':
+        values = values.str.lower()
+        keep = values.isin(fpc.expected_cities)
+    elif field == 'street':
+        pattern = fpc.street_type_re
+        types = values.str.extract('({0})'.format(pattern.pattern), flags=pattern.flags)[0]
+        keep = types.isna() | types.isin(fpc.expected)
+    else:
+        keep = values.str.match(fpc.cep.pattern, flags=fpc.cep.flags)
+    return [value if known is True else None
+            for value, known in zip(values, keep.fillna(False).astype(bool).tolist())]
+
+
+def clean_unique(uniques, counts, field):
+    """
+    Clean distinct values and record each fix counts[i] times in the cleaning report.
+
+    Return the list of cleaned values.
+    """
+    field = _field(field)
+    audit = getattr(final_project_code, FIELDS[field])
+    cleaned = _unchanged(uniques, field)
+    for i, value in enumerate(uniques):
+        if cleaned[i] is not None:
+            continue
+        # The fixes of the value are recorded count times, not in the shared report
+        recorder = _Recorder()
+        cleaned[i] = audit(value, recorder)
+        for rule, before, after in recorder.records:
+            report.record(rule, before, after, counts[i])
+    return cleaned
+
+
+def clean_values(values, field):
+    """
+    Clean a column of address values of field 'street', 'city' or 'postcode'.
+
+    Return the cleaned values with the type of values (list, NumPy array or pandas
+    Series with the same index); missing values are returned as they are.
+    """
+    codes, uniques = factorize(values)
+    counts = [0] * len(uniques)
+    for code in codes:
+        if code >= 0:
+            counts[code] += 1
+    cleaned = clean_unique(uniques, counts, field)
+    result = [cleaned[code] if code >= 0 else value for code, value in zip(codes, values)]
+    if pandas is not None and isinstance(values, pandas.Series):
+        return pandas.Series(result, index=values.index, name=values.name, dtype=object)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return numpy.array(result, dtype=object)
+    return result
+
+
+#%% Re-cleaning exports
+def _reclean_docs(docs):
+    """Re-clean the address fields of shaped documents in place; return the number changed."""
+    changed = 0
+    for field in FIELDS:
+        rows = [doc['address'] for doc in docs
+                if field in doc.get('address', {}) and isinstance(doc['address'][field], str)]
+        if not rows:
+            continue
+        values = [address[field] for address in rows]
+        for address, value, cleaned in zip(rows, values, clean_values(values, field)):
+            if cleaned != value:
+                address[field] = cleaned
+                changed += 1
+    return changed
+
+
+def reclean_jsonl(store, encoder=None, chunk_size=CHUNK_SIZE):
+    """
+    Re-clean the address fields of a JSON lines file written by process_map, in place.
+
+    The file is rewritten chunk by chunk in a temporary file that replaces it at the
+    end; lines without a changed value are copied as they are, the others are
+    encoded with encoder (by default the one that wrote the store). Compressed and
+    pretty stores are rejected with ValueError. The cleaning report is written to
+    '<store>.report.json'. Return the number of values changed.
+    """
+    check_rewritable(store)
+    encoder = encoder or detect_encoder(store)
+    report.reset()
+    changed = 0
+    tmp = store + '.tmp'
+    with open(store, 'rb') as fi, JsonLinesWriter(tmp, encoder=encoder) as writer:
+        while True:
+            lines = [line for _, line in zip(range(chunk_size), fi)]
+            if not lines:
+                break
+            docs = [json.loads(line) for line in lines]
+            # Compare the addresses before and after to copy the unchanged lines
+            before = [dict(doc['address']) if 'address' in doc else None for doc in docs]
+            changed += _reclean_docs(docs)
+            for line, doc, address in zip(lines, docs, before):
+                if address == doc.get('address'):
+                    writer.write_raw(line)
+                else:
+                    writer.write(doc)
+    os.replace(tmp, store)
+    report.dump("{0}.report.json".format(store))
+    return changed
+
+
+def reclean_parquet(path):
+    """
+    Re-clean the street, city and postcode columns of an osm_columnar export, in place.
+
+    path is the export directory or its addresses.parquet file. Each column is
+    dictionary encoded by Arrow, so only the distinct values are cleaned. Return the
+    number of values changed.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if os.path.isdir(path):
+        path = os.path.join(path, 'addresses.parquet')
+    report.reset()
+    table = pq.read_table(path)
+    changed = 0
+    for field in FIELDS:
+        if field not in table.column_names:
+            continue
+        column = table.column(field).combine_chunks().dictionary_encode()
+        uniques = column.dictionary.to_pylist()
+        counts = pc.value_counts(column.indices.drop_null())
+        occurrences = [0] * len(uniques)
+        for item in counts.to_pylist():
+            occurrences[item['values']] = item['counts']
+        cleaned = pa.array(clean_unique(uniques, occurrences, field), pa.string())
+        new_column = pc.take(cleaned, column.indices)
+        changed += sum(n for value, new, n in zip(uniques, cleaned.to_pylist(), occurrences)
+                       if new != value)
+        table = table.set_column(table.column_names.index(field), field, new_column)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+    report.dump("{0}.report.json".format(path))
+    return changed
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the processing pipeline on synthetic OSM files.
+
+generate_osm writes a deterministic OSM XML file (same parameters and seed, same
+bytes) with a configurable number of nodes, share of ways, tags per element, share
+of dirty 'addr:street'/'addr:city'/'addr:postcode' values and number of relations.
+run_benchmark times parsing, shaping, cleaning and serialization separately and
+reports elements/s and the memory used by each stage: how much its peak RSS rose
+above the RSS it started with (the peak is reset before each stage on Linux;
+elsewhere the RSS at the end of the stage is used).
+
+Results are JSON files, so runs on different commits can be compared:
+
+>python osm_benchmark.py --nodes 200000 --output before.json
+>python osm_benchmark.py --nodes 200000 --output after.json --compare before.json
+"""
+
+#%% Some basic statements
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from xml.sax.saxutils import quoteattr
+
+import final_project_code
+from osm_metrics import rss_mb
+from osm_writers import get_encoder, resolve_encoder
+
+# Values used by the generator; the dirty ones are fixed by the cleaning mappings
+CLEAN_STREETS = ['Rua Tiradentes', 'Avenida Brasil', 'Rua Marechal Floriano', 'Travessa Ipiranga']
+DIRTY_STREETS = ['Av. Brasil', 'BR 158', 'BR158', 'ERS-342', 'RS 344', 'rua dos Andradas']
+DIRTY_CITIES = ['Ijui', 'santo angelo', 'panambi - rs', 'SANTA ROSA', 'Cruz Alta']
+CLEAN_POSTCODES = ['98700-000', '98801-015', '98900-000']
+DIRTY_POSTCODES = ['98910000', '98.700-000', '987000']
+PLAIN_TAGS = [('amenity', ['restaurant', 'school', 'bank', 'pharmacy', 'place_of_worship']),
+              ('cuisine', ['pizza', 'regional', 'burger']),
+              ('highway', ['residential', 'primary', 'bus_stop']),
+              ('name', ['Centro', 'Bela Vista', 'São José']),
+              ('building', ['yes', 'house']),
+              ('source', ['survey', 'bing'])]
+USERS = ['linuxUser16', 'ana', 'bob', 'carla', 'diego', 'eva']
+
+
+#%% Synthetic data
+def _address_tags(rng, dirty_share):
+    def pick(clean, dirty):
+        return rng.choice(dirty) if rng.random() < dirty_share else rng.choice(clean)
+    return [('addr:street', pick(CLEAN_STREETS, DIRTY_STREETS)),
+            ('addr:housenumber', str(rng.randint(1, 3000))),
+            ('addr:city', pick(final_project_code.expected_cities, DIRTY_CITIES)),
+            ('addr:postcode', pick(CLEAN_POSTCODES, DIRTY_POSTCODES))]
+
+
+def _tags(rng, tags_per_element, dirty_share, address_share):
+    tags = []
+    if rng.random() < address_share:
+        tags.extend(_address_tags(rng, dirty_share))
+    for k, values in rng.sample(PLAIN_TAGS, min(tags_per_element, len(PLAIN_TAGS))):
+        tags.append((k, rng.choice(values)))
+    return tags
+
+
+def _meta(rng):
+    user = rng.randrange(len(USERS))
+    return ('version="{0}" changeset="{1}" timestamp="2018-0{2}-1{3}T12:00:00Z" '
+            'user="{4}" uid="{5}"').format(rng.randint(1, 9), rng.randint(1, 60000000),
+                                           rng.randint(1, 9), rng.randint(0, 9),
+                                           USERS[user], 1000 + user)
+
+
+def _write_tags(fo, tags):
+    for k, v in tags:
+        fo.write('  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)))
+
+
+def generate_osm(file_out, nodes=100000, way_ratio=0.1, tags_per_element=2,
+                 dirty_share=0.2, address_share=0.3, relations=100, nodes_per_way=8,
+                 seed=42):
+    """
+    Write a synthetic OSM XML file and return the number of top level elements.
+
+    Keyword arguments:
+    nodes -- number of nodes
+    way_ratio -- number of ways per node
+    tags_per_element -- plain tags of each element (besides the address tags)
+    dirty_share -- share of the address values needing to be cleaned
+    address_share -- share of the elements having address tags
+    relations -- number of relations
+    nodes_per_way -- node references of each way
+    seed -- seed of the random generator; the same arguments give the same file
+    """
+    rng = random.Random(seed)
+    ways = int(nodes * way_ratio)
+    with open(file_out, 'w', encoding='utf-8') as fo:
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fo.write('<osm version="0.6" generator="osm_benchmark">\n')
+        fo.write(' <bounds minlat="-29.0000000" minlon="-55.5000000" '
+                 'maxlat="-27.0000000" maxlon="-53.0000000"/>\n')
+        for node_id in range(1, nodes + 1):
+            tags = _tags(rng, rng.randint(0, tags_per_element), dirty_share, address_share)
+            fo.write(' <node id="{0}" {1} lat="{2:.7f}" lon="{3:.7f}"'.format(
+                node_id, _meta(rng), rng.uniform(-29, -27), rng.uniform(-55.5, -53)))
+            if tags:
+                fo.write('>\n')
+                _write_tags(fo, tags)
+                fo.write(' </node>\n')
+            else:
+                fo.write('/>\n')
+        for way_id in range(1, ways + 1):
+            fo.write(' <way id="{0}" {1}>\n'.format(way_id, _meta(rng)))
+            start = rng.randint(1, max(nodes - nodes_per_way, 1))
+            for ref in range(start, min(start + nodes_per_way, nodes + 1)):
+                fo.write('  <nd ref="{0}"/>\n'.format(ref))
+            _write_tags(fo, _tags(rng, tags_per_element, dirty_share, address_share))
+            fo.write(' </way>\n')
+        for relation_id in range(1, relations + 1):
+            fo.write(' <relation id="{0}" {1}>\n'.format(relation_id, _meta(rng)))
+            fo.write('  <member type="way" ref="{0}" role="outer"/>\n'.format(
+                rng.randint(1, max(ways, 1))))
+            _write_tags(fo, [('type', 'multipolygon')])
+            fo.write(' </relation>\n')
+        fo.write('</osm>\n')
+    return nodes + ways + relations
+
+
+#%% Timing
+def peak_rss_mb():
+    """Return the peak resident set size of the process in MB (ru_maxrss is in KB on Linux)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of the process (VmHWM, Linux only); return False if it failed."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fo:
+            fo.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_since_reset_mb():
+    with open('/proc/self/status') as fi:
+        for line in fi:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    return rss_mb()
+
+
+def _start():
+    """Return the memory state at the start of a stage, for _stage."""
+    return rss_mb(), _reset_peak_rss()
+
+
+def _stage(seconds, count, start):
+    before, reset = start
+    after = _peak_rss_since_reset_mb() if reset else rss_mb()
+    return {'seconds': seconds,
+            'count': count,
+            'per_second': count / seconds if seconds else 0.0,
+            'rss_increase_mb': max(after - before, 0.0)}
+
+
+def bench_parse(file_in):
+    """Time iterparse alone (the elements are only counted)."""
+    start = _start()
+    started = time.perf_counter()
+    count = 0
+    for _ in final_project_code.iter_elements(file_in, tags=None):
+        count += 1
+    return _stage(time.perf_counter() - started, count, start)
+
+
+def collect_samples(file_in, keep=100000):
+    """
+    Return the first 'keep' shaped documents (for the serialization benchmark) and
+    the raw address values (for the cleaning benchmark).
+
+    Done before the timed stages, so their time and memory do not include these lists.
+    """
+    docs = []
+    values = []
+    for element in final_project_code.iter_elements(file_in):
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k in ('addr:street', 'addr:city', 'addr:postcode'):
+                values.append((k, tag.attrib['v']))
+        if len(docs) < keep:
+            docs.append(final_project_code.shape_element(element))
+    return docs, values
+
+
+def bench_shape(file_in):
+    """Time shape_element alone, inside a normal parse of the file (the documents are dropped)."""
+    final_project_code.build_cleaners()
+    final_project_code.report.reset()
+    start = _start()
+    shape = final_project_code.shape_element
+    clock = time.perf_counter
+    seconds = 0.0
+    count = 0
+    for element in final_project_code.iter_elements(file_in):
+        started = clock()
+        shape(element)
+        seconds += clock() - started
+        count += 1
+    return _stage(seconds, count, start)
+
+
+def bench_clean(values):
+    """Time the street, city and postcode cleaning of the raw address values."""
+    fpc = final_project_code
+    cleaners = {'addr:street': fpc.audit_street_type,
+                'addr:city': fpc.audit_city_name,
+                'addr:postcode': fpc.audit_postal_code}
+    fpc.build_cleaners()
+    fpc.report.reset()
+    start = _start()
+    started = time.perf_counter()
+    for k, v in values:
+        cleaners[k](v)
+    return _stage(time.perf_counter() - started, len(values), start)
+
+
+def bench_serialize(docs, encoder=None):
+    """Time the JSON encoding of the shaped documents."""
+    encode = get_encoder(encoder)
+    start = _start()
+    started = time.perf_counter()
+    for doc in docs:
+        encode(doc)
+    return _stage(time.perf_counter() - started, len(docs), start)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(file_in, repeat=3, encoders=('json', None)):
+    """
+    Time every stage 'repeat' times on file_in and keep the best run of each.
+
+    Return a dict with the run metadata and, for each stage, seconds, count,
+    count per second and RSS increase in MB.
+    """
+    best = {}
+
+    def keep_best(name, result):
+        if name not in best or result['seconds'] < best[name]['seconds']:
+            best[name] = result
+
+    docs, values = collect_samples(file_in)
+    for _ in range(repeat):
+        keep_best('parse', bench_parse(file_in))
+        keep_best('shape', bench_shape(file_in))
+        keep_best('clean', bench_clean(values))
+        for encoder in encoders:
+            name = 'serialize_{0}'.format(resolve_encoder(encoder))
+            keep_best(name, bench_serialize(docs, encoder))
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'file': file_in,
+            'repeat': repeat,
+            'stages': best}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Print the speed of every stage relative to a baseline run.
+
+    Return the names of the stages more than 'tolerance' slower than the baseline.
+    """
+    regressions = []
+    for name, stage in sorted(results['stages'].items()):
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['per_second']
+        ratio = stage['per_second'] / before if before else 0.0
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('{0:<18} {1:>12.0f}/s  baseline {2:>12.0f}/s  x{3:.2f}{4}'.format(
+            name, stage['per_second'], before, ratio, flag))
+    return regressions
+
+
+#%% Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--file', help='benchmark this file instead of a synthetic one')
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--way-ratio', type=float, default=0.1)
+    parser.add_argument('--tags', type=int, default=2, help='plain tags per element')
+    parser.add_argument('--dirty', type=float, default=0.2, help='share of dirty address values')
+    parser.add_argument('--relations', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline results JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    file_in = args.file
+    params = None
+    if file_in is None:
+        params = {'nodes': args.nodes, 'way_ratio': args.way_ratio,
+                  'tags_per_element': args.tags, 'dirty_share': args.dirty,
+                  'relations': args.relations, 'seed': args.seed}
+        file_in = 'synthetic_{nodes}_{seed}.osm'.format(**params)
+        generate_osm(file_in, **params)
+
+    results = run_benchmark(file_in, args.repeat)
+    results['generator'] = params
+    for name, stage in sorted(results['stages'].items()):
+        print('{0:<18} {1:>10} in {2:>8.3f}s  {3:>12.0f}/s  RSS +{4:.0f} MB'.format(
+            name, stage['count'], stage['seconds'], stage['per_second'], stage['rss_increase_mb']))
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump(results, fo, indent=2)
+    if args.compare:
+        with open(args.compare) as fi:
+            baseline = json.load(fi)
+        if baseline.get('generator') != params:
+            print('Warning: the baseline was run on a different input')
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed cache of the parsed elements and of the outputs of process_map.
+
+Entries are keyed on the BLAKE2 digest of the input file (computed once per file
+size and modification time) and stored in a directory:
+
+- '<digest>.elements': the node and way elements before any cleaning, as a stream
+  of marshal records (lists of element tuples), so later runs skip the XML parsing;
+- '<digest>-<config>-<options>.output': the output file of process_map and the
+  state of its cleaning report, returned as they are when nothing changed.
+
+The config part of the output key is a fingerprint of the cleaning configuration
+(street_mapping, mapping_cities, mapping_cep, expected, expected_cities, the
+regexes, CREATED and the osm_fuzzy resolvers), so changing a mapping invalidates
+the cached outputs but not the cached elements.
+
+The cache is bounded to max_bytes; the least recently used entries are removed
+first (using an entry touches its modification time).
+
+>cache = ResultCache('.osm_cache', max_bytes=4 * 1024 ** 3)
+>process_map('Missoes.osm', cache=cache)
+"""
+
+#%% Some basic statements
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import struct
+
+import final_project_code
+from osm_pbf import make_element
+from osm_writers import resolve_encoder
+
+CACHE_DIR = '.osm_cache'
+MAX_BYTES = 2 * 1024 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# Elements per marshal record, stored after its size: marshal.load on a file object
+# reads it in tiny pieces, marshal.loads on a block is much faster
+RECORD_BATCH = 4096
+RECORD_SIZE = struct.Struct('<I')
+
+# Changed when the format of the entries or of the shaped documents changes
+CACHE_FORMAT = 1
+
+
+def file_digest(file_in):
+    """Return the hex BLAKE2b digest of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_in, 'rb') as fi:
+        for block in iter(lambda: fi.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_fingerprint():
+    """Return a digest of everything the cleaning and shaping of the elements depend on."""
+    fpc = final_project_code
+    config = {'format': CACHE_FORMAT,
+              # Lists of items: the order of the keys changes the cleaning
+              'mappings': [list(mapping.items())
+                           for mapping in (fpc.street_mapping, fpc.mapping_cities,
+                                           fpc.mapping_cep)],
+              'expected': fpc.expected,
+              'expected_cities': fpc.expected_cities,
+              'regexes': [fpc.problemchars.pattern, fpc.street_type_re.pattern,
+                          fpc.cep.pattern],
+              'created': fpc.CREATED,
+              'resolvers': [resolver.config() if resolver is not None else None
+                            for resolver in (fpc.city_resolver, fpc.street_resolver)]}
+    encoded = json.dumps(config, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=10).hexdigest()
+
+
+def element_record(element):
+    """Return the (tag, attrib, tags, refs, members) tuple of an element, as in osm_pbf."""
+    tags = []
+    refs = []
+    members = []
+    for child in element:
+        if child.tag == 'tag':
+            tags.append((child.attrib['k'], child.attrib['v']))
+        elif child.tag == 'nd':
+            refs.append(child.attrib['ref'])
+        elif child.tag == 'member':
+            members.append((child.attrib['type'], child.attrib['ref'], child.attrib['role']))
+    return element.tag, dict(element.attrib), tags, refs, members
+
+
+#%% Cache
+class ResultCache(object):
+    """
+    Size bounded LRU cache of parsed elements and process_map outputs.
+
+    Keyword arguments:
+    directory -- directory of the entries, created if needed
+    max_bytes -- total size of the entries kept after each store
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = {'elements': 0, 'output': 0}
+        self.misses = {'elements': 0, 'output': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def digest(self, file_in):
+        """Return the digest of file_in, hashing it only when its size or mtime changed."""
+        stat = os.stat(file_in)
+        memo_path = self.path('digests.json')
+        try:
+            with open(memo_path) as fi:
+                memo = json.load(fi)
+        except (IOError, OSError, ValueError):
+            memo = {}
+        key = os.path.abspath(file_in)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        if key in memo and memo[key][0] == stamp:
+            return memo[key][1]
+        digest = file_digest(file_in)
+        memo[key] = [stamp, digest]
+        with open(memo_path + '.tmp', 'w') as fo:
+            json.dump(memo, fo)
+        os.replace(memo_path + '.tmp', memo_path)
+        return digest
+
+    #%% Elements
+    def iter_elements(self, file_in):
+        """
+        Yield the node and way elements of file_in, like final_project_code.iter_elements.
+
+        The elements are read from the cache when they are in it, otherwise they are
+        parsed and stored as they stream by (the entry is kept only if the whole file
+        was read).
+        """
+        path = self.path('{0}.elements'.format(self.digest(file_in)))
+        if self._touch(path):
+            self.hits['elements'] += 1
+            with open(path, 'rb') as fi:
+                while True:
+                    header = fi.read(RECORD_SIZE.size)
+                    if not header:
+                        break
+                    for record in marshal.loads(fi.read(RECORD_SIZE.unpack(header)[0])):
+                        yield make_element(record)
+            return
+        self.misses['elements'] += 1
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as fo:
+                records = []
+                for element in final_project_code.iter_elements(file_in):
+                    records.append(element_record(element))
+                    if len(records) == RECORD_BATCH:
+                        self._dump_records(records, fo)
+                        records = []
+                    yield element
+                if records:
+                    self._dump_records(records, fo)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    @staticmethod
+    def _dump_records(records, fo):
+        data = marshal.dumps(records)
+        fo.write(RECORD_SIZE.pack(len(data)))
+        fo.write(data)
+
+    #%% Outputs
+    def output_key(self, file_in, pretty=False, encoder=None, compression=None):
+        options = '{0}{1}{2}'.format(resolve_encoder(encoder), '-pretty' if pretty else '',
+                                     '-' + compression if compression else '')
+        return '{0}-{1}-{2}'.format(self.digest(file_in), config_fingerprint(), options)
+
+    def restore_output(self, key, file_out):
+        """
+        Copy a cached output to file_out and return the state of its cleaning report.
+
+        Return None when the output is not in the cache.
+        """
+        path = self.path('{0}.output'.format(key))
+        if not self._touch(path) or not self._touch(path + '.report'):
+            self.misses['output'] += 1
+            return None
+        self.hits['output'] += 1
+        shutil.copyfile(path, file_out)
+        with open(path + '.report') as fi:
+            return json.load(fi)
+
+    def store_output(self, key, file_out, report_state):
+        """Store a copy of an output file and the state of its cleaning report."""
+        path = self.path('{0}.output'.format(key))
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        shutil.copyfile(file_out, tmp)
+        report_tmp = '{0}.report.{1}.tmp'.format(path, os.getpid())
+        with open(report_tmp, 'w') as fo:
+            json.dump(report_state, fo)
+        os.replace(report_tmp, path + '.report')
+        os.replace(tmp, path)
+        self.evict()
+
+    #%% Eviction
+    def entries(self):
+        """Return [(last use, size, paths)] of the entries, the least recently used first."""
+        entries = {}
+        for name in os.listdir(self.directory):
+            if name == 'digests.json' or name.endswith('.tmp'):
+                continue
+            path = self.path(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # An output and its report are one entry
+            entry = entries.setdefault('.'.join(name.split('.')[:2]), [0.0, 0, []])
+            entry[0] = max(entry[0], stat.st_mtime)
+            entry[1] += stat.st_size
+            entry[2].append(path)
+        return sorted(entries.values())
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, paths in entries:
+            if total <= max_bytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        return self.evict(0)
+
+    def stats(self):
+        return {'hits': dict(self.hits), 'misses': dict(self.misses),
+                'bytes': self.size(), 'max_bytes': self.max_bytes}
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental updates from OSM change files (.osc).
+
+The nodes and ways of the <create>, <modify> and <delete> blocks of a change file are
+shaped with the same cleaning as process_map and applied to an existing JSON lines
+store or MongoDB collection, instead of rebuilding everything from a new extract:
+
+>apply_to_jsonl('daily.osc', 'Missoes.osm.json')
+>apply_to_collection('daily.osc', db.osm)
+
+A change is applied only if its version is newer than the 'created.version' of the
+stored document; older or equal versions are counted as stale and skipped.
+Given an osm_stats.StatsSink (stats=...), the applied changes are also applied to
+its counts.
+"""
+
+#%% Some basic statements
+import json
+import os
+
+from final_project_code import ET, shape_element
+from osm_writers import JsonLinesWriter, check_rewritable, detect_encoder
+
+ACTIONS = ('create', 'modify', 'delete')
+
+
+#%% Reading the change file
+def iter_changes(file_in):
+    """
+    Yield (action, element) for the nodes and ways of an osmChange file.
+
+    Each element is freed once consumed, as in final_project_code.iter_elements.
+    """
+    action = None
+    block = None
+    depth = 0
+    for event, element in ET.iterparse(file_in, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                action = element.tag
+                block = element
+            continue
+        depth -= 1
+        if depth == 2:
+            if action in ACTIONS and element.tag in ('node', 'way'):
+                yield action, element
+            element.clear()
+            block.clear()
+
+
+def _version(value):
+    return int(value) if value is not None else 0
+
+
+def collect_changes(file_in):
+    """
+    Return {(type, id): (action, version, shaped document or None)}.
+
+    When an element changes several times in the file only its newest version is kept.
+    """
+    changes = {}
+    for action, element in iter_changes(file_in):
+        key = (element.tag, element.attrib['id'])
+        version = _version(element.attrib.get('version'))
+        if key in changes and changes[key][1] > version:
+            continue
+        doc = None if action == 'delete' else shape_element(element)
+        changes[key] = (action, version, doc)
+    return changes
+
+
+def stored_version(doc):
+    return _version(doc.get('created', {}).get('version'))
+
+
+#%% Applying the changes
+def apply_to_jsonl(change_file, store, encoder=None, stats=None):
+    """
+    Apply a change file to a JSON lines file written by process_map.
+
+    Unchanged lines are copied as they are; the store is rewritten in a temporary
+    file that replaces it at the end. The changed lines are encoded with encoder,
+    by default the one that wrote the store (osm_writers.detect_encoder). Compressed
+    and pretty stores are rejected with ValueError. Return the number of created,
+    modified, deleted and stale changes.
+    """
+    check_rewritable(store)
+    encoder = encoder or detect_encoder(store)
+    changes = collect_changes(change_file)
+    counts = dict((k, 0) for k in ('created', 'modified', 'deleted', 'stale'))
+    tmp = store + '.tmp'
+    with open(store, 'rb') as fi, JsonLinesWriter(tmp, encoder=encoder) as writer:
+        for line in fi:
+            doc = json.loads(line)
+            key = (doc['type'], doc['id'])
+            if key not in changes:
+                writer.write_raw(line)
+                continue
+            action, version, new_doc = changes.pop(key)
+            if version <= stored_version(doc):
+                counts['stale'] += 1
+                writer.write_raw(line)
+            elif action == 'delete':
+                counts['deleted'] += 1
+                if stats is not None:
+                    stats.remove(doc)
+            else:
+                counts['modified'] += 1
+                writer.write(new_doc)
+                if stats is not None:
+                    stats.apply_change(doc, new_doc)
+        # Elements not in the store yet
+        for action, version, new_doc in changes.values():
+            if action == 'delete':
+                counts['stale'] += 1
+            else:
+                counts['created'] += 1
+                writer.write(new_doc)
+                if stats is not None:
+                    stats.add(new_doc)
+    os.replace(tmp, store)
+    return counts
+
+
+def apply_to_collection(change_file, collection, batch_size=1000, stats=None, geo=False):
+    """
+    Apply a change file to a MongoDB collection as upserts and deletes keyed on (id, type).
+
+    With stats, the whole stored documents are read to update its counts. With geo,
+    the nodes get their osm_mongo GeoJSON point, as in load_map(geo=True).
+
+    Return the number of upserted, deleted and stale changes.
+    """
+    from pymongo import DeleteOne, ReplaceOne
+    from osm_mongo import with_location
+
+    changes = list(collect_changes(change_file).items())
+    counts = {'upserted': 0, 'deleted': 0, 'stale': 0}
+    for i in range(0, len(changes), batch_size):
+        batch = changes[i:i + batch_size]
+        query = {'$or': [{'type': t, 'id': element_id} for (t, element_id), _ in batch]}
+        projection = None if stats is not None else {'type': 1, 'id': 1, 'created.version': 1}
+        stored = dict(((doc['type'], doc['id']), doc)
+                      for doc in collection.find(query, projection))
+        requests = []
+        for (t, element_id), (action, version, doc) in batch:
+            key = {'id': element_id, 'type': t}
+            old = stored.get((t, element_id))
+            if old is not None:
+                if version <= stored_version(old):
+                    counts['stale'] += 1
+                    continue
+            elif action == 'delete':
+                counts['stale'] += 1
+                continue
+            if action == 'delete':
+                requests.append(DeleteOne(key))
+                counts['deleted'] += 1
+                doc = None
+            else:
+                requests.append(ReplaceOne(key, with_location(doc) if geo else doc,
+                                           upsert=True))
+                counts['upserted'] += 1
+            if stats is not None:
+                stats.apply_change(old, doc)
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+    return counts
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints and resume for long conversions.
+
+process_map_resumable shapes the file shard by shard (the shards of osm_parallel,
+which start at top level element boundaries) and, every checkpoint_bytes of input,
+flushes the output and atomically writes '<output>.checkpoint.json' with:
+
+- the input byte offset of the next shard and the last element (type, id) done;
+- the number of bytes of output written, all of them flushed to disk;
+- the state of the cleaning report.
+
+After a crash, process_map_resumable(..., resume=True) truncates the output to the
+recorded size, restores the report and continues at the recorded input offset, so
+no document is lost or written twice. The output is the same as process_map's.
+
+>process_map('planet.osm', checkpoint_every=256 * 1024 * 1024)
+>process_map('planet.osm', resume=True)
+"""
+
+#%% Some basic statements
+import json
+import os
+
+from final_project_code import report
+from osm_parallel import find_shards, shape_shard
+from osm_writers import output_path, resolve_encoder
+
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+SHARD_SIZE = 4 * 1024 * 1024
+
+
+def checkpoint_path(file_out):
+    return "{0}.checkpoint.json".format(file_out)
+
+
+def _input_id(file_in):
+    """Size and modification time, used to refuse resuming on a different input."""
+    stat = os.stat(file_in)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def load_checkpoint(file_out):
+    """Return the last checkpoint of an output file, or None."""
+    try:
+        with open(checkpoint_path(file_out)) as fi:
+            return json.load(fi)
+    except (IOError, OSError):
+        return None
+
+
+def save_checkpoint(file_out, checkpoint):
+    """Write the checkpoint to a temporary file and rename it over the previous one."""
+    path = checkpoint_path(file_out)
+    with open(path + '.tmp', 'w') as fo:
+        json.dump(checkpoint, fo)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.replace(path + '.tmp', path)
+
+
+#%% Resumable processing
+def process_map_resumable(file_in, pretty=False, encoder=None, resume=False,
+                          checkpoint_every=CHECKPOINT_BYTES, shard_size=SHARD_SIZE):
+    """
+    Shape the OSM file into '<file_in>.json', checkpointing every checkpoint_every bytes.
+
+    With resume=True the run continues from the last checkpoint of a previous run of
+    the same input (and starts from the beginning if there is none).
+    Return the total number of elements and documents processed.
+    """
+    file_out = output_path(file_in)
+    encoder = resolve_encoder(encoder)
+    checkpoint = load_checkpoint(file_out) if resume else None
+    if checkpoint is not None:
+        if checkpoint['input_id'] != _input_id(file_in):
+            raise ValueError('{0} changed since the checkpoint was written'.format(file_in))
+        if checkpoint['encoder'] != encoder or checkpoint['pretty'] != pretty:
+            raise ValueError('The checkpoint was written with encoder={0!r} and pretty={1!r}'
+                             .format(checkpoint['encoder'], checkpoint['pretty']))
+        report.load_state(checkpoint['report'])
+        start = checkpoint['input_offset']
+        fo = open(file_out, 'r+b')
+        # Drop what was written after the checkpoint
+        fo.truncate(checkpoint['output_offset'])
+        fo.seek(checkpoint['output_offset'])
+        print('Resuming {0} at byte {1} after {2}'.format(file_in, start,
+                                                          checkpoint['last_element']))
+    else:
+        report.reset()
+        start = 0
+        fo = open(file_out, 'wb')
+        checkpoint = {'input': file_in, 'input_id': _input_id(file_in),
+                      'encoder': encoder, 'pretty': pretty,
+                      'elements': 0, 'documents': 0, 'last_element': None}
+
+    elements = 0
+    documents = 0
+    pending = 0
+    with fo:
+        for shard_start, shard_end in find_shards(file_in, shard_size, start):
+            lines, count, shaped, last = shape_shard(file_in, shard_start, shard_end,
+                                                     pretty, encoder)
+            fo.write(lines)
+            elements += count
+            documents += shaped
+            pending += shard_end - shard_start
+            if last is not None:
+                checkpoint['last_element'] = last
+            if pending >= checkpoint_every:
+                pending = 0
+                fo.flush()
+                os.fsync(fo.fileno())
+                checkpoint.update({'input_offset': shard_end,
+                                   'output_offset': fo.tell(),
+                                   'elements': checkpoint['elements'] + elements,
+                                   'documents': checkpoint['documents'] + documents,
+                                   'report': report.state()})
+                elements = documents = 0
+                save_checkpoint(file_out, checkpoint)
+
+    # Done: the checkpoint is not needed anymore
+    if os.path.exists(checkpoint_path(file_out)):
+        os.remove(checkpoint_path(file_out))
+    report.dump("{0}.report.json".format(file_out))
+    print(report.summary())
+    return {'elements': checkpoint['elements'] + elements,
+            'documents': checkpoint['documents'] + documents}
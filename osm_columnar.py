@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar (Parquet) export of the shaped data.
+
+ParquetSink receives the documents built by shape_element and writes them as Arrow
+record batches of at most batch_size rows to four Parquet files:
+
+- nodes.parquet: one row per node, with typed id, lat, lon, version, changeset,
+  uid and timestamp columns, the common tags as columns and the other tags in a map;
+- ways.parquet: one row per way, same columns without lat/lon;
+- way_nodes.parquet: (way_id, seq, node_id), one row per node reference;
+- addresses.parquet: the flattened 'address' of nodes and ways.
+
+>process_map('Missoes.osm', columnar='Missoes_parquet')
+
+The amenity/city analyses of the notebook then run with pandas or DuckDB:
+
+>duckdb.sql("SELECT city, count(*) FROM 'Missoes_parquet/addresses.parquet' GROUP BY city")
+"""
+
+#%% Some basic statements
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+BATCH_SIZE = 65536
+
+# Tags stored in their own columns, the other ones go to the 'tags' map
+TAG_COLUMNS = ['amenity', 'cuisine', 'name', 'phone']
+ADDRESS_COLUMNS = ['street', 'housenumber', 'postcode', 'city']
+# Keys of the shaped documents that are not tags
+SHAPE_KEYS = set(['created', 'type', 'pos', 'id', 'visible', 'address', 'node_refs'])
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+TAGS_TYPE = pa.map_(pa.string(), pa.string())
+
+ELEMENT_FIELDS = [pa.field('id', pa.int64()),
+                  pa.field('version', pa.int64()),
+                  pa.field('changeset', pa.int64()),
+                  pa.field('timestamp', pa.timestamp('s', tz='UTC')),
+                  pa.field('user', pa.string()),
+                  pa.field('uid', pa.int64()),
+                  pa.field('visible', pa.bool_())]
+TAG_FIELDS = [pa.field(k, pa.string()) for k in TAG_COLUMNS] + [pa.field('tags', TAGS_TYPE)]
+
+SCHEMAS = {
+    'nodes': pa.schema(ELEMENT_FIELDS[:1] + [pa.field('lat', pa.float64()),
+                                             pa.field('lon', pa.float64())]
+                       + ELEMENT_FIELDS[1:] + TAG_FIELDS),
+    'ways': pa.schema(ELEMENT_FIELDS + TAG_FIELDS),
+    'way_nodes': pa.schema([pa.field('way_id', pa.int64()),
+                            pa.field('seq', pa.int32()),
+                            pa.field('node_id', pa.int64())]),
+    'addresses': pa.schema([pa.field('type', pa.string()),
+                            pa.field('id', pa.int64())]
+                           + [pa.field(k, pa.string()) for k in ADDRESS_COLUMNS]
+                           + [pa.field('other', TAGS_TYPE)]),
+}
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _bool(value):
+    return None if value is None else value == 'true'
+
+
+#%% Parquet sink
+class _Table(object):
+    """Column buffers of one Parquet file, flushed as a record batch when full."""
+
+    def __init__(self, path, schema, batch_size):
+        self.path = path
+        self.schema = schema
+        self.batch_size = batch_size
+        self.columns = dict((name, []) for name in schema.names)
+        self.rows = 0
+        self.writer = None
+
+    def append(self, row):
+        for name, values in self.columns.items():
+            values.append(row.get(name))
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows and self.writer is not None:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if pa.types.is_timestamp(field.type):
+                array = pc.strptime(pa.array(values, pa.string()), TIMESTAMP_FORMAT, 's')
+                array = array.cast(field.type)
+            else:
+                array = pa.array(values, field.type)
+            arrays.append(array)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.columns = dict((name, []) for name in self.schema.names)
+        self.rows = 0
+
+    def close(self):
+        # Also creates the file (with the schema) for tables without rows
+        self.flush()
+        self.writer.close()
+
+
+class ParquetSink(object):
+    """
+    Write shaped nodes and ways to Parquet files in out_dir.
+
+    It is a process_map sink: write(doc) for each shaped document, then close().
+    """
+
+    def __init__(self, out_dir, batch_size=BATCH_SIZE):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.tables = dict((name, _Table(os.path.join(out_dir, name + '.parquet'),
+                                         schema, batch_size))
+                           for name, schema in SCHEMAS.items())
+
+    def write(self, doc):
+        created = doc.get('created', {})
+        element_id = _int(doc.get('id'))
+        row = {'id': element_id,
+               'version': _int(created.get('version')),
+               'changeset': _int(created.get('changeset')),
+               'timestamp': created.get('timestamp'),
+               'user': created.get('user'),
+               'uid': _int(created.get('uid')),
+               'visible': _bool(doc.get('visible'))}
+        tags = []
+        for k, v in doc.items():
+            if k in SHAPE_KEYS or not isinstance(v, str):
+                continue
+            if k in TAG_COLUMNS:
+                row[k] = v
+            else:
+                tags.append((k, v))
+        row['tags'] = tags
+
+        if doc['type'] == 'node':
+            if 'pos' in doc:
+                row['lat'], row['lon'] = doc['pos']
+            self.tables['nodes'].append(row)
+        else:
+            self.tables['ways'].append(row)
+            way_nodes = self.tables['way_nodes']
+            for seq, ref in enumerate(doc.get('node_refs', ())):
+                way_nodes.append({'way_id': element_id, 'seq': seq, 'node_id': int(ref)})
+
+        if 'address' in doc:
+            address = {'type': doc['type'], 'id': element_id}
+            other = []
+            for k, v in doc['address'].items():
+                if k in ADDRESS_COLUMNS:
+                    address[k] = v
+                else:
+                    other.append((k, v))
+            address['other'] = other
+            self.tables['addresses'].append(address)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
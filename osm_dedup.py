@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Version aware deduplication of nodes and ways.
+
+Merged regional extracts repeat the elements of their overlaps, and history files
+hold every version of an element. process_map(dedup=...) keeps the latest version of
+each (type, id) only:
+
+- 'two-pass' (exact): a first pass records, for each id, its highest version and
+  the first element (by position in the file) with that version; the second pass
+  shapes only those elements. It also runs with parallel workers, which then only
+  read the index.
+- 'stream' (single pass): an element is kept if its version is newer than all the
+  versions of its id seen before it. Older or equal versions coming later are
+  dropped, but an older version written before a newer one stays in the output;
+  sinks upserting on (id, type), like osm_mongo.MongoSink, end with the latest one.
+
+>process_map('merged.osm', dedup='two-pass')
+>process_map('merged.osm', dedup='two-pass', workers=4)
+
+The ids are not kept in a dict: each type has a VersionIndex, one 64 bit cell per
+id packing the version and the position of the winning element, in an array for
+ids up to dense_limit and in a sparse memory mapped file above it.
+"""
+
+#%% Some basic statements
+from array import array
+import mmap
+import multiprocessing
+import os
+import tempfile
+
+from osm_parallel import imap_bounded, iter_shard_elements
+
+DENSE_LIMIT = 1 << 24
+GROW = 1 << 20
+TYPES = ('node', 'way')
+
+# A cell is (version << ORDINAL_BITS) | (ordinal + 1); 0 means the id was not seen
+ORDINAL_BITS = 40
+ORDINAL_MASK = (1 << ORDINAL_BITS) - 1
+MAX_VERSION = (1 << (64 - ORDINAL_BITS)) - 1
+
+
+def element_version(element):
+    version = element.attrib.get('version')
+    return int(version) if version is not None else 0
+
+
+#%% Index
+class VersionIndex(object):
+    """
+    Latest version of each id, and the ordinal of the first element having it.
+
+    Ids below dense_limit are cells of an array; the first larger id moves the
+    cells to a sparse file (path, or a temporary file removed by close()) that is
+    memory mapped and indexed by id. Negative ids (new objects of editors) are
+    kept in a dict.
+    """
+
+    def __init__(self, path=None, dense_limit=DENSE_LIMIT):
+        self.path = path
+        self.dense_limit = dense_limit
+        self.cells = array('Q')
+        self.negative = {}
+        self._fd = None
+        self._mm = None
+        self._temporary = False
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _grow(self, size):
+        if self._mm is None and size <= self.dense_limit:
+            self.cells.frombytes(bytes(8 * (size - len(self.cells))))
+            return
+        if self._mm is None:
+            if self.path is None:
+                self._fd, self.path = tempfile.mkstemp(suffix='.versions')
+                self._temporary = True
+            else:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            dense = self.cells
+        else:
+            dense = None
+            self.cells.release()
+            self._mm.close()
+        # Extending the file with ftruncate keeps it sparse
+        os.ftruncate(self._fd, size * 8)
+        self._mm = mmap.mmap(self._fd, size * 8)
+        self.cells = memoryview(self._mm).cast('Q')
+        if dense is not None:
+            self.cells[:len(dense)] = dense
+
+    def get(self, element_id):
+        """Return the cell of an id (0 if it was not seen)."""
+        if element_id < 0:
+            return self.negative.get(element_id, 0)
+        if element_id >= len(self.cells):
+            return 0
+        return self.cells[element_id]
+
+    def offer(self, element_id, version, ordinal):
+        """Record an element; return True if its version is the highest seen for its id."""
+        cell = self.get(element_id)
+        if cell and version <= cell >> ORDINAL_BITS:
+            return False
+        if version > MAX_VERSION or ordinal >= ORDINAL_MASK:
+            raise ValueError('Version {0} or ordinal {1} out of range'.format(version, ordinal))
+        cell = (version << ORDINAL_BITS) | (ordinal + 1)
+        if element_id < 0:
+            self.negative[element_id] = cell
+            return True
+        if element_id >= len(self.cells):
+            size = max(element_id + 1, 2 * len(self.cells), GROW)
+            if self._mm is None and element_id < self.dense_limit:
+                size = min(size, self.dense_limit)
+            self._grow(size)
+        self.cells[element_id] = cell
+        return True
+
+    def winner(self, element_id):
+        """Return the ordinal of the element to keep for an id, or None."""
+        cell = self.get(element_id)
+        return (cell & ORDINAL_MASK) - 1 if cell else None
+
+    def __getstate__(self):
+        # A spilled index is sent to the workers by path, they map the same file
+        state = self.__dict__.copy()
+        state.update({'_fd': None, '_mm': None, '_temporary': False})
+        if self._mm is not None:
+            state['cells'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cells is None:
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._mm = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+            self.cells = memoryview(self._mm).cast('Q')
+
+    def close(self):
+        """Unmap the file, and remove it if it is a temporary one."""
+        if self._mm is not None:
+            self.cells.release()
+            self._mm.close()
+            os.close(self._fd)
+            self._mm = None
+            self.cells = array('Q')
+            if self._temporary:
+                os.remove(self.path)
+
+
+#%% Deduplication
+class Deduplicator(object):
+    """
+    Keep the latest version of each node and way; accept(element) filters them.
+
+    Keyword arguments:
+    mode -- 'two-pass' (call scan() with the elements of the file first) or 'stream'
+    path -- prefix of the spill files of the indexes (temporary files by default)
+    dense_limit -- largest id kept in memory
+    """
+
+    def __init__(self, mode='two-pass', path=None, dense_limit=DENSE_LIMIT):
+        if mode not in ('two-pass', 'stream'):
+            raise ValueError('Unknown dedup mode {0!r}'.format(mode))
+        self.mode = mode
+        self.indexes = dict((t, VersionIndex(path and '{0}.{1}'.format(path, t), dense_limit))
+                            for t in TYPES)
+        self.ordinals = dict((t, 0) for t in TYPES)
+        self.dropped = 0
+
+    def _next(self, element):
+        ordinal = self.ordinals[element.tag]
+        self.ordinals[element.tag] = ordinal + 1
+        return ordinal
+
+    def scan(self, elements):
+        """First pass of 'two-pass': record the versions of the elements of the file."""
+        for element in elements:
+            if element.tag in self.indexes:
+                self.indexes[element.tag].offer(int(element.attrib['id']),
+                                                element_version(element), self._next(element))
+        self.ordinals = dict((t, 0) for t in TYPES)
+
+    def add_shard(self, versions):
+        """Record the (ids, versions) arrays of each type returned by scan_shard, in order."""
+        for t, (ids, shard_versions) in versions.items():
+            index = self.indexes[t]
+            ordinal = self.ordinals[t]
+            for element_id, version in zip(ids, shard_versions):
+                index.offer(element_id, version, ordinal)
+                ordinal += 1
+            self.ordinals[t] = ordinal
+
+    def accept(self, element):
+        """Return True if the element is the one to keep for its (type, id)."""
+        index = self.indexes.get(element.tag)
+        if index is None:
+            return True
+        ordinal = self._next(element)
+        element_id = int(element.attrib['id'])
+        if self.mode == 'stream':
+            keep = index.offer(element_id, element_version(element), ordinal)
+        else:
+            keep = index.winner(element_id) == ordinal
+        if not keep:
+            self.dropped += 1
+        return keep
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+
+
+#%% Parallel first pass
+def scan_shard(args):
+    """Return {type: (ids, versions)} of the nodes and ways of a shard, in file order."""
+    file_in, start, end = args
+    versions = dict((t, (array('q'), array('I'))) for t in TYPES)
+    for element in iter_shard_elements(file_in, start, end):
+        if element.tag in versions:
+            ids, shard_versions = versions[element.tag]
+            ids.append(int(element.attrib['id']))
+            shard_versions.append(element_version(element))
+    return versions
+
+
+def scan_shards(file_in, shards, workers=None, dedup=None):
+    """
+    First pass of 'two-pass' over the shards with a pool of workers.
+
+    Return the Deduplicator and the ordinals of the first node and way of each
+    shard, which the second pass starts from.
+    """
+    dedup = dedup or Deduplicator()
+    starts = []
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = [(file_in, start, end) for start, end in shards]
+        for versions in imap_bounded(pool, scan_shard, tasks,
+                                     2 * (workers or multiprocessing.cpu_count())):
+            starts.append(dict(dedup.ordinals))
+            dedup.add_shard(versions)
+    finally:
+        pool.close()
+        pool.join()
+    dedup.ordinals = dict((t, 0) for t in TYPES)
+    return dedup, starts
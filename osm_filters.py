@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Filters applied to the raw elements, before shape_element.
+
+An ElementFilter given to process_map(element_filter=...) drops the elements that are
+not needed before any dictionary is built or cleaning regex is run, using only the
+XML attributes and tag keys. The checks run from the cheapest to the most expensive:
+element type, position (bounding box, then polygon) and tag keys.
+
+>region = ElementFilter(bbox=(-28.5, -54.5, -28.0, -54.0), require_keys=['amenity', 'addr:*'])
+>process_map('Missoes.osm', element_filter=region)
+
+A way is inside the region if one of its nodes is, so the ids of the nodes inside
+are kept (as a set of ints) while the nodes stream by. OSM files list the nodes
+before the ways, which makes this possible in a single pass.
+"""
+
+
+#%% Geometry
+def point_in_polygon(lat, lon, polygon):
+    """Ray casting test of a point against a polygon given as a list of (lat, lon)."""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            cross = (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i
+            if lon < cross:
+                inside = not inside
+        j = i
+    return inside
+
+
+def _bounds(polygon):
+    lats = [lat for lat, lon in polygon]
+    lons = [lon for lat, lon in polygon]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+#%% Filter
+class ElementFilter(object):
+    """
+    Declarative filter of nodes and ways.
+
+    Keyword arguments:
+    bbox -- (min_lat, min_lon, max_lat, max_lon) the nodes must be in
+    polygon -- list of (lat, lon) vertices the nodes must be in
+    require_keys -- keep only the elements having at least one of these tag keys;
+                    a key ending with '*' matches a prefix, e.g. 'addr:*'
+    exclude_keys -- drop the elements having one of these tag keys (same syntax)
+    types -- element types to keep
+    """
+
+    def __init__(self, bbox=None, polygon=None, require_keys=(), exclude_keys=(),
+                 types=('node', 'way')):
+        if polygon is not None and bbox is None:
+            # Cheap rejection of the points far from the polygon
+            bbox = _bounds(polygon)
+        self.bbox = bbox
+        self.polygon = polygon
+        self.spatial = bbox is not None
+        self.types = frozenset(types)
+        self.require_keys, self.require_prefixes = self._split(require_keys)
+        self.exclude_keys, self.exclude_prefixes = self._split(exclude_keys)
+        self.inside_nodes = set()
+
+    @staticmethod
+    def _split(keys):
+        exact = frozenset(k for k in keys if not k.endswith('*'))
+        prefixes = tuple(k[:-1] for k in keys if k.endswith('*'))
+        return exact, prefixes
+
+    def contains(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return self.polygon is None or point_in_polygon(lat, lon, self.polygon)
+
+    def _inside(self, element):
+        if element.tag == 'node':
+            attrib = element.attrib
+            if 'lat' not in attrib or 'lon' not in attrib:
+                return False
+            if self.contains(float(attrib['lat']), float(attrib['lon'])):
+                # Remembered for the ways, even if the node itself is filtered out
+                self.inside_nodes.add(int(attrib['id']))
+                return True
+            return False
+        inside_nodes = self.inside_nodes
+        for nd in element.iter('nd'):
+            if int(nd.attrib['ref']) in inside_nodes:
+                return True
+        return False
+
+    def _match_keys(self, element):
+        required = self.require_keys or self.require_prefixes
+        found = not required
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k in self.exclude_keys or (self.exclude_prefixes and
+                                          k.startswith(self.exclude_prefixes)):
+                return False
+            if not found and (k in self.require_keys or
+                              (self.require_prefixes and k.startswith(self.require_prefixes))):
+                found = True
+                if not self.exclude_keys and not self.exclude_prefixes:
+                    return True
+        return found
+
+    def accept(self, element):
+        """Return True if the element must be shaped."""
+        if self.spatial:
+            # Nodes are always checked so the ways can use their position
+            if element.tag == 'node' or element.tag in self.types:
+                if not self._inside(element):
+                    return False
+            if element.tag not in self.types:
+                return False
+        elif element.tag not in self.types:
+            return False
+        return self._match_keys(element)
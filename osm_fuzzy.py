@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fuzzy resolution of city names and street types.
+
+The explicit mappings of final_project_code (mapping_cities, street_mapping) only fix
+the variants somebody added to them. A FuzzyResolver maps any value close enough to
+a canonical name ('santo angelo', 'Panambi - RS', 'Ijui', 'Avenidaa') to it:
+
+- values are normalized first: lower case, accents and punctuation removed, state
+  or country suffixes ('rs', 'brasil') dropped, so most variants match exactly;
+- the others are looked up in a SymSpell index: the strings obtained by deleting
+  up to max_distance characters of each canonical name, so a lookup only generates
+  the deletes of the value instead of comparing it with the whole vocabulary;
+- the candidates are checked with the (optimal string alignment) edit distance and
+  the best one is kept if its confidence, 1 - distance / length, reaches
+  min_confidence and no other canonical name is as close;
+- results are cached, since the same values repeat all over an extract.
+
+The resolution is opt-in and runs only for the values the explicit mappings leave
+unchanged and unexpected:
+
+>install()
+>process_map('Missoes.osm')
+
+Fuzzy fixes are recorded as 'city_fuzzy' and 'street_fuzzy' in the cleaning report.
+"""
+
+#%% Some basic statements
+import re
+import unicodedata
+
+import final_project_code
+
+PUNCTUATION = re.compile(r'[^\w\s]+')
+SPACES = re.compile(r'\s+')
+CITY_SUFFIXES = ('rs', 'brasil', 'brazil')
+
+
+def normalize(value, suffixes=()):
+    """Return value in lower case without accents, punctuation, extra spaces and suffixes."""
+    value = unicodedata.normalize('NFKD', value.lower())
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    words = SPACES.sub(' ', PUNCTUATION.sub(' ', value)).split()
+    while len(words) > 1 and words[-1] in suffixes:
+        words.pop()
+    return ' '.join(words)
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Return the optimal string alignment distance of a and b (insertions, deletions,
+    substitutions and transpositions), or max_distance + 1 if it is larger.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        lowest = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            d = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, previous2[j - 2] + 1)
+            current[j] = d
+            if d < lowest:
+                lowest = d
+        if lowest > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+#%% Index
+class SymSpellIndex(object):
+    """
+    Deletes index of a vocabulary of (normalized) terms.
+
+    Only the first prefix_length characters of the terms are used for the deletes,
+    which keeps the index small for long names; candidates are verified on the whole
+    strings.
+    """
+
+    def __init__(self, terms, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.terms = set()
+        self.deletes = {}
+        for term in terms:
+            self.add(term)
+
+    def _deletes(self, term):
+        term = term[:self.prefix_length]
+        found = {term}
+        level = {term}
+        for _ in range(self.max_distance):
+            following = set()
+            for word in level:
+                for i in range(len(word)):
+                    following.add(word[:i] + word[i + 1:])
+            following -= found
+            found |= following
+            level = following
+        return found
+
+    def add(self, term):
+        self.terms.add(term)
+        for delete in self._deletes(term):
+            self.deletes.setdefault(delete, set()).add(term)
+
+    def lookup(self, value):
+        """Return [(distance, term)] of the terms within max_distance of value, closest first."""
+        if value in self.terms:
+            return [(0, value)]
+        candidates = set()
+        for delete in self._deletes(value):
+            candidates.update(self.deletes.get(delete, ()))
+        matches = []
+        for term in candidates:
+            distance = edit_distance(value, term, self.max_distance)
+            if distance <= self.max_distance:
+                matches.append((distance, term))
+        return sorted(matches)
+
+
+#%% Resolver
+class FuzzyResolver(object):
+    """
+    Resolve values to the closest name of a canonical vocabulary.
+
+    Keyword arguments:
+    vocabulary -- canonical names, returned as they are written here
+    max_distance -- largest edit distance between normalized values and names
+    min_confidence -- smallest 1 - distance / length accepted
+    min_length -- shorter values are only resolved when they match exactly
+    suffixes -- trailing words dropped by the normalization
+    cache_size -- number of resolved values kept
+    """
+
+    def __init__(self, vocabulary, max_distance=2, min_confidence=0.8, min_length=4,
+                 suffixes=(), cache_size=100000):
+        self.max_distance = max_distance
+        self.min_confidence = min_confidence
+        self.min_length = min_length
+        self.suffixes = tuple(suffixes)
+        self.canonical = {}
+        for name in vocabulary:
+            self.canonical.setdefault(normalize(name, self.suffixes), name)
+        self.index = SymSpellIndex(self.canonical, max_distance)
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def config(self):
+        """Return the settings of the resolver (they change its results)."""
+        return {'vocabulary': sorted(self.canonical.values()),
+                'max_distance': self.max_distance, 'min_confidence': self.min_confidence,
+                'min_length': self.min_length, 'suffixes': list(self.suffixes)}
+
+    def match(self, value):
+        """Return (canonical name, confidence), or (None, confidence of the best guess)."""
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+        key = normalize(value, self.suffixes)
+        result = (None, 0.0)
+        if key in self.canonical:
+            result = (self.canonical[key], 1.0)
+        elif len(key) >= self.min_length:
+            matches = self.index.lookup(key)
+            if matches:
+                distance, term = matches[0]
+                confidence = 1.0 - float(distance) / max(len(key), len(term))
+                ambiguous = len(matches) > 1 and matches[1][0] == distance
+                if confidence >= self.min_confidence and not ambiguous:
+                    result = (self.canonical[term], confidence)
+                else:
+                    result = (None, confidence)
+        if len(self.cache) < self.cache_size:
+            self.cache[value] = result
+        return result
+
+    def resolve(self, value):
+        """Return the canonical name of value, or None."""
+        return self.match(value)[0]
+
+
+def install(cities=None, street_types=None, max_distance=2, min_confidence=0.8):
+    """
+    Make audit_city_name and audit_street_type resolve the values their mappings leave
+    unexpected, using expected_cities and expected by default.
+    """
+    fpc = final_project_code
+    fpc.city_resolver = FuzzyResolver(cities or fpc.expected_cities, max_distance,
+                                      min_confidence, suffixes=CITY_SUFFIXES)
+    fpc.street_resolver = FuzzyResolver(street_types or fpc.expected, max_distance,
+                                        min_confidence)
+    return fpc.city_resolver, fpc.street_resolver
+
+
+def uninstall():
+    final_project_code.city_resolver = None
+    final_project_code.street_resolver = None
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Node coordinate indexes used to resolve the geometry of ways.
+
+OSM files list the nodes before the ways, so shape_element can store the position of
+every node in an index while streaming and, in the same run, resolve the node_refs of
+each way to positions and attach 'node_pos', 'bbox' and 'centroid' to it:
+
+>process_map('Missoes.osm', node_index=SortedNodeIndex())
+>process_map('planet.osm', node_index=MmapNodeIndex('planet.nodes'))
+
+Coordinates are kept as 32 bit fixed point integers (1e-7 degree, the precision of
+OSM files), never as Python objects:
+
+- SortedNodeIndex keeps ids and coordinates in arrays, looked up by binary search
+  (O(log n)); it suits files whose nodes fit in memory (16 bytes per node).
+- MmapNodeIndex stores the coordinates of node id n at offset 8 * n of a sparse,
+  memory mapped file (O(1) lookups); it suits planet sized files.
+"""
+
+#%% Some basic statements
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+
+SCALE = 10000000
+
+
+def _fixed(value):
+    return int(round(value * SCALE))
+
+
+#%% In memory index
+class SortedNodeIndex(object):
+    """Node positions in sorted arrays of ids and fixed point coordinates."""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.lats = array('i')
+        self.lons = array('i')
+        # Length of the sorted prefix of the arrays
+        self._sorted = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id, lat, lon):
+        if self._sorted == len(self.ids) and (not self.ids or node_id >= self.ids[-1]):
+            self._sorted += 1
+        self.ids.append(node_id)
+        self.lats.append(_fixed(lat))
+        self.lons.append(_fixed(lon))
+
+    def _sort(self):
+        """Sort the ids added out of order and merge them into the sorted prefix."""
+        ids, lats, lons = self.ids, self.lats, self.lons
+        start = self._sorted
+        # Only the tail is ordered through a list; the prefix is copied by slices
+        tail = sorted(range(start, len(ids)), key=ids.__getitem__)
+        merged_ids, merged_lats, merged_lons = array('q'), array('i'), array('i')
+        i = 0
+        for j in tail:
+            node_id = ids[j]
+            k = bisect_right(ids, node_id, i, start)
+            if k > i:
+                merged_ids.extend(ids[i:k])
+                merged_lats.extend(lats[i:k])
+                merged_lons.extend(lons[i:k])
+                i = k
+            merged_ids.append(node_id)
+            merged_lats.append(lats[j])
+            merged_lons.append(lons[j])
+        merged_ids.extend(ids[i:start])
+        merged_lats.extend(lats[i:start])
+        merged_lons.extend(lons[i:start])
+        self.ids, self.lats, self.lons = merged_ids, merged_lats, merged_lons
+        self._sorted = len(merged_ids)
+
+    def get(self, node_id):
+        """Return (lat, lon) of the node, or None if it is not in the index."""
+        if self._sorted < len(self.ids):
+            self._sort()
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return self.lats[i] / SCALE, self.lons[i] / SCALE
+        return None
+
+    def lookup(self, refs):
+        """Return the [lat, lon] of the refs found in the index."""
+        coords = []
+        for ref in refs:
+            pos = self.get(int(ref))
+            if pos is not None:
+                coords.append(list(pos))
+        return coords
+
+    def close(self):
+        pass
+
+
+#%% Memory mapped index
+class MmapNodeIndex(object):
+    """
+    Node positions in a sparse file indexed by node id.
+
+    Each node takes two unsigned 32 bit integers: lat and lon in fixed point, shifted
+    by +900000001 and +1800000001 so that 0 (a hole of the sparse file) means missing.
+    Negative ids (new objects of editors) are kept in a dict.
+    """
+    LAT_SHIFT = 900000001
+    LON_SHIFT = 1800000001
+    GROW = 16 * 1024 * 1024
+
+    def __init__(self, path, keep=False):
+        self.path = path
+        self.keep = keep
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self.size = 0
+        self.mm = None
+        self.cells = None
+        self.negative = {}
+        self._resize(max(os.fstat(self.fd).st_size // 8, self.GROW))
+
+    def _resize(self, nodes):
+        if self.cells is not None:
+            self.cells.release()
+            self.mm.close()
+        # Extending the file with ftruncate keeps it sparse
+        os.ftruncate(self.fd, nodes * 8)
+        self.size = nodes
+        self.mm = mmap.mmap(self.fd, nodes * 8)
+        self.cells = memoryview(self.mm).cast('I')
+
+    def add(self, node_id, lat, lon):
+        if node_id < 0:
+            self.negative[node_id] = (_fixed(lat), _fixed(lon))
+            return
+        if node_id >= self.size:
+            self._resize(max(node_id + 1, 2 * self.size))
+        self.cells[2 * node_id] = _fixed(lat) + self.LAT_SHIFT
+        self.cells[2 * node_id + 1] = _fixed(lon) + self.LON_SHIFT
+
+    def get(self, node_id):
+        """Return (lat, lon) of the node, or None if it is not in the index."""
+        if node_id < 0:
+            pos = self.negative.get(node_id)
+            return (pos[0] / SCALE, pos[1] / SCALE) if pos is not None else None
+        if node_id >= self.size:
+            return None
+        lat = self.cells[2 * node_id]
+        if lat == 0:
+            return None
+        return ((lat - self.LAT_SHIFT) / SCALE,
+                (self.cells[2 * node_id + 1] - self.LON_SHIFT) / SCALE)
+
+    def lookup(self, refs):
+        """Return the [lat, lon] of the refs found in the index."""
+        coords = []
+        for ref in refs:
+            pos = self.get(int(ref))
+            if pos is not None:
+                coords.append(list(pos))
+        return coords
+
+    def close(self):
+        """Unmap the file, and remove it unless keep=True."""
+        if self.cells is not None:
+            self.cells.release()
+            self.mm.close()
+            os.close(self.fd)
+            self.cells = None
+            if not self.keep:
+                os.remove(self.path)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of process_map.
+
+An Instrumentation given to process_map(instrument=...) times each stage of the run:
+
+- parse: iterparse, i.e. waiting for the next element;
+- shape: shape_element, including
+  - problemchars: the problem characters regex, run once per distinct tag key,
+  - street, city, postcode: the audit_street_type, audit_city_name and
+    audit_postal_code cleaners;
+- serialize: the JSON encoding of the documents;
+- write: the writes of the output file.
+
+It prints a progress line every progress_every seconds (elements, rate, ETA from the
+input file offset and RSS), runs the hooks (CProfileHook, TracemallocHook or any
+object with the same methods) on a sample of the elements, and writes the metrics
+as JSON and in the Prometheus text format at the end of the run:
+
+>instrument = Instrumentation(hooks=[CProfileHook(every=1000)])
+>process_map('Missoes.osm', instrument=instrument)
+"""
+
+#%% Some basic statements
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+
+import final_project_code
+
+
+def rss_mb():
+    """Return the current resident set size in MB (the peak one where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as fi:
+            pages = int(fi.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+#%% Hooks
+class SamplingHook(object):
+    """Base class of the hooks: start() and stop() are called around every n-th shaping."""
+
+    def __init__(self, every=1000):
+        self.every = every
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        """Return a JSON serializable result, added to the metrics."""
+        return None
+
+
+class CProfileHook(SamplingHook):
+    """Profile the shaping of the sampled elements with cProfile."""
+
+    def __init__(self, every=1000, top=20, path=None):
+        SamplingHook.__init__(self, every)
+        self.top = top
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def report(self):
+        if self.path:
+            self.profile.dump_stats(self.path)
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+
+class TracemallocHook(SamplingHook):
+    """Sum the memory allocated, by line, while shaping the sampled elements."""
+
+    def __init__(self, every=1000, top=10):
+        SamplingHook.__init__(self, every)
+        self.top = top
+        self.allocated = {}
+
+    def start(self):
+        tracemalloc.start()
+
+    def stop(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for stat in snapshot.statistics('lineno'):
+            line = str(stat.traceback)
+            self.allocated[line] = self.allocated.get(line, 0) + stat.size
+
+    def report(self):
+        top = sorted(self.allocated.items(), key=lambda item: item[1], reverse=True)
+        return [{'line': line, 'bytes': size} for line, size in top[:self.top]]
+
+
+class _TimedPattern(object):
+    """Stand-in for a compiled regex whose search() is timed."""
+
+    def __init__(self, pattern, instrumentation, name):
+        self.pattern = pattern
+        self.search = instrumentation.timed(pattern.search, name)
+
+
+#%% Instrumentation
+class Instrumentation(object):
+    """
+    Per stage timers and counters, progress lines, sampling hooks and metrics dump.
+
+    Keyword arguments:
+    progress_every -- seconds between progress lines (None for no progress)
+    hooks -- sampling hooks run around shape_element
+    out -- stream of the progress lines
+    """
+
+    def __init__(self, progress_every=10.0, hooks=(), out=None):
+        self.progress_every = progress_every
+        self.hooks = list(hooks)
+        self.out = out or sys.stderr
+        self.timers = {}
+        self.counters = {}
+        self.total_bytes = None
+        self.source = None
+        self.started = None
+        self._last_progress = None
+
+    def add(self, name, seconds, count=1):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of code as stage 'name'."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def timed(self, function, name):
+        """Return function wrapped so that its calls are timed as stage 'name'."""
+        clock = time.perf_counter
+        timers = self.timers
+        counters = self.counters
+        timers.setdefault(name, 0.0)
+        counters.setdefault(name, 0)
+
+        def wrapper(*args, **kwargs):
+            started = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timers[name] += clock() - started
+                counters[name] += 1
+        return wrapper
+
+    #%% Attaching to a run
+    def open_input(self, file_in):
+        """Open the input so the progress can use its offset; PBF paths are returned as is."""
+        if isinstance(file_in, str) and not file_in.endswith('.pbf'):
+            self.total_bytes = os.path.getsize(file_in)
+            self.source = open(file_in, 'rb')
+            return self.source
+        return file_in
+
+    def iter_elements(self, elements):
+        """Time the 'parse' stage of an element iterator and print the progress."""
+        clock = time.perf_counter
+        self.started = self._last_progress = time.time()
+        elements = iter(elements)
+        while True:
+            started = clock()
+            try:
+                element = next(elements)
+            except StopIteration:
+                break
+            self.add('parse', clock() - started)
+            yield element
+            if self.progress_every is not None and \
+                    time.time() - self._last_progress >= self.progress_every:
+                self.progress()
+
+    def shaper(self, shape):
+        """Return shape timed as stage 'shape', running the hooks on the sampled elements."""
+        timed_shape = self.timed(shape, 'shape')
+        if not self.hooks:
+            return timed_shape
+        counter = [0]
+
+        def sampled_shape(*args):
+            counter[0] += 1
+            hooks = [hook for hook in self.hooks if counter[0] % hook.every == 0]
+            for hook in hooks:
+                hook.start()
+            try:
+                return timed_shape(*args)
+            finally:
+                for hook in hooks:
+                    hook.stop()
+        return sampled_shape
+
+    def attach_writer(self, writer):
+        """Time the encoding ('serialize') and the file writes ('write') of a JsonLinesWriter."""
+        writer.encode = self.timed(writer.encode, 'serialize')
+        writer.flush = self.timed(writer.flush, 'write')
+
+    @contextmanager
+    def cleaners(self):
+        """Time the problem characters regex and the cleaners while the block runs."""
+        fpc = final_project_code
+        saved = (fpc.problemchars, fpc.audit_street_type, fpc.audit_city_name,
+                 fpc.audit_postal_code)
+        fpc.problemchars = _TimedPattern(fpc.problemchars, self, 'problemchars')
+        fpc.audit_street_type = self.timed(fpc.audit_street_type, 'street')
+        fpc.audit_city_name = self.timed(fpc.audit_city_name, 'city')
+        fpc.audit_postal_code = self.timed(fpc.audit_postal_code, 'postcode')
+        try:
+            yield
+        finally:
+            (fpc.problemchars, fpc.audit_street_type, fpc.audit_city_name,
+             fpc.audit_postal_code) = saved
+
+    #%% Reporting
+    def progress(self):
+        """Print a progress line: elements, rate, position in the input, ETA and RSS."""
+        now = time.time()
+        self._last_progress = now
+        elapsed = now - self.started
+        elements = self.counters.get('parse', 0)
+        rate = elements / elapsed if elapsed else 0.0
+        line = '{0} elements, {1:.0f}/s'.format(elements, rate)
+        if self.source is not None and self.total_bytes:
+            done = self.source.tell() / float(self.total_bytes)
+            eta = elapsed * (1 - done) / done if done else float('nan')
+            line += ', {0:.1%} of input, ETA {1:.0f}s'.format(done, eta)
+        line += ', RSS {0:.0f} MB'.format(rss_mb())
+        print(line, file=self.out)
+
+    def metrics(self):
+        """Return the metrics of the run as a JSON serializable dict."""
+        elapsed = time.time() - self.started if self.started else 0.0
+        elements = self.counters.get('parse', 0)
+        metrics = {'elapsed_seconds': elapsed,
+                   'elements': elements,
+                   'elements_per_second': elements / elapsed if elapsed else 0.0,
+                   'rss_mb': rss_mb(),
+                   'stages': dict((name, {'seconds': self.timers[name],
+                                          'calls': self.counters.get(name, 0)})
+                                  for name in self.timers)}
+        hooks = [{'hook': type(hook).__name__, 'report': hook.report()} for hook in self.hooks]
+        if hooks:
+            metrics['hooks'] = hooks
+        return metrics
+
+    def dump(self, path):
+        """Write the metrics as JSON to path and in the Prometheus text format to path.prom."""
+        metrics = self.metrics()
+        with open(path, 'w') as fo:
+            json.dump(metrics, fo, indent=2)
+        with open(path + '.prom', 'w') as fo:
+            fo.write('osm_elapsed_seconds {0}\n'.format(metrics['elapsed_seconds']))
+            fo.write('osm_elements_total {0}\n'.format(metrics['elements']))
+            fo.write('osm_elements_per_second {0}\n'.format(metrics['elements_per_second']))
+            fo.write('osm_rss_megabytes {0}\n'.format(metrics['rss_mb']))
+            for name, stage in sorted(metrics['stages'].items()):
+                fo.write('osm_stage_seconds{{stage="{0}"}} {1}\n'.format(name, stage['seconds']))
+                fo.write('osm_stage_calls_total{{stage="{0}"}} {1}\n'.format(name, stage['calls']))
+        return metrics
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loading the shaped data straight into MongoDB.
+
+Instead of writing '<file>.json' with process_map and running mongoimport, the
+documents built by shape_element are written to the collection in batches:
+
+>collection = get_collection()
+>load_map('Missoes.osm', collection, batch_size=5000, workers=4)
+
+Documents are upserted on ('id', 'type') by default, so reloading a file replaces
+the existing documents instead of duplicating them. A MongoSink can also be given
+to process_map(sinks=[...]) to load the data while the JSON file is written.
+
+'pos' is stored as [lat, lon], which a 2dsphere index would read as [lon, lat]
+(failing the inserts wherever |lon| > 90). With geo=True the nodes also get a
+GeoJSON point in 'location', in the collection only, and that field gets the
+2dsphere index:
+
+>load_map('Missoes.osm', collection, geo=True)
+>collection.find({'location': {'$near': {'$geometry': point, '$maxDistance': 500}}})
+"""
+
+#%% Some basic statements
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING, GEOSPHERE, MongoClient, ReplaceOne
+
+from final_project_code import iter_shaped, report
+
+# GeoJSON point of the nodes, added to the documents written with geo=True
+GEO_FIELD = 'location'
+
+
+def get_collection(uri='mongodb://localhost:27017/', database='udacity', name='osm'):
+    """Return the collection used by the exploration notebook."""
+    return MongoClient(uri)[database][name]
+
+
+def create_indexes(collection, geo=False):
+    """
+    Create the indexes used by the upserts and by the notebook aggregations.
+
+    geo -- also create the 2dsphere index on GEO_FIELD
+    """
+    collection.create_index([('id', ASCENDING), ('type', ASCENDING)], unique=True)
+    if geo:
+        collection.create_index([(GEO_FIELD, GEOSPHERE)])
+    collection.create_index([('address.city', ASCENDING)])
+    collection.create_index([('amenity', ASCENDING)])
+
+
+def with_location(doc):
+    """Return a copy of a node with its GeoJSON point in GEO_FIELD (other documents as they are)."""
+    if 'pos' not in doc:
+        return doc
+    lat, lon = doc['pos']
+    doc = dict(doc)
+    doc[GEO_FIELD] = {'type': 'Point', 'coordinates': [lon, lat]}
+    return doc
+
+
+#%% Batched sink
+class MongoSink(object):
+    """
+    Write documents to a collection in batches.
+
+    Keyword arguments:
+    collection -- pymongo (or mongomock) collection
+    batch_size -- number of documents sent in each insert_many/bulk_write
+    workers -- number of batches written concurrently by a thread pool
+    upsert -- replace the documents with the same ('id', 'type') instead of inserting
+    geo -- add the GeoJSON point of the nodes in GEO_FIELD
+    """
+
+    def __init__(self, collection, batch_size=1000, workers=1, upsert=True, geo=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.geo = geo
+        self.batch = []
+        self.written = 0
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._pending = []
+
+    def write(self, doc):
+        self.batch.append(doc)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the current batch (in the background when workers > 1)."""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        if self._executor is None:
+            self.written += self._write_batch(batch)
+            return
+        # Bound the batches in flight so a slow server applies backpressure
+        while len(self._pending) >= 2 * self._workers:
+            self.written += self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(self._write_batch, batch))
+
+    def close(self):
+        """Flush the last batch and wait for every write; raise the first write error."""
+        self.flush()
+        try:
+            while self._pending:
+                self.written += self._pending.pop(0).result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+        return self.written
+
+    def _write_batch(self, batch):
+        if self.geo:
+            batch = [with_location(doc) for doc in batch]
+        if self.upsert:
+            requests = [ReplaceOne({'id': doc['id'], 'type': doc['type']}, doc, upsert=True)
+                        for doc in batch]
+            self.collection.bulk_write(requests, ordered=False)
+        else:
+            # insert_many adds an '_id' to the documents, insert copies of them
+            self.collection.insert_many([dict(doc) for doc in batch], ordered=False)
+        return len(batch)
+
+
+def load_map(file_in, collection, batch_size=1000, workers=1, upsert=True, indexes=True,
+             geo=False):
+    """
+    Shape the OSM file and load it into the collection, without an intermediate JSON file.
+
+    With geo=True the nodes get a GeoJSON point in GEO_FIELD, indexed as 2dsphere.
+    Return the number of documents written.
+    """
+    if indexes:
+        create_indexes(collection, geo)
+    report.reset()
+    sink = MongoSink(collection, batch_size, workers, upsert, geo)
+    try:
+        for el in iter_shaped(file_in):
+            sink.write(el)
+    finally:
+        written = sink.close()
+    print(report.summary())
+    return written
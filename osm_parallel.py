@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Multiprocess conversion of large OSM files.
+
+The input is split into shards at the byte offsets where top level <node>, <way> or
+<relation> elements start. Each shard is wrapped in an <osm> root, parsed and shaped
+by a worker of a process pool, and the JSON lines are written by the parent:
+
+- ordered=True writes the shards in file order, so the output is byte identical to
+  the one of final_project_code.process_map;
+- ordered=False (relaxed order) writes each shard as soon as it is done. The lines
+  of a shard keep their relative order, but shards may appear in any order.
+
+OSM XML files are UTF-8 and never contain a raw '<' inside attribute values, so
+searching for '<node', '<way' and '<relation' finds exactly the top level elements.
+"""
+
+#%% Some basic statements
+from collections import deque
+import io
+from itertools import islice
+import multiprocessing
+import os
+import queue
+import re
+import time
+
+import final_project_code
+import osm_pbf
+from osm_writers import JsonLinesWriter, get_encoder, output_path, resolve_encoder
+
+# Start of a top level element
+TOP_LEVEL_RE = re.compile(br'<(?:node|way|relation)[\s/>]')
+ROOT_END = b'</osm>'
+
+SHARD_SIZE = 32 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+#%% Splitting the input
+def find_element_start(fi, offset, limit):
+    """Return the offset of the first top level element starting at or after offset (or limit)."""
+    fi.seek(offset)
+    pos = offset
+    buf = b''
+    while pos + len(buf) < limit:
+        block = fi.read(READ_SIZE)
+        if not block:
+            break
+        buf += block
+        m = TOP_LEVEL_RE.search(buf)
+        if m:
+            return min(pos + m.start(), limit)
+        # Keep the last bytes in case a start tag is split between two reads
+        keep = min(len(buf), 16)
+        pos += len(buf) - keep
+        buf = buf[-keep:]
+    return limit
+
+
+def find_root_end(fi, size):
+    """Return the offset of the closing </osm> tag (or the file size)."""
+    tail = min(size, READ_SIZE)
+    fi.seek(size - tail)
+    pos = fi.read(tail).rfind(ROOT_END)
+    return size - tail + pos if pos >= 0 else size
+
+
+def find_shards(file_in, shard_size=SHARD_SIZE, start=0):
+    """
+    Return a list of (start, end) byte ranges covering the top level elements.
+
+    Every range begins at the start of a top level element and ends where the next
+    range begins (or at </osm>), so each one holds whole elements only. The shards
+    of '.pbf' files are groups of whole file blocks.
+    """
+    if osm_pbf.is_pbf(file_in):
+        return [shard for shard in osm_pbf.find_blocks(file_in, shard_size) if shard[0] >= start]
+    size = os.path.getsize(file_in)
+    shards = []
+    with open(file_in, 'rb') as fi:
+        end = find_root_end(fi, size)
+        begin = find_element_start(fi, start, end)
+        while begin < end:
+            stop = find_element_start(fi, begin + shard_size, end)
+            shards.append((begin, stop))
+            begin = stop
+    return shards
+
+
+def read_shard(file_in, start, end):
+    """Return the bytes of a shard wrapped in an <osm> root element."""
+    with open(file_in, 'rb') as fi:
+        fi.seek(start)
+        return b'<osm>' + fi.read(end - start) + ROOT_END
+
+
+#%% Running tasks
+def imap_bounded(pool, func, iterable, window, ordered=True):
+    """
+    Yield func(args) for each item of iterable, computed by the pool, like pool.imap.
+
+    pool.imap submits every task at once and keeps every result until it is
+    consumed, in order: one slow task makes the results of all the others wait in
+    memory. Here at most window tasks are running or done and waiting, besides the
+    result being consumed, so the memory holds at most window + 1 results. With ordered=False the results are yielded
+    as soon as they are done (as pool.imap_unordered).
+    """
+    tasks = iter(iterable)
+    if ordered:
+        pending = deque(pool.apply_async(func, (args,)) for args in islice(tasks, window))
+        while pending:
+            result = pending.popleft().get()
+            for args in islice(tasks, 1):
+                pending.append(pool.apply_async(func, (args,)))
+            yield result
+        return
+    done = queue.Queue()
+
+    def submit(args):
+        pool.apply_async(func, (args,), callback=lambda value: done.put((True, value)),
+                         error_callback=lambda error: done.put((False, error)))
+
+    running = 0
+    for args in islice(tasks, window):
+        submit(args)
+        running += 1
+    while running:
+        ok, value = done.get()
+        running -= 1
+        if not ok:
+            raise value
+        for args in islice(tasks, 1):
+            submit(args)
+            running += 1
+        yield value
+
+
+#%% Shaping the shards
+def iter_shard_elements(file_in, start, end):
+    """Yield the top level elements of a shard."""
+    if osm_pbf.is_pbf(file_in):
+        return osm_pbf.iter_range_elements(file_in, start, end)
+    data = io.BytesIO(read_shard(file_in, start, end))
+    return final_project_code.iter_elements(data, tags=None)
+
+
+def shape_shard(file_in, start, end, pretty=False, encoder='json', dedup=None):
+    """
+    Shape the elements of a shard, recording the cleaning in final_project_code.report.
+
+    Return the JSON lines (bytes) of its nodes and ways, encoded exactly as process_map
+    does, the number of top level elements parsed, the number of documents shaped and
+    the (type, id) of the last element. dedup is an osm_dedup.Deduplicator whose
+    ordinals are set to the ones of the first node and way of the shard.
+    """
+    encode = get_encoder(encoder, pretty)
+    lines = []
+    count = 0
+    last = None
+    for element in iter_shard_elements(file_in, start, end):
+        count += 1
+        last = (element.tag, element.attrib.get('id'))
+        if dedup is not None and not dedup.accept(element):
+            continue
+        el = final_project_code.shape_element(element)
+        if el:
+            lines.append(encode(el) + b'\n')
+    return b''.join(lines), count, len(lines), last
+
+
+# Deduplicator of the workers, set once per process by _init_worker
+_dedup = None
+
+
+def _init_worker(dedup):
+    global _dedup
+    _dedup = dedup
+
+
+def _shape_shard_task(args):
+    """Shape a shard in a worker and return its results and cleaning report."""
+    report = final_project_code.report
+    report.reset()
+    file_in, start, end, pretty, encoder, ordinals = args
+    dedup = None
+    if ordinals is not None:
+        dedup = _dedup
+        dedup.ordinals = dict(ordinals)
+        dedup.dropped = 0
+    results = shape_shard(file_in, start, end, pretty, encoder, dedup)
+    return results + (dedup.dropped if dedup is not None else 0, report)
+
+
+def process_map_parallel(file_in, pretty=False, workers=None, ordered=True,
+                         shard_size=SHARD_SIZE, encoder=None, compression=None, dedup=False):
+    """
+    Shape the OSM file into '<file_in>.json' using a pool of worker processes.
+
+    Keyword arguments:
+    file_in -- path of the OSM XML file
+    pretty -- indent the JSON documents, as in process_map
+    workers -- number of processes (default: number of CPUs)
+    ordered -- keep the input order (byte identical to process_map); when False the
+               shards are written as soon as they are done (relaxed order)
+    shard_size -- approximate size in bytes of each shard
+    encoder, compression -- JSON encoder and output compression, as in process_map
+    dedup -- keep the latest version of each node and way only ('two-pass' mode of
+             osm_dedup: the versions are scanned by the pool first)
+
+    The merged cleaning report of the shards is written next to the output, as in
+    process_map. Return a dict with the number of elements, documents, seconds and
+    elements/s.
+    """
+    file_out = output_path(file_in, compression)
+    # Resolve the encoder here so every worker uses the same one
+    encoder = resolve_encoder(encoder)
+    started = time.time()
+    shards = find_shards(file_in, shard_size)
+    deduplicator = None
+    starts = [None] * len(shards)
+    if dedup:
+        import osm_dedup
+        deduplicator, starts = osm_dedup.scan_shards(file_in, shards, workers)
+    tasks = [(file_in, start, end, pretty, encoder, ordinals)
+             for (start, end), ordinals in zip(shards, starts)]
+    elements = 0
+    documents = 0
+    dropped = 0
+    report = final_project_code.report
+    report.reset()
+    # The workers get the index once, and only read it
+    pool = multiprocessing.Pool(workers, _init_worker, (deduplicator,))
+    try:
+        # Two shards per worker in flight: the memory holds at most that many outputs
+        results = imap_bounded(pool, _shape_shard_task, tasks,
+                               2 * (workers or multiprocessing.cpu_count()), ordered)
+        with JsonLinesWriter(file_out, pretty, encoder, compression) as writer:
+            for lines, count, shaped, last, shard_dropped, shard_report in results:
+                writer.write_raw(lines)
+                report.merge(shard_report)
+                elements += count
+                documents += shaped
+                dropped += shard_dropped
+    finally:
+        pool.close()
+        pool.join()
+        if deduplicator is not None:
+            deduplicator.close()
+
+    report.dump("{0}.report.json".format(file_out))
+    print(report.summary())
+    seconds = time.time() - started
+    stats = {'elements': elements,
+             'documents': documents,
+             'seconds': seconds,
+             'elements_per_second': elements / seconds if seconds else 0.0,
+             'shards': len(shards),
+             'workers': workers or multiprocessing.cpu_count()}
+    if dedup:
+        stats['duplicates'] = dropped
+        print('Dropped {0} older or duplicate versions'.format(dropped))
+    print('Processed {0} elements in {1:.1f}s ({2:.0f} elements/s)'.format(
+        elements, seconds, stats['elements_per_second']))
+    return stats
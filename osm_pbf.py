@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reader of OSM PBF files (.osm.pbf).
+
+The file blocks are decoded with zlib and a small hand written protobuf decoder, and
+each node, way and relation is returned as an ElementTree element with the same
+attributes and <tag>, <nd> and <member> children as in the XML files, so that
+shape_element, the audits and process_map work unchanged:
+
+>for element in iter_pbf_elements('sul-latest.osm.pbf'):
+>    shape_element(element)
+
+final_project_code.iter_elements reads '.pbf' files with this module. The packed
+arrays of the dense nodes and the string table are decoded once per block, and
+iter_pbf_elements(workers=N) decodes the blocks in a pool of processes. Format:
+https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+#%% Some basic statements
+from itertools import accumulate
+import lzma
+import multiprocessing
+import struct
+import time
+import zlib
+
+from final_project_code import ET
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+def is_pbf(file_in):
+    return isinstance(file_in, str) and file_in.endswith('.pbf')
+
+
+#%% Protobuf decoding
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """Yield (field number, value) of a message; length delimited values are memoryviews."""
+    buf = memoryview(buf)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {0}'.format(wire))
+        yield key >> 3, value
+
+
+def _packed(buf):
+    """Decode a packed repeated varint field."""
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _signed(n):
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def _packed_sint(buf):
+    return [(n >> 1) ^ -(n & 1) for n in _packed(buf)]
+
+
+def _delta(buf):
+    return list(accumulate(_packed_sint(buf)))
+
+
+#%% File blocks
+def iter_fileblocks(fi):
+    """Yield (type, offset, size, blob) for every file block; offset is its length prefix."""
+    offset = 0
+    while True:
+        head = fi.read(4)
+        if not head:
+            return
+        header_size = struct.unpack('>I', head)[0]
+        blob_type = None
+        data_size = 0
+        for field, value in _fields(fi.read(header_size)):
+            if field == 1:
+                blob_type = bytes(value).decode('utf-8')
+            elif field == 3:
+                data_size = value
+        blob = fi.read(data_size)
+        size = 4 + header_size + data_size
+        yield blob_type, offset, size, blob
+        offset += size
+
+
+def decode_blob(blob):
+    """Return the uncompressed data of a Blob message."""
+    raw_size = None
+    for field, value in _fields(blob):
+        if field == 1:
+            return bytes(value)
+        elif field == 2:
+            raw_size = value
+        elif field == 3:
+            return zlib.decompress(value, bufsize=raw_size or zlib.DEF_BUF_SIZE)
+        elif field == 4:
+            return lzma.decompress(value)
+        elif field == 7:
+            if zstandard is None:
+                raise ImportError('zstd compressed blocks need the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(value, max_output_size=raw_size)
+    raise ValueError('Unsupported PBF blob compression')
+
+
+def check_header(data):
+    """Raise if the OSMHeader block requires features this reader does not have."""
+    for field, value in _fields(data):
+        if field == 4:
+            feature = bytes(value).decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError('Unsupported PBF feature {0!r}'.format(feature))
+
+
+def find_blocks(file_in, shard_size=None):
+    """
+    Return the (start, end) byte ranges of the OSMData blocks.
+
+    Consecutive blocks are grouped in ranges of about shard_size bytes, used as the
+    shards of osm_parallel.
+    """
+    ranges = []
+    with open(file_in, 'rb') as fi:
+        for blob_type, offset, size, blob in iter_fileblocks(fi):
+            if blob_type == 'OSMHeader':
+                check_header(decode_blob(blob))
+            elif blob_type == 'OSMData':
+                if ranges and shard_size and offset - ranges[-1][0] < shard_size:
+                    ranges[-1] = (ranges[-1][0], offset + size)
+                else:
+                    ranges.append((offset, offset + size))
+    return ranges
+
+
+#%% Primitive blocks
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _coord(nano):
+    """Format nanodegrees as the shortest exact decimal string, as in the XML files."""
+    sign = '-' if nano < 0 else ''
+    whole, frac = divmod(abs(nano), 1000000000)
+    frac = '{0:09d}'.format(frac).rstrip('0')
+    return '{0}{1}.{2}'.format(sign, whole, frac) if frac else '{0}{1}'.format(sign, whole)
+
+
+class _Block(object):
+    """Decoding state of a PrimitiveBlock: string table, granularity and offsets."""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, value in _fields(data):
+            if field == 1:
+                self.strings = [bytes(s).decode('utf-8') for _, s in _fields(value)]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = _signed(value)
+            elif field == 20:
+                self.lon_offset = _signed(value)
+
+    def info(self, attrib, version=None, timestamp=None, changeset=None, uid=None,
+             user_sid=None, visible=None):
+        """Add the metadata attributes in the order of the OSM XML files."""
+        if visible is not None:
+            attrib['visible'] = 'true' if visible else 'false'
+        if version is not None:
+            attrib['version'] = str(version)
+        if changeset is not None:
+            attrib['changeset'] = str(changeset)
+        if timestamp is not None:
+            attrib['timestamp'] = _timestamp(timestamp * self.date_granularity // 1000)
+        if user_sid:
+            attrib['user'] = self.strings[user_sid]
+        if uid is not None:
+            attrib['uid'] = str(uid)
+
+    def decode_info(self, attrib, data):
+        fields = {}
+        for field, value in _fields(data):
+            fields[field] = value
+        self.info(attrib, fields.get(1), fields.get(2), fields.get(3),
+                  _signed(fields[4]) if 4 in fields else None, fields.get(5), fields.get(6))
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def position(self, attrib, lat, lon):
+        attrib['lat'] = _coord(self.lat_offset + self.granularity * lat)
+        attrib['lon'] = _coord(self.lon_offset + self.granularity * lon)
+
+    def elements(self):
+        """Return the elements of the block as (tag, attrib, tags, refs, members) tuples."""
+        elements = []
+        for group in self.groups:
+            for field, value in _fields(group):
+                if field == 1:
+                    elements.append(self.node(value))
+                elif field == 2:
+                    elements.extend(self.dense(value))
+                elif field == 3:
+                    elements.append(self.way(value))
+                elif field == 4:
+                    elements.append(self.relation(value))
+        return elements
+
+    def _common(self, data, zigzag_id=False):
+        """Decode the id, keys, vals and info fields shared by nodes, ways and relations."""
+        attrib = {}
+        keys = vals = ()
+        info = None
+        rest = {}
+        for field, value in _fields(data):
+            if field == 1:
+                attrib['id'] = str(_zigzag(value) if zigzag_id else _signed(value))
+            elif field == 2:
+                keys = _packed(value)
+            elif field == 3:
+                vals = _packed(value)
+            elif field == 4:
+                info = value
+            else:
+                rest[field] = value
+        if info is not None:
+            self.decode_info(attrib, info)
+        return attrib, self.tags(keys, vals), rest
+
+    def node(self, data):
+        # Node ids are sint64, way and relation ids int64
+        attrib, tags, rest = self._common(data, zigzag_id=True)
+        self.position(attrib, _zigzag(rest.get(8, 0)), _zigzag(rest.get(9, 0)))
+        return ('node', attrib, tags, (), ())
+
+    def way(self, data):
+        attrib, tags, rest = self._common(data)
+        refs = [str(ref) for ref in _delta(rest[8])] if 8 in rest else []
+        return ('way', attrib, tags, refs, ())
+
+    def relation(self, data):
+        attrib, tags, rest = self._common(data)
+        roles = _packed(rest[8]) if 8 in rest else []
+        memids = _delta(rest[9]) if 9 in rest else []
+        types = _packed(rest[10]) if 10 in rest else []
+        members = [(MEMBER_TYPES[t], str(ref), self.strings[role])
+                   for t, ref, role in zip(types, memids, roles)]
+        return ('relation', attrib, tags, (), members)
+
+    def dense(self, data):
+        """Decode a DenseNodes message, one packed array at a time."""
+        ids = lats = lons = keys_vals = ()
+        info = None
+        for field, value in _fields(data):
+            if field == 1:
+                ids = _delta(value)
+            elif field == 5:
+                info = value
+            elif field == 8:
+                lats = _delta(value)
+            elif field == 9:
+                lons = _delta(value)
+            elif field == 10:
+                keys_vals = _packed(value)
+
+        infos = None
+        if info is not None:
+            columns = {}
+            for field, value in _fields(info):
+                if field == 1 or field == 6:
+                    columns[field] = _packed(value)
+                else:
+                    columns[field] = _delta(value)
+            infos = [columns.get(f) for f in (1, 2, 3, 4, 5, 6)]
+
+        strings = self.strings
+        nodes = []
+        kv = 0
+        for i, node_id in enumerate(ids):
+            attrib = {'id': str(node_id)}
+            if infos is not None:
+                self.info(attrib, *[column[i] if column else None for column in infos])
+            self.position(attrib, lats[i], lons[i])
+            tags = []
+            if keys_vals:
+                while keys_vals[kv] != 0:
+                    tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                    kv += 2
+                kv += 1
+            nodes.append(('node', attrib, tags, (), ()))
+        return nodes
+
+
+def decode_block(blob):
+    """Decode an OSMData blob into (tag, attrib, tags, refs, members) tuples."""
+    return _Block(decode_blob(blob)).elements()
+
+
+def make_element(item):
+    """Build the ElementTree element of a decoded (tag, attrib, tags, refs, members) tuple."""
+    tag, attrib, tags, refs, members = item
+    element = ET.Element(tag, attrib)
+    for ref in refs:
+        ET.SubElement(element, 'nd', {'ref': ref})
+    for member_type, ref, role in members:
+        ET.SubElement(element, 'member', {'type': member_type, 'ref': ref, 'role': role})
+    for k, v in tags:
+        ET.SubElement(element, 'tag', {'k': k, 'v': v})
+    return element
+
+
+#%% Reading elements
+def _iter_blobs(fi):
+    for blob_type, offset, size, blob in iter_fileblocks(fi):
+        if blob_type == 'OSMHeader':
+            check_header(decode_blob(blob))
+        elif blob_type == 'OSMData':
+            yield blob
+
+
+def _decode_range(file_in, start, end):
+    with open(file_in, 'rb') as fi:
+        fi.seek(start)
+        items = []
+        for blob_type, offset, size, blob in iter_fileblocks(fi):
+            if blob_type == 'OSMData':
+                items.extend(decode_block(blob))
+            if start + offset + size >= end:
+                break
+        return items
+
+
+def iter_range_elements(file_in, start, end, tags=None):
+    """Yield the elements of the blocks in the byte range (start, end) of find_blocks."""
+    for item in _decode_range(file_in, start, end):
+        if tags is None or item[0] in tags:
+            yield make_element(item)
+
+
+def iter_pbf_elements(file_in, tags=('node', 'way'), workers=None):
+    """
+    Yield the elements of a PBF file as ElementTree elements.
+
+    Keyword arguments:
+    file_in -- path of the .osm.pbf file
+    tags -- element tags to yield (None yields nodes, ways and relations)
+    workers -- decode the blocks in a pool of this many processes
+    """
+    with open(file_in, 'rb') as fi:
+        if workers and workers > 1:
+            from osm_parallel import imap_bounded
+            pool = multiprocessing.Pool(workers)
+            try:
+                # At most two blocks per worker are read ahead of the consumer
+                blocks = imap_bounded(pool, decode_block, _iter_blobs(fi), 2 * workers)
+                for items in blocks:
+                    for item in items:
+                        if tags is None or item[0] in tags:
+                            yield make_element(item)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for blob in _iter_blobs(fi):
+                for item in decode_block(blob):
+                    if tags is None or item[0] in tags:
+                        yield make_element(item)
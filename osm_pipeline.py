@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Threaded reading, shaping and writing for process_map(pipelined=True).
+
+The work of process_map is split in three stages connected by bounded queues:
+
+- reader: reads large blocks of the input, decompressing '.gz' and '.bz2' files
+  on the fly;
+- shaper (the calling thread): feeds the blocks to an XMLPullParser and shapes the
+  nodes and ways, in batches;
+- writer: writes the batches, encoded by the shaper, to the JSON lines output and
+  the documents to the sinks.
+
+File reads, decompression, compression and writes release the GIL, so they overlap
+with the shaping and a run takes about as long as its slowest stage. The queues
+are bounded: a slow stage makes the others wait instead of filling the memory.
+An exception in any stage stops the others and is raised again by
+process_map_pipelined, and the output is the same as process_map's.
+
+>process_map('Missoes.osm.bz2', pipelined=True)
+"""
+
+#%% Some basic statements
+import bz2
+from contextlib import ExitStack
+import queue
+import threading
+import zlib
+
+import final_project_code
+from final_project_code import ET, report
+import osm_pbf
+from osm_writers import JsonLinesWriter, output_path
+
+READ_SIZE = 1024 * 1024
+# The parser is fed smaller pieces: it is slower when it builds many elements at once
+FEED_SIZE = 64 * 1024
+COMPRESSED_READ_SIZE = 256 * 1024
+BATCH_SIZE = 1000
+QUEUE_SIZE = 8
+
+# End of the stream of blocks or batches
+DONE = object()
+
+
+def _decompressor(file_in):
+    """Return a factory of decompressors for the file suffix, or None."""
+    if file_in.endswith('.gz'):
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if file_in.endswith('.bz2'):
+        return bz2.BZ2Decompressor
+    return None
+
+
+def iter_blocks(file_in, read_size=READ_SIZE):
+    """
+    Yield the bytes of an OSM XML file in blocks, decompressing '.gz' and '.bz2' files.
+
+    Compressed files are read in blocks of COMPRESSED_READ_SIZE given to the
+    decompressor in a single call (gzip.open and bz2.open decompress small pieces,
+    holding the GIL in between). Files made of several gzip members or bzip2
+    streams are read to the end.
+    """
+    new_decompressor = _decompressor(file_in)
+    with open(file_in, 'rb') as fi:
+        if new_decompressor is None:
+            for block in iter(lambda: fi.read(read_size), b''):
+                yield block
+            return
+        decompressor = new_decompressor()
+        for data in iter(lambda: fi.read(COMPRESSED_READ_SIZE), b''):
+            while data:
+                block = decompressor.decompress(data)
+                if block:
+                    yield block
+                if not decompressor.eof:
+                    break
+                data = decompressor.unused_data
+                decompressor = new_decompressor()
+
+
+#%% Stages
+class Pipeline(object):
+    """
+    Threads connected by bounded queues, with a shared stop flag.
+
+    A stage failing sets the flag, so the others leave their put() and get() calls
+    instead of waiting forever, and check() raises its exception again.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def spawn(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            except BaseException as error:
+                if self.error is None:
+                    self.error = error
+                self.stopped.set()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def put(self, q, item):
+        """Put item in q; return False if the pipeline was stopped meanwhile."""
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        """Return the next item of q, or DONE if the pipeline was stopped meanwhile."""
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.check()
+
+
+def read_blocks(pipeline, file_in, blocks, read_size=READ_SIZE):
+    """Reader stage: put the (decompressed) blocks of file_in in the blocks queue."""
+    for block in iter_blocks(file_in, read_size):
+        if not pipeline.put(blocks, block):
+            return
+    pipeline.put(blocks, DONE)
+
+
+def write_batches(pipeline, batches, writer, sinks):
+    """Writer stage: write the (encoded lines, documents) batches until DONE."""
+    while True:
+        batch = pipeline.get(batches)
+        if batch is DONE:
+            break
+        lines, docs = batch
+        writer.write_raw(lines)
+        for sink in sinks:
+            for doc in docs:
+                sink.write(doc)
+
+
+def iter_block_elements(pipeline, blocks, tags=('node', 'way')):
+    """Shaper stage input: yield the top level elements parsed from the blocks queue."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    while True:
+        block = pipeline.get(blocks)
+        if block is DONE:
+            pipeline.check()
+            parser.close()
+            break
+        for offset in range(0, len(block), FEED_SIZE):
+            parser.feed(block[offset:offset + FEED_SIZE])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    if element.tag in tags:
+                        yield element
+                    element.clear()
+                    root.clear()
+
+
+#%% Running
+def process_map_pipelined(file_in, pretty=False, collect=False, sinks=(), encoder=None,
+                          compression=None, node_index=None, element_filter=None,
+                          batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE):
+    """
+    Shape the OSM file into '<file_in>.json' like process_map, with the reading,
+    shaping and writing done by three threads.
+
+    Return the list of shaped dictionaries if collect=True.
+    """
+    if osm_pbf.is_pbf(file_in):
+        raise ValueError('pipelined reads OSM XML files (optionally .gz or .bz2), not PBF')
+    file_out = output_path(file_in, compression)
+    data = [] if collect else None
+    report.reset()
+    shape = final_project_code.shape_element
+    blocks = queue.Queue(queue_size)
+    batches = queue.Queue(queue_size)
+    pipeline = Pipeline()
+    try:
+        with JsonLinesWriter(file_out, pretty, encoder, compression) as writer:
+            pipeline.spawn(read_blocks, pipeline, file_in, blocks)
+            pipeline.spawn(write_batches, pipeline, batches, writer, sinks)
+            try:
+                # Encoding holds the GIL, so it is done here and the writer thread only
+                # compresses and writes, which releases it
+                encode = writer.encode
+                lines = []
+                docs = []
+                for element in iter_block_elements(pipeline, blocks):
+                    if element_filter is not None and not element_filter.accept(element):
+                        if node_index is not None:
+                            final_project_code.index_node(element, node_index)
+                        continue
+                    el = shape(element, node_index)
+                    if not el:
+                        continue
+                    if collect:
+                        data.append(el)
+                    lines.append(encode(el))
+                    if sinks:
+                        docs.append(el)
+                    if len(lines) >= batch_size:
+                        lines.append(b'')
+                        pipeline.put(batches, (b'\n'.join(lines), docs))
+                        lines = []
+                        docs = []
+                if lines:
+                    lines.append(b'')
+                    pipeline.put(batches, (b'\n'.join(lines), docs))
+                pipeline.put(batches, DONE)
+                for thread in pipeline.threads:
+                    thread.join()
+            finally:
+                pipeline.stop()
+    finally:
+        # Also after an error: the stages are stopped, the sinks write their last batch.
+        # Every sink is closed even if another one fails (in order, as in process_map)
+        with ExitStack() as stack:
+            for sink in reversed(sinks):
+                stack.callback(sink.close)
+
+    report.dump("{0}.report.json".format(file_out))
+    print(report.summary())
+    return data
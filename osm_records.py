@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact typed records for nodes and ways.
+
+shape_element builds nested dictionaries of strings for every element. shape_record
+builds a NodeRecord or WayRecord instead: __slots__ objects with int ids, versions,
+changesets and uids, float coordinates and the way references in an array('q').
+The cleaned tags are the same as in shape_element (both use shape_tags).
+
+record.to_dict() builds, only when called, the same dictionary shape_element returns
+(same keys, key order and string values), so the JSON and MongoDB outputs do not
+change. Numeric attributes are written back with str(int(value)), which is the
+original text for every value found in OSM files.
+"""
+
+#%% Some basic statements
+from array import array
+
+from final_project_code import CREATED, iter_elements, shape_tags
+
+# Attributes parsed to int
+INT_ATTRIBS = ('id', 'version', 'changeset', 'uid')
+STR_ATTRIBS = ('timestamp', 'user', 'visible')
+
+# Attribute orders already seen, shared by the records having the same one
+_layouts = {}
+
+
+def _layout(keys):
+    keys = tuple(keys)
+    return _layouts.setdefault(keys, keys)
+
+
+#%% Records
+class ElementRecord(object):
+    """Common fields and to_dict() of the node and way records."""
+    __slots__ = ('id', 'version', 'changeset', 'uid', 'timestamp', 'user', 'visible',
+                 'tags', 'layout', 'extra')
+    type = None
+
+    def __init__(self, attrib, tags):
+        get = attrib.get
+        self.id = _int(get('id'))
+        self.version = _int(get('version'))
+        self.changeset = _int(get('changeset'))
+        self.uid = _int(get('uid'))
+        self.timestamp = get('timestamp')
+        self.user = get('user')
+        self.visible = get('visible')
+        # (is_address, key, value) tuples, as yielded by shape_tags
+        self.tags = tags
+        # Order of the XML attributes, to rebuild the dictionary keys in order
+        self.layout = _layout(attrib.keys())
+        extra = None
+        for k in self.layout:
+            if k not in INT_ATTRIBS and k not in STR_ATTRIBS and k != 'lat' and k != 'lon':
+                if extra is None:
+                    extra = {}
+                extra[k] = attrib[k]
+        self.extra = extra
+
+    def attrib(self, k):
+        """Return the XML attribute k as the original string."""
+        if k in INT_ATTRIBS:
+            value = getattr(self, k)
+            return None if value is None else str(value)
+        if k in STR_ATTRIBS:
+            return getattr(self, k)
+        return self.extra[k]
+
+    def to_dict(self):
+        """Return the dictionary shape_element builds for the same element."""
+        node = {'created': {}, 'type': self.type}
+        self._add_pos(node)
+        for k in self.layout:
+            if k == 'lat' or k == 'lon':
+                continue
+            if k in CREATED:
+                node['created'][k] = self.attrib(k)
+            else:
+                node[k] = self.attrib(k)
+        for is_address, k, v in self.tags:
+            if is_address:
+                if 'address' not in node:
+                    node['address'] = {}
+                node['address'][k] = v
+            else:
+                node[k] = v
+        self._add_refs(node)
+        return node
+
+    def _add_pos(self, node):
+        pass
+
+    def _add_refs(self, node):
+        pass
+
+
+class NodeRecord(ElementRecord):
+    __slots__ = ('lat', 'lon')
+    type = 'node'
+
+    def __init__(self, attrib, tags):
+        ElementRecord.__init__(self, attrib, tags)
+        if 'lat' in attrib and 'lon' in attrib:
+            self.lat = float(attrib['lat'])
+            self.lon = float(attrib['lon'])
+        else:
+            self.lat = self.lon = None
+
+    def _add_pos(self, node):
+        if self.lat is not None:
+            node['pos'] = [self.lat, self.lon]
+
+
+class WayRecord(ElementRecord):
+    __slots__ = ('refs',)
+    type = 'way'
+
+    def __init__(self, attrib, tags, refs):
+        ElementRecord.__init__(self, attrib, tags)
+        self.refs = refs
+
+    def _add_refs(self, node):
+        if len(self.refs) > 0:
+            node['node_refs'] = [str(ref) for ref in self.refs]
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+#%% Shaping
+def shape_record(element):
+    """Return a NodeRecord or WayRecord for node and way elements, None otherwise."""
+    if element.tag == 'node':
+        return NodeRecord(element.attrib, tuple(shape_tags(element)))
+    elif element.tag == 'way':
+        refs = array('q', [int(nd.attrib['ref']) for nd in element.iter('nd')])
+        return WayRecord(element.attrib, tuple(shape_tags(element)), refs)
+    return None
+
+
+def iter_records(file_in):
+    """Yield the record of every node and way in the OSM file."""
+    for element in iter_elements(file_in):
+        yield shape_record(element)
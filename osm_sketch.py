@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fixed memory sketches for the approximate audit of very large files.
+
+Exact distinct counts and frequency tables grow with the data (every user, city,
+tag value...). These sketches use a fixed amount of memory, chosen up front, and
+give estimates with known error bounds:
+
+- HyperLogLog(p): number of distinct values, 2**p bytes, relative standard
+  error 1.04 / sqrt(2**p) (0.81% with the default p=14, 16 KB);
+- CountMinSketch(width, depth): frequency of any value, 8 * width * depth bytes;
+  an estimate is never below the true count and, with probability 1 - exp(-depth),
+  at most e / width * total above it (e = 2.718...);
+- HeavyHitters(k): the k most frequent values, by Count-Min estimates.
+
+Values are hashed with BLAKE2b, so the sketches of the same parameters built on
+different chunks of a file (or in different processes) are merged with merge()
+into the sketch of the whole file.
+"""
+
+#%% Some basic statements
+from array import array
+import hashlib
+import math
+
+MASK64 = (1 << 64) - 1
+
+
+def hash128(value):
+    """Return two 64 bit hashes of a string (or bytes)."""
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    digest = hashlib.blake2b(value, digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+
+#%% Distinct counts
+class HyperLogLog(object):
+    """
+    Estimate the number of distinct values added.
+
+    p -- number of index bits (4 to 18); 2**p one byte registers
+    """
+
+    def __init__(self, p=14):
+        if not 4 <= p <= 18:
+            raise ValueError('p must be between 4 and 18')
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        h = hash128(value)[0]
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            # Small range correction: linear counting of the empty registers
+            empty = self.registers.count(0)
+            if empty:
+                estimate = m * math.log(float(m) / empty)
+        return int(round(estimate))
+
+    def error(self):
+        """Relative standard error of count()."""
+        return 1.04 / math.sqrt(self.m)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('Cannot merge HyperLogLog sketches of different sizes')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def report(self):
+        return {'estimate': self.count(), 'relative_error': self.error()}
+
+
+#%% Frequencies
+class CountMinSketch(object):
+    """
+    Estimate the number of times each value was added.
+
+    width -- counters per row, e / width is the error relative to the total
+    depth -- rows, the error bound holds with probability 1 - exp(-depth)
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    @classmethod
+    def from_error(cls, epsilon=0.001, delta=0.01):
+        """Return a sketch overestimating by at most epsilon * total with probability 1 - delta."""
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1.0 / delta))))
+
+    def _columns(self, value):
+        h1, h2 = hash128(value)
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, value, count=1):
+        """Add count to value and return its new estimate."""
+        self.total += count
+        estimate = None
+        for row, column in zip(self.rows, self._columns(value)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, value):
+        return min(row[column] for row, column in zip(self.rows, self._columns(value)))
+
+    def error_bound(self):
+        """Largest overestimate (with probability 1 - exp(-depth))."""
+        return math.e / self.width * self.total
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Cannot merge Count-Min sketches of different sizes')
+        for row, other_row in zip(self.rows, other.rows):
+            for i, count in enumerate(other_row):
+                if count:
+                    row[i] += count
+        self.total += other.total
+        return self
+
+
+class HeavyHitters(object):
+    """
+    The k most frequent values, kept with their Count-Min estimates.
+
+    At most 2 * k candidates are kept; when the table is full only the k with the
+    highest estimates stay (as in final_project_code.TopCounter).
+    """
+
+    def __init__(self, k=20, width=2048, depth=4):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.candidates = {}
+
+    def add(self, value, count=1):
+        estimate = self.sketch.add(value, count)
+        candidates = self.candidates
+        if value in candidates or len(candidates) < 2 * self.k:
+            candidates[value] = estimate
+        elif estimate > min(candidates.values()):
+            candidates[value] = estimate
+            self._prune()
+
+    def _prune(self):
+        self.candidates = dict(self.most_common(self.k))
+
+    def most_common(self, n=None):
+        # Ties by value, so the merged sketches of chunks give the same order
+        items = sorted(self.candidates.items(), key=lambda item: (-item[1], item[0]))
+        return items if n is None else items[:n]
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        values = set(self.candidates) | set(other.candidates)
+        self.candidates = dict((value, self.sketch.estimate(value)) for value in values)
+        self._prune()
+        return self
+
+    def report(self):
+        return {'top': self.most_common(self.k),
+                'total': self.sketch.total,
+                'error_bound': self.sketch.error_bound()}
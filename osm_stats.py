@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Summary statistics of the shaped data, maintained while the documents stream by.
+
+The exploration notebook computes its overview with full collection scans
+(find().count() per type, distinct('created.user') and $group pipelines). A
+StatsSink given to process_map(stats=True) counts the same things as the documents
+are written and saves them to '<output>.stats.json':
+
+- documents, nodes and ways (data_information);
+- documents per user, hence the number of distinct users;
+- documents per 'address.city' (the city count aggregation);
+- nodes per amenity (find_amenities);
+- amenity and cuisine values per city (find_amenities_byCity).
+
+Everything is kept as counts, so a document can be removed as well as added and
+osm_changes keeps the statistics in sync with apply_change(old, new):
+
+>stats = StatsSink.load('Missoes.osm.json.stats.json')
+>apply_to_jsonl('daily.osc', 'Missoes.osm.json', stats=stats)
+>stats.close()
+"""
+
+#%% Some basic statements
+from collections import Counter
+import json
+
+
+#%% Statistics
+class StatsSink(object):
+    """
+    Counts of the documents written to it, with write(doc) and close() like the sinks
+    of process_map.
+
+    path -- file the statistics are written to by close() (None to not write them)
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.types = Counter()
+        self.users = Counter()
+        self.cities = Counter()
+        self.amenities = Counter()
+        # {city (None for no city): (amenity Counter, cuisine Counter)}
+        self.by_city = {}
+
+    def add(self, doc, sign=1):
+        """Count a document (or uncount it, with sign=-1)."""
+        self.types[doc.get('type')] += sign
+        user = doc.get('created', {}).get('user')
+        if user is not None:
+            self.users[user] += sign
+        city = doc.get('address', {}).get('city')
+        if city is not None:
+            self.cities[city] += sign
+        amenity = doc.get('amenity')
+        cuisine = doc.get('cuisine')
+        if amenity is not None and doc.get('type') == 'node':
+            self.amenities[amenity] += sign
+        if amenity is not None or cuisine is not None:
+            if city not in self.by_city:
+                self.by_city[city] = (Counter(), Counter())
+            amenities, cuisines = self.by_city[city]
+            if amenity is not None:
+                amenities[amenity] += sign
+            if cuisine is not None:
+                cuisines[cuisine] += sign
+
+    def write(self, doc):
+        self.add(doc)
+
+    def remove(self, doc):
+        self.add(doc, -1)
+
+    def apply_change(self, old, new):
+        """Replace the counts of document old (None if created) by those of new (None if deleted)."""
+        if old is not None:
+            self.remove(old)
+        if new is not None:
+            self.add(new)
+
+    def merge(self, other):
+        """Add the counts of another StatsSink to this one."""
+        for counter in ('types', 'users', 'cities', 'amenities'):
+            getattr(self, counter).update(getattr(other, counter))
+        for city, (amenities, cuisines) in other.by_city.items():
+            if city not in self.by_city:
+                self.by_city[city] = (Counter(), Counter())
+            self.by_city[city][0].update(amenities)
+            self.by_city[city][1].update(cuisines)
+        return self
+
+    #%% Views
+    def overview(self):
+        """Return the numbers of data_information."""
+        return {'documents': sum(self.types.values()),
+                'nodes': self.types['node'],
+                'ways': self.types['way'],
+                'users': sum(1 for count in self.users.values() if count > 0)}
+
+    @staticmethod
+    def _groups(counter):
+        # Most frequent first, ties by key so the order does not depend on the history
+        return [{'_id': key, 'count': count}
+                for key, count in sorted(counter.items(), key=lambda item: (-item[1], item[0]))
+                if count > 0]
+
+    def city_counts(self):
+        """Return the result of the city count aggregation, the most frequent first."""
+        return self._groups(self.cities)
+
+    def amenity_counts(self):
+        """Return the result of find_amenities."""
+        return self._groups(self.amenities)
+
+    def amenities_by_city(self):
+        """Return the result of find_amenities_byCity (the values sorted)."""
+        return [{'_id': city,
+                 'amenities': sorted(k for k, count in amenities.items() if count > 0),
+                 'cuisine': sorted(k for k, count in cuisines.items() if count > 0)}
+                for city, (amenities, cuisines) in self.by_city.items()]
+
+    def to_dict(self):
+        """Return the views and the counts they are computed from."""
+        return {'overview': self.overview(),
+                'cities': self.city_counts(),
+                'amenities': self.amenity_counts(),
+                'amenities_by_city': self.amenities_by_city(),
+                'counts': {'types': dict(self.types),
+                           'users': dict(self.users),
+                           'cities': dict(self.cities),
+                           'amenities': dict(self.amenities),
+                           'by_city': [[city, dict(amenities), dict(cuisines)]
+                                       for city, (amenities, cuisines) in self.by_city.items()]}}
+
+    #%% Saving and loading
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as fo:
+            json.dump(self.to_dict(), fo, indent=2, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        """Return the StatsSink saved in path; close() writes it back there."""
+        with open(path, encoding='utf-8') as fi:
+            counts = json.load(fi)['counts']
+        stats = cls(path)
+        stats.types.update(counts['types'])
+        stats.users.update(counts['users'])
+        stats.cities.update(counts['cities'])
+        stats.amenities.update(counts['amenities'])
+        for city, amenities, cuisines in counts['by_city']:
+            stats.by_city[city] = (Counter(amenities), Counter(cuisines))
+        return stats
+
+    def close(self):
+        if self.path is not None:
+            self.dump(self.path)
+
+
+def save_to_collection(stats, collection, name='osm_stats'):
+    """Store the statistics as a single document {'_id': name, ...} of a MongoDB collection."""
+    doc = stats.to_dict()
+    doc['_id'] = name
+    collection.replace_one({'_id': name}, doc, upsert=True)
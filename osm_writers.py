@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+JSON lines writers used by process_map.
+
+The encoder is chosen once, when the writer is created: orjson or ujson when they
+are installed, the standard json module otherwise. 'pretty' is an encoder setting,
+so the shaping loop only calls writer.write(doc). Lines are buffered and written in
+large blocks, optionally through gzip or zstd (the zstandard package) compression.
+"""
+
+#%% Some basic statements
+import gzip
+from itertools import islice
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 1024 * 1024
+
+# Suffix added to the '.json' output file name for each compression
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+# First bytes of the gzip and zstd formats
+MAGIC_NUMBERS = (b'\x1f\x8b', b'\x28\xb5\x2f\xfd')
+
+
+#%% Encoders
+def resolve_encoder(name=None):
+    """Return the name of the encoder to use: 'orjson', 'ujson' or 'json'."""
+    if name in (None, 'auto'):
+        if orjson is not None:
+            return 'orjson'
+        if ujson is not None:
+            return 'ujson'
+        return 'json'
+    if name == 'orjson' and orjson is None or name == 'ujson' and ujson is None:
+        raise ImportError('The {0} package is not installed'.format(name))
+    if name not in ('orjson', 'ujson', 'json'):
+        raise ValueError('Unknown JSON encoder {0!r}'.format(name))
+    return name
+
+
+def get_encoder(name=None, pretty=False):
+    """Return a function encoding a document into UTF-8 JSON bytes."""
+    name = resolve_encoder(name)
+    if name == 'orjson':
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        return lambda doc: orjson.dumps(doc, option=option)
+    if name == 'ujson':
+        indent = 2 if pretty else 0
+        return lambda doc: ujson.dumps(doc, indent=indent).encode('utf-8')
+    # Same output as the original json.dumps(el) / json.dumps(el, indent=2)
+    indent = 2 if pretty else None
+    return lambda doc: json.dumps(doc, indent=indent).encode('utf-8')
+
+
+def check_rewritable(file_in):
+    """
+    Raise ValueError unless file_in is an uncompressed JSON lines file written with
+    pretty=False, the only kind the stores are rewritten in place line by line.
+    """
+    with open(file_in, 'rb') as fi:
+        first = fi.readline()
+    if file_in.endswith(('.gz', '.zst')) or first.startswith(MAGIC_NUMBERS):
+        raise ValueError('{0} is compressed, decompress it before rewriting it'.format(file_in))
+    if first.strip() == b'{':
+        raise ValueError('{0} was written with pretty=True, it cannot be rewritten line by '
+                         'line'.format(file_in))
+
+
+def detect_encoder(file_in, max_lines=1000):
+    """
+    Return the name of the encoder that wrote a JSON lines file (not pretty).
+
+    The first lines are decoded and encoded again with each installed encoder,
+    until a single one gives the same bytes ('json' if several still do).
+    """
+    installed = {'json': True, 'orjson': orjson is not None, 'ujson': ujson is not None}
+    names = [name for name in ('json', 'orjson', 'ujson') if installed[name]]
+    encoders = dict((name, get_encoder(name)) for name in names)
+    with open(file_in, 'rb') as fi:
+        for line in islice(fi, max_lines):
+            line = line.rstrip(b'\r\n')
+            doc = json.loads(line)
+            names = [name for name in names if encoders[name](doc) == line]
+            if len(names) <= 1:
+                break
+    if not names:
+        raise ValueError('{0} was not written by an installed encoder, give the encoder '
+                         'to use'.format(file_in))
+    return names[0]
+
+
+#%% Writers
+def output_path(file_in, compression=None):
+    """Return the name of the JSON lines file written for file_in."""
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {0!r}'.format(compression))
+    return "{0}.json{1}".format(file_in, COMPRESSIONS[compression])
+
+
+def open_output(file_out, compression=None, mode='wb'):
+    """Open a binary file, compressed with gzip or zstd if requested."""
+    if compression is None:
+        return open(file_out, mode)
+    if compression == 'gzip':
+        return gzip.open(file_out, mode, compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().stream_writer(open(file_out, mode))
+    raise ValueError('Unknown compression {0!r}'.format(compression))
+
+
+class JsonLinesWriter(object):
+    """
+    Buffered writer of one JSON document per line.
+
+    Keyword arguments:
+    file_out -- output file name
+    pretty -- indent the documents (the lines are then multi-line documents)
+    encoder -- 'orjson', 'ujson', 'json' or None to pick the fastest installed
+    compression -- None, 'gzip' or 'zstd'
+    buffer_size -- number of bytes buffered before each write to the file
+    """
+
+    def __init__(self, file_out, pretty=False, encoder=None, compression=None,
+                 buffer_size=BUFFER_SIZE):
+        self.file_out = file_out
+        self.encoder = resolve_encoder(encoder)
+        self.encode = get_encoder(self.encoder, pretty)
+        self.buffer_size = buffer_size
+        self.fo = open_output(file_out, compression)
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, doc):
+        line = self.encode(doc) + b'\n'
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_raw(self, data):
+        """Write already encoded JSON lines."""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.fo.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self.fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
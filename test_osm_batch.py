@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_batch: batch cleaning gives the results of the audit functions."""
+
+import json
+import random
+import threading
+
+import pytest
+
+import final_project_code
+import osm_batch
+from final_project_code import report
+from osm_benchmark import (CLEAN_POSTCODES, CLEAN_STREETS, DIRTY_CITIES, DIRTY_POSTCODES,
+                           DIRTY_STREETS)
+from osm_writers import detect_encoder
+
+AUDITS = {'street': final_project_code.audit_street_type,
+          'city': final_project_code.audit_city_name,
+          'postcode': final_project_code.audit_postal_code}
+VALUES = {'street': CLEAN_STREETS + DIRTY_STREETS,
+          'city': final_project_code.expected_cities + DIRTY_CITIES,
+          'postcode': CLEAN_POSTCODES + DIRTY_POSTCODES}
+
+
+def column(field, size=500):
+    rng = random.Random(field)
+    return [rng.choice(VALUES[field]) for _ in range(size)]
+
+
+def audit_one_by_one(values, field):
+    report.reset()
+    cleaned = [AUDITS[field](value) for value in values]
+    return cleaned, report.to_dict()
+
+
+@pytest.fixture(params=['pandas', 'python'])
+def engine(request, monkeypatch):
+    if request.param == 'pandas':
+        pytest.importorskip('pandas')
+    else:
+        monkeypatch.setattr(osm_batch, 'pandas', None)
+    return request.param
+
+
+@pytest.mark.parametrize('field', ['street', 'city', 'postcode'])
+def test_clean_values_equals_audits(engine, field):
+    values = column(field)
+    expected, expected_report = audit_one_by_one(values, field)
+    report.reset()
+    assert osm_batch.clean_values(values, field) == expected
+    assert report.to_dict() == expected_report
+    assert osm_batch.clean_values(values, 'addr:' + field) == expected
+
+
+def test_clean_values_keeps_type_and_missing_values():
+    pandas = pytest.importorskip('pandas')
+    numpy = pytest.importorskip('numpy')
+    values = ['BR158', None, 'Rua Tiradentes', float('nan'), 'BR158']
+    codes, uniques = osm_batch.factorize(values)
+    assert codes == [0, -1, 1, -1, 0] and uniques == ['BR158', 'Rua Tiradentes']
+
+    series = pandas.Series(values, index=list('abcde'), name='street')
+    cleaned = osm_batch.clean_values(series, 'street')
+    assert list(cleaned.index) == list('abcde') and cleaned.name == 'street'
+    assert cleaned['a'] == cleaned['e'] == 'BR-158'
+    assert cleaned.isna().tolist() == series.isna().tolist()
+    array = osm_batch.clean_values(numpy.array(values, dtype=object), 'street')
+    assert isinstance(array, numpy.ndarray) and array[2] == 'Rua Tiradentes'
+    with pytest.raises(ValueError):
+        osm_batch.clean_values(values, 'country')
+
+
+def test_concurrent_clean_values_record_every_row():
+    values = column('street')
+    _, expected_report = audit_one_by_one(values, 'street')
+    report.reset()
+    threads = [threading.Thread(target=osm_batch.clean_values, args=(values, 'street'))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counts = dict((rule, value['count']) for rule, value in report.to_dict().items())
+    assert counts == dict((rule, 4 * value['count'])
+                          for rule, value in expected_report.items())
+
+
+def test_reclean_jsonl(synthetic, monkeypatch):
+    final_project_code.process_map(synthetic, encoder='json')
+    store = synthetic + '.json'
+    with open(store, 'rb') as fi:
+        before = fi.read().splitlines(True)
+    monkeypatch.setitem(final_project_code.street_mapping, 'BR-', 'Rodovia BR-')
+    changed = osm_batch.reclean_jsonl(store, chunk_size=100)
+    with open(store, 'rb') as fi:
+        after = fi.read().splitlines(True)
+
+    assert changed == sum(b'"street": "BR-' in line for line in before) > 0
+    assert len(after) == len(before)
+    for old, new in zip(before, after):
+        if b'"street": "BR-' in old:
+            assert json.loads(new)['address']['street'].startswith('Rodovia BR-')
+        else:
+            assert new == old
+    assert detect_encoder(store) == 'json'
+    with open(store + '.report.json') as fi:
+        assert json.load(fi)
+
+
+def test_reclean_parquet(synthetic, tmp_path, monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+    export = str(tmp_path / 'export')
+    final_project_code.process_map(synthetic, encoder='json', columnar=export)
+    streets = pq.read_table(export + '/addresses.parquet').column('street').to_pylist()
+    monkeypatch.setitem(final_project_code.street_mapping, 'BR-', 'Rodovia BR-')
+    changed = osm_batch.reclean_parquet(export)
+    assert changed == sum(1 for street in streets if street and street.startswith('BR-')) > 0
+    recleaned = pq.read_table(export + '/addresses.parquet').column('street').to_pylist()
+    assert recleaned == ['Rodovia ' + street if street and street.startswith('BR-') else street
+                         for street in streets]
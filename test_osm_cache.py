@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_cache: a cache hit gives the result of a miss."""
+
+import pytest
+
+import final_project_code
+import osm_cache
+from conftest import read_bytes
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return osm_cache.ResultCache(str(tmp_path / 'cache'))
+
+
+def run(file_in, **kwargs):
+    result = final_project_code.process_map(file_in, encoder='json', **kwargs)
+    return result, read_bytes(file_in + '.json'), read_bytes(file_in + '.json.report.json')
+
+
+def test_output_hit_equals_miss(synthetic, cache):
+    _, output, report = run(synthetic)
+    assert run(synthetic, cache=cache)[1:] == (output, report)
+    assert cache.stats()['misses'] == {'elements': 1, 'output': 1}
+    final_project_code.report.reset()
+    assert run(synthetic, cache=cache)[1:] == (output, report)
+    assert cache.stats()['hits'] == {'elements': 0, 'output': 1}
+    # The report is restored with the output
+    assert final_project_code.report.to_dict()
+
+
+def test_elements_hit_equals_miss(synthetic, cache):
+    data, output, report = run(synthetic, collect=True)
+    # collect bypasses the cached output, the elements are parsed then read back
+    assert run(synthetic, collect=True, cache=cache) == (data, output, report)
+    assert run(synthetic, collect=True, cache=cache) == (data, output, report)
+    assert cache.stats()['hits'] == {'elements': 1, 'output': 0}
+
+
+def test_mapping_change_invalidates_output(synthetic, cache, monkeypatch):
+    _, output, _ = run(synthetic, cache=cache)
+    monkeypatch.setitem(final_project_code.street_mapping, 'BR158', 'Rodovia BR-158')
+    _, changed, _ = run(synthetic, cache=cache)
+    assert changed != output and b'Rodovia BR-158' in changed
+    # The elements are still valid, only the output is shaped again
+    assert cache.stats()['hits'] == {'elements': 1, 'output': 0}
+    assert run(synthetic)[1] == changed
+
+
+def test_changed_input_is_parsed_again(synthetic, cache):
+    run(synthetic, cache=cache)
+    with open(synthetic, 'a') as fo:
+        fo.write('<!-- edited -->\n')
+    run(synthetic, cache=cache)
+    assert cache.stats()['misses'] == {'elements': 2, 'output': 2}
+
+
+def test_evicts_least_recently_used(synthetic, tmp_path, cache):
+    run(synthetic, cache=cache)
+    other = str(tmp_path / 'other.osm')
+    with open(synthetic) as fi, open(other, 'w') as fo:
+        fo.write(fi.read().replace('Centro', 'Norte'))
+    run(other, cache=cache)
+    entries = cache.entries()
+    assert len(entries) == 4
+    # Entries of the first file are the oldest
+    newest = sum(size for _, size, _ in entries[2:])
+    assert cache.evict(newest) == 2
+    run(other, cache=cache)
+    assert cache.stats()['hits']['output'] == 1
+    run(synthetic, cache=cache)
+    assert cache.stats()['misses'] == {'elements': 3, 'output': 3}
+    cache.clear()
+    assert cache.size() == 0
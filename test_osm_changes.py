@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_changes: applying change files to JSON lines stores and collections."""
+
+import json
+import shutil
+
+import pytest
+
+import final_project_code
+import osm_changes
+from osm_writers import detect_encoder
+
+OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" version="2" user="ana" uid="7" lat="-28.1" lon="-54.2">
+  <tag k="addr:street" v="Av. Brasil"/>
+ </node>
+ <node id="2" version="1" user="ana" uid="7" lat="-28.2" lon="-54.3"/>
+ <node id="3" version="4" user="bob" uid="8" lat="-28.3" lon="-54.4"/>
+ <way id="10" version="1" user="bob" uid="8">
+  <nd ref="1"/>
+  <nd ref="3"/>
+  <tag k="highway" v="residential"/>
+ </way>
+</osm>
+"""
+
+OSC = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+ <modify>
+  <node id="1" version="3" user="carla" uid="9" lat="-28.1" lon="-54.2">
+   <tag k="addr:street" v="BR 158"/>
+  </node>
+  <node id="3" version="4" user="eva" uid="10" lat="-28.3" lon="-54.4"/>
+ </modify>
+ <delete>
+  <node id="2" version="2" user="ana" uid="7" lat="-28.2" lon="-54.3"/>
+  <way id="99" version="1" user="ana" uid="7"/>
+ </delete>
+ <create>
+  <node id="4" version="1" user="ana" uid="7" lat="-28.4" lon="-54.5">
+   <tag k="addr:city" v="ijui"/>
+  </node>
+ </create>
+ <modify>
+  <node id="1" version="2" user="bob" uid="8" lat="-28.1" lon="-54.2"/>
+ </modify>
+</osmChange>
+"""
+
+COUNTS = {'created': 1, 'modified': 1, 'deleted': 1, 'stale': 2}
+
+
+@pytest.fixture
+def files(tmp_path):
+    osm = tmp_path / 'test.osm'
+    osm.write_text(OSM, encoding='utf-8')
+    osc = tmp_path / 'test.osc'
+    osc.write_text(OSC, encoding='utf-8')
+    return str(osm), str(osc)
+
+
+def read_docs(path):
+    with open(path) as fi:
+        return [json.loads(line) for line in fi]
+
+
+def test_collect_changes_keeps_newest(files):
+    changes = osm_changes.collect_changes(files[1])
+    assert changes[('node', '1')][:2] == ('modify', 3)
+    assert changes[('node', '1')][2]['address']['street'] == 'BR-158'
+    assert changes[('node', '2')] == ('delete', 2, None)
+    assert len(changes) == 5
+
+
+@pytest.mark.parametrize('encoder', ['json', 'orjson'])
+def test_apply_to_jsonl(files, encoder):
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+    osm, osc = files
+    final_project_code.process_map(osm, encoder=encoder)
+    store = osm + '.json'
+    with open(store, 'rb') as fi:
+        before = fi.read().splitlines(True)
+    assert osm_changes.apply_to_jsonl(osc, store) == COUNTS
+
+    docs = read_docs(store)
+    assert [(doc['type'], doc['id']) for doc in docs] == \
+        [('node', '1'), ('node', '3'), ('way', '10'), ('node', '4')]
+    assert docs[0]['created']['user'] == 'carla'
+    assert docs[0]['address']['street'] == 'BR-158'
+    assert docs[3]['address']['city'] == 'ijuí'
+    with open(store, 'rb') as fi:
+        after = fi.read().splitlines(True)
+    # Stale and unchanged lines are copied, new lines use the encoder of the store
+    assert after[1:3] == [before[2], before[3]]
+    assert detect_encoder(store) == encoder
+
+    # Applying the same changes again only finds stale ones
+    assert osm_changes.apply_to_jsonl(osc, store) == \
+        {'created': 0, 'modified': 0, 'deleted': 0, 'stale': 5}
+    assert read_docs(store) == docs
+
+
+def test_rejects_compressed_and_pretty_stores(files):
+    osm, osc = files
+    final_project_code.process_map(osm, encoder='json', compression='gzip')
+    with pytest.raises(ValueError):
+        osm_changes.apply_to_jsonl(osc, osm + '.json.gz')
+    # A compressed store without its suffix
+    shutil.copy(osm + '.json.gz', osm + '.json')
+    with pytest.raises(ValueError):
+        osm_changes.apply_to_jsonl(osc, osm + '.json')
+    final_project_code.process_map(osm, pretty=True, encoder='json')
+    with pytest.raises(ValueError):
+        osm_changes.apply_to_jsonl(osc, osm + '.json')
+
+
+def test_apply_to_collection(files):
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('pymongo')
+    import osm_mongo
+    osm, osc = files
+    collection = mongomock.MongoClient().db.osm
+    osm_mongo.load_map(osm, collection)
+    assert osm_changes.apply_to_collection(osc, collection, batch_size=2) == \
+        {'upserted': 2, 'deleted': 1, 'stale': 2}
+    assert collection.count_documents({}) == 4
+    assert collection.find_one({'type': 'node', 'id': '1'})['created']['user'] == 'carla'
+    assert collection.find_one({'type': 'node', 'id': '2'}) is None
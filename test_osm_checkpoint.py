@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_checkpoint: resuming after a crash gives the output of a full run."""
+
+import os
+
+import pytest
+
+import final_project_code
+import osm_checkpoint
+from conftest import read_bytes
+
+SHARD_SIZE = 4 * 1024
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_after(monkeypatch, shards):
+    """Make the shaping of the shards fail after the first ones."""
+    shape_shard = osm_checkpoint.shape_shard
+    calls = []
+
+    def failing(*args):
+        calls.append(args)
+        if len(calls) > shards:
+            raise Crash()
+        return shape_shard(*args)
+    monkeypatch.setattr(osm_checkpoint, 'shape_shard', failing)
+
+
+@pytest.fixture
+def serial(synthetic):
+    final_project_code.process_map(synthetic, encoder='json')
+    return read_bytes(synthetic + '.json'), read_bytes(synthetic + '.json.report.json')
+
+
+def run(file_in, resume=False):
+    return osm_checkpoint.process_map_resumable(file_in, encoder='json', resume=resume,
+                                                checkpoint_every=3 * SHARD_SIZE,
+                                                shard_size=SHARD_SIZE)
+
+
+def test_resume_after_crash(synthetic, serial, monkeypatch):
+    with monkeypatch.context() as patch:
+        crash_after(patch, 8)
+        with pytest.raises(Crash):
+            run(synthetic)
+    file_out = synthetic + '.json'
+    checkpoint = osm_checkpoint.load_checkpoint(file_out)
+    # Two shards were written after the last checkpoint, they are written again
+    assert os.path.getsize(file_out) > checkpoint['output_offset']
+    assert checkpoint['input_offset'] > 0
+
+    final_project_code.report.reset()
+    stats = run(synthetic, resume=True)
+    assert read_bytes(file_out) == serial[0]
+    assert read_bytes(file_out + '.report.json') == serial[1]
+    assert stats == {'elements': 2220, 'documents': serial[0].count(b'\n')}
+    assert osm_checkpoint.load_checkpoint(file_out) is None
+
+
+def test_resume_without_checkpoint(synthetic, serial):
+    run(synthetic, resume=True)
+    assert read_bytes(synthetic + '.json') == serial[0]
+
+
+def test_resume_refuses_other_options(synthetic, monkeypatch):
+    with monkeypatch.context() as patch:
+        crash_after(patch, 4)
+        with pytest.raises(Crash):
+            run(synthetic)
+    with pytest.raises(ValueError, match='encoder'):
+        osm_checkpoint.process_map_resumable(synthetic, pretty=True, encoder='json',
+                                             resume=True, shard_size=SHARD_SIZE)
+    os.utime(synthetic, (0, 0))
+    with pytest.raises(ValueError, match='changed'):
+        run(synthetic, resume=True)
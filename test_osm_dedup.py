@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_dedup: merged extracts and history files keep the latest versions."""
+
+import json
+import os
+import pickle
+import re
+
+import pytest
+
+import final_project_code
+import osm_dedup
+import osm_parallel
+from conftest import read_bytes
+
+
+def split(file_in):
+    with open(file_in, 'rb') as fi:
+        head, rest = fi.read().split(b'<node', 1)
+    return head, b'<node' + rest.rsplit(b'</osm>', 1)[0]
+
+
+def newer(match):
+    """Bump the version of the elements whose id is a multiple of 3."""
+    attrs = match.group(2)
+    if int(re.search(br' id="(\d+)"', attrs).group(1)) % 3 == 0:
+        attrs = re.sub(br' version="(\d+)"',
+                       lambda v: b' version="%d"' % (int(v.group(1)) + 1), attrs)
+        attrs = re.sub(br' user="[^"]*"', b' user="newer"', attrs)
+    return b'<' + match.group(1) + attrs
+
+
+@pytest.fixture
+def single(synthetic):
+    final_project_code.process_map(synthetic, encoder='json')
+    return read_bytes(synthetic + '.json'), read_bytes(synthetic + '.json.report.json')
+
+
+@pytest.fixture
+def merged(synthetic, tmp_path):
+    """Two overlapping extracts: every element is written twice."""
+    head, body = split(synthetic)
+    path = tmp_path / 'merged.osm'
+    path.write_bytes(head + body + body + b'</osm>\n')
+    return str(path)
+
+
+@pytest.fixture
+def history(synthetic, tmp_path):
+    """Newer versions of a third of the elements, before their older versions."""
+    head, body = split(synthetic)
+    path = tmp_path / 'history.osm'
+    path.write_bytes(head + re.sub(br'<(node|way)(\s[^>]*)', newer, body) + body +
+                     b'</osm>\n')
+    return str(path)
+
+
+@pytest.mark.parametrize('mode', ['two-pass', 'stream'])
+def test_merged_equals_single(merged, single, mode):
+    final_project_code.process_map(merged, encoder='json', dedup=mode)
+    assert read_bytes(merged + '.json') == single[0]
+    assert read_bytes(merged + '.json.report.json') == single[1]
+
+
+def test_history_keeps_latest_version(history):
+    final_project_code.process_map(history, encoder='json', dedup=True)
+    with open(history + '.json') as fi:
+        docs = [json.loads(line) for line in fi]
+    keys = [(doc['type'], doc['id']) for doc in docs]
+    assert len(keys) == len(set(keys)) == 2200
+    for doc in docs:
+        assert (int(doc['id']) % 3 == 0) == (doc['created']['user'] == 'newer')
+
+
+def test_parallel_equals_serial(history):
+    final_project_code.process_map(history, encoder='json', dedup='two-pass')
+    serial = read_bytes(history + '.json')
+    osm_parallel.process_map_parallel(history, workers=2, shard_size=16 * 1024,
+                                      encoder='json', dedup=True)
+    assert read_bytes(history + '.json') == serial
+
+
+def test_stream_keeps_older_versions_written_first(tmp_path):
+    osm = tmp_path / 'stream.osm'
+    osm.write_text('<osm>'
+                   '<node id="1" version="1" lat="0" lon="0"/>'
+                   '<node id="1" version="3" lat="1" lon="1"/>'
+                   '<node id="1" version="2" lat="2" lon="2"/>'
+                   '</osm>')
+    data = final_project_code.process_map(str(osm), collect=True, encoder='json',
+                                          dedup='stream')
+    assert [doc['pos'] for doc in data] == [[0.0, 0.0], [1.0, 1.0]]
+    data = final_project_code.process_map(str(osm), collect=True, encoder='json',
+                                          dedup='two-pass')
+    assert [doc['pos'] for doc in data] == [[1.0, 1.0]]
+
+
+def test_version_index_spills_to_file(tmp_path):
+    index = osm_dedup.VersionIndex(str(tmp_path / 'versions'), dense_limit=100)
+    assert index.offer(5, 2, 0)
+    assert not index.offer(5, 2, 1)
+    assert index.offer(5, 3, 2)
+    assert index.offer(-7, 1, 3)
+    assert index.offer(10 ** 6, 1, 4)
+    assert os.path.exists(str(tmp_path / 'versions'))
+    # Cells of the array moved to the file
+    assert [index.winner(i) for i in (5, -7, 10 ** 6, 6, -8)] == [2, 3, 4, None, None]
+
+    # Workers get the spilled index by path
+    copy = pickle.loads(pickle.dumps(index))
+    assert [copy.winner(i) for i in (5, -7, 10 ** 6)] == [2, 3, 4]
+    copy.close()
+    index.close()
+
+
+def test_version_index_removes_temporary_file():
+    index = osm_dedup.VersionIndex(dense_limit=10)
+    index.offer(100, 1, 0)
+    path = index.path
+    assert os.path.exists(path)
+    index.close()
+    assert not os.path.exists(path)
+
+
+def test_version_out_of_range():
+    with pytest.raises(ValueError):
+        osm_dedup.VersionIndex().offer(1, osm_dedup.MAX_VERSION + 1, 0)
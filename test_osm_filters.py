@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_filters and of process_map(element_filter=...)."""
+
+import pytest
+
+import final_project_code
+from osm_filters import ElementFilter, point_in_polygon
+from osm_geometry import SortedNodeIndex
+
+OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" lat="-28.1" lon="-54.2">
+  <tag k="addr:street" v="Av. Brasil"/>
+ </node>
+ <node id="2" lat="-28.2" lon="-54.3">
+  <tag k="amenity" v="school"/>
+  <tag k="disused" v="yes"/>
+ </node>
+ <node id="3" lat="-30.0" lon="-51.0">
+  <tag k="amenity" v="bank"/>
+ </node>
+ <node id="4" lat="-28.3" lon="-54.4"/>
+ <way id="10">
+  <nd ref="3"/>
+  <nd ref="4"/>
+  <tag k="highway" v="residential"/>
+ </way>
+ <way id="11">
+  <nd ref="3"/>
+  <tag k="highway" v="primary"/>
+ </way>
+</osm>
+"""
+
+BBOX = (-28.5, -54.5, -28.0, -54.0)
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    path = tmp_path / 'test.osm'
+    path.write_text(OSM, encoding='utf-8')
+    return str(path)
+
+
+def kept(osm_file, element_filter, **kwargs):
+    data = final_project_code.process_map(osm_file, collect=True, encoder='json',
+                                          element_filter=element_filter, **kwargs)
+    return [(doc['type'], doc['id']) for doc in data], data
+
+
+def test_bbox_keeps_ways_with_a_node_inside(osm_file):
+    ids, _ = kept(osm_file, ElementFilter(bbox=BBOX))
+    assert ids == [('node', '1'), ('node', '2'), ('node', '4'), ('way', '10')]
+
+
+def test_polygon(osm_file):
+    triangle = [(-28.0, -54.0), (-28.0, -54.3), (-28.5, -54.0)]
+    assert point_in_polygon(-28.1, -54.2, triangle)
+    assert not point_in_polygon(-28.2, -54.3, triangle)
+    ids, _ = kept(osm_file, ElementFilter(polygon=triangle))
+    assert ids == [('node', '1')]
+
+
+def test_keys(osm_file):
+    ids, _ = kept(osm_file, ElementFilter(require_keys=['amenity', 'addr:*']))
+    assert ids == [('node', '1'), ('node', '2'), ('node', '3')]
+    ids, _ = kept(osm_file, ElementFilter(require_keys=['amenity'], exclude_keys=['dis*']))
+    assert ids == [('node', '3')]
+    ids, _ = kept(osm_file, ElementFilter(exclude_keys=['highway'], types=('way',)))
+    assert ids == []
+
+
+def test_types(osm_file):
+    ids, _ = kept(osm_file, ElementFilter(types=('way',)))
+    assert ids == [('way', '10'), ('way', '11')]
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_node_index_gets_filtered_nodes(osm_file, pipelined):
+    index = SortedNodeIndex()
+    ids, data = kept(osm_file, ElementFilter(types=('way',)), node_index=index,
+                     pipelined=pipelined)
+    assert len(index) == 4
+    assert ids == [('way', '10'), ('way', '11')]
+    assert data[0]['node_pos'] == [[-30.0, -51.0], [-28.3, -54.4]]
+    assert data[1]['node_pos'] == [[-30.0, -51.0]]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of the node indexes of osm_geometry and of the way geometry they resolve."""
+
+import os
+import random
+
+import pytest
+
+import final_project_code
+from osm_geometry import MmapNodeIndex, SortedNodeIndex
+
+OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="3" lat="-28.3" lon="-54.4"/>
+ <node id="1" lat="-28.1" lon="-54.2"/>
+ <node id="-5" lat="-28.5" lon="-54.6"/>
+ <way id="10">
+  <nd ref="1"/>
+  <nd ref="3"/>
+  <nd ref="-5"/>
+  <nd ref="99"/>
+ </way>
+</osm>
+"""
+
+
+@pytest.fixture(params=['sorted', 'mmap'])
+def index(request, tmp_path):
+    if request.param == 'sorted':
+        index = SortedNodeIndex()
+    else:
+        index = MmapNodeIndex(str(tmp_path / 'nodes'))
+    yield index
+    index.close()
+
+
+def test_index_returns_added_positions(index):
+    rng = random.Random(5)
+    positions = {}
+    # Mostly increasing ids with some out of order, looked up while they are added
+    ids = list(range(1, 3000, 3)) + rng.sample(range(3000, 6000), 500) + [-1, -7, 2]
+    for i, node_id in enumerate(ids):
+        positions[node_id] = (round(rng.uniform(-90, 90), 7), round(rng.uniform(-180, 180), 7))
+        index.add(node_id, *positions[node_id])
+        if i % 200 == 0:
+            probe = rng.choice(list(positions))
+            assert index.get(probe) == pytest.approx(positions[probe], abs=1e-7)
+    for node_id, pos in positions.items():
+        assert index.get(node_id) == pytest.approx(pos, abs=1e-7)
+    for node_id in (0, 3, -2, 10 ** 7):
+        assert index.get(node_id) is None
+    assert index.lookup(['1', '3', '-7']) == [list(index.get(1)), list(index.get(-7))]
+
+
+def test_sorted_index_keeps_first_duplicate():
+    index = SortedNodeIndex()
+    for node_id, lat in [(5, 1.0), (2, 2.0), (5, 3.0), (2, 4.0), (1, 5.0)]:
+        index.add(node_id, lat, 0.0)
+    assert [index.get(i)[0] for i in (1, 2, 5)] == [5.0, 2.0, 1.0]
+    index.add(3, 6.0, 0.0)
+    index.add(6, 7.0, 0.0)
+    assert index.get(3) == (6.0, 0.0)
+    assert list(index.ids) == [1, 2, 2, 3, 5, 5, 6]
+
+
+def test_mmap_index_removes_file(tmp_path):
+    path = str(tmp_path / 'nodes')
+    MmapNodeIndex(path).close()
+    assert not os.path.exists(path)
+    index = MmapNodeIndex(path, keep=True)
+    index.add(12, -28.1, -54.2)
+    index.close()
+    index = MmapNodeIndex(path)
+    assert index.get(12) == pytest.approx((-28.1, -54.2))
+    index.close()
+
+
+def test_way_geometry(tmp_path, index):
+    path = tmp_path / 'test.osm'
+    path.write_text(OSM, encoding='utf-8')
+    data = final_project_code.process_map(str(path), collect=True, encoder='json',
+                                          node_index=index)
+    way = data[-1]
+    assert way['node_pos'] == [[-28.1, -54.2], [-28.3, -54.4], [-28.5, -54.6]]
+    assert way['bbox'] == [-28.5, -54.6, -28.1, -54.2]
+    assert way['centroid'] == pytest.approx([-28.3, -54.4])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_mongo against mongomock (skipped when it is not installed)."""
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('pymongo')
+
+import final_project_code
+import osm_mongo
+
+OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" version="2" changeset="1" timestamp="2013-08-03T16:43:42Z" user="ana" uid="7" lat="-28.1" lon="-54.2">
+  <tag k="addr:street" v="Av. Brasil"/>
+  <tag k="amenity" v="restaurant"/>
+ </node>
+ <node id="2" version="1" changeset="1" timestamp="2013-08-03T16:43:42Z" user="ana" uid="7" lat="35.6" lon="139.7"/>
+ <node id="3" version="1" changeset="1" timestamp="2013-08-03T16:43:42Z" user="bob" uid="8" lat="-28.3" lon="-54.4"/>
+ <node id="10" version="1" changeset="1" timestamp="2013-08-03T16:43:42Z" user="bob" uid="8" lat="-28.4" lon="-54.5"/>
+ <way id="10" version="3" changeset="9" timestamp="2014-01-01T00:00:00Z" user="bob" uid="8">
+  <nd ref="1"/>
+  <nd ref="3"/>
+  <tag k="highway" v="residential"/>
+ </way>
+</osm>
+"""
+
+
+class CountingCollection(object):
+    """Collection proxy recording the size of each write."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.writes = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes.append(len(requests))
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+    def insert_many(self, docs, ordered=True):
+        self.writes.append(len(docs))
+        return self.collection.insert_many(docs, ordered=ordered)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    path = tmp_path / 'test.osm'
+    path.write_text(OSM, encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.osm
+
+
+def docs(n):
+    return [{'id': str(i), 'type': 'node', 'name': 'n{0}'.format(i)} for i in range(n)]
+
+
+def test_sink_writes_in_batches(collection):
+    counting = CountingCollection(collection)
+    sink = osm_mongo.MongoSink(counting, batch_size=3)
+    for doc in docs(7):
+        sink.write(doc)
+    assert counting.writes == [3, 3]
+    assert sink.close() == 7
+    assert counting.writes == [3, 3, 1]
+    assert collection.count_documents({}) == 7
+
+
+def test_sink_upserts_on_id_and_type(collection):
+    sink = osm_mongo.MongoSink(collection, batch_size=2)
+    for doc in docs(3):
+        sink.write(doc)
+    sink.write({'id': '1', 'type': 'node', 'name': 'changed'})
+    sink.write({'id': '1', 'type': 'way', 'name': 'way'})
+    sink.close()
+    assert collection.count_documents({}) == 4
+    assert collection.find_one({'id': '1', 'type': 'node'})['name'] == 'changed'
+    assert collection.find_one({'id': '1', 'type': 'way'})['name'] == 'way'
+
+
+def test_sink_inserts_without_upsert(collection):
+    written = docs(2)
+    sink = osm_mongo.MongoSink(collection, upsert=False)
+    for doc in written + written:
+        sink.write(doc)
+    sink.close()
+    assert collection.count_documents({}) == 4
+    # The written documents are not changed by insert_many
+    assert all('_id' not in doc for doc in written)
+
+
+def test_sink_threaded(collection):
+    counting = CountingCollection(collection)
+    sink = osm_mongo.MongoSink(counting, batch_size=10, workers=3)
+    for doc in docs(1005):
+        sink.write(doc)
+    assert sink.close() == 1005
+    assert sorted(counting.writes) == [5] + [10] * 100
+    assert collection.count_documents({}) == 1005
+    assert sink._executor._shutdown
+
+
+def test_load_map(osm_file, collection):
+    assert osm_mongo.load_map(osm_file, collection, batch_size=2, workers=2) == 5
+    assert collection.count_documents({'type': 'node'}) == 4
+    # Node 10 and way 10 are different documents
+    way = collection.find_one({'id': '10', 'type': 'way'})
+    assert way['node_refs'] == ['1', '3']
+    node = collection.find_one({'id': '1', 'type': 'node'})
+    assert node['address']['street'] == 'Avenida Brasil'
+    assert 'location' not in node
+
+    # Reloading replaces the documents
+    assert osm_mongo.load_map(osm_file, collection) == 5
+    assert collection.count_documents({}) == 5
+
+    indexes = collection.index_information()
+    assert indexes['id_1_type_1']['unique']
+    assert 'address.city_1' in indexes and 'amenity_1' in indexes
+    assert not any('2dsphere' in name for name in indexes)
+
+
+def test_load_map_geo(osm_file, collection):
+    osm_mongo.load_map(osm_file, collection, geo=True)
+    assert 'location_2dsphere' in collection.index_information()
+    node = collection.find_one({'id': '2', 'type': 'node'})
+    assert node['pos'] == [35.6, 139.7]
+    assert node['location'] == {'type': 'Point', 'coordinates': [139.7, 35.6]}
+    assert 'location' not in collection.find_one({'type': 'way'})
+
+
+def test_process_map_closes_sinks_on_error(osm_file, collection):
+    class FailingFilter(object):
+        seen = 0
+
+        def accept(self, element):
+            self.seen += 1
+            if self.seen == 4:
+                raise RuntimeError('shaping failed')
+            return True
+
+    sink = osm_mongo.MongoSink(collection, batch_size=100, workers=2)
+    with pytest.raises(RuntimeError):
+        final_project_code.process_map(osm_file, sinks=[sink], element_filter=FailingFilter())
+    # The documents shaped before the error were written and the threads stopped
+    assert collection.count_documents({}) == 3
+    assert sink._executor._shutdown
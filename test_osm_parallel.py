@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_parallel: sharding, bounded task submission and output equality."""
+
+import json
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+import final_project_code
+import osm_parallel
+from conftest import read_bytes
+
+
+def serial_run(file_in):
+    final_project_code.process_map(file_in, encoder='json')
+    with open(file_in + '.json.report.json') as fi:
+        return read_bytes(file_in + '.json'), json.load(fi)
+
+
+def test_shards_cover_the_file(synthetic):
+    shards = osm_parallel.find_shards(synthetic, shard_size=8 * 1024)
+    assert len(shards) > 5
+    for (_, end), (start, _) in zip(shards, shards[1:]):
+        assert end == start
+    with open(synthetic, 'rb') as fi:
+        data = fi.read()
+    for start, _ in shards:
+        assert data[start:start + 5] in (b'<node', b'<way ', b'<rela')
+    elements = sum(1 for start, end in shards
+                   for _ in osm_parallel.iter_shard_elements(synthetic, start, end))
+    assert elements == 2000 + 200 + 20
+
+
+def test_parallel_equals_serial(synthetic):
+    output, report = serial_run(synthetic)
+    stats = osm_parallel.process_map_parallel(synthetic, workers=2, shard_size=8 * 1024,
+                                              encoder='json')
+    assert read_bytes(synthetic + '.json') == output
+    with open(synthetic + '.json.report.json') as fi:
+        assert json.load(fi) == report
+    assert stats['elements'] == 2220
+    assert stats['documents'] == output.count(b'\n')
+
+
+def test_unordered_keeps_every_line(synthetic):
+    output, report = serial_run(synthetic)
+    osm_parallel.process_map_parallel(synthetic, workers=2, ordered=False,
+                                      shard_size=8 * 1024, encoder='json')
+    assert sorted(read_bytes(synthetic + '.json').splitlines()) == \
+        sorted(output.splitlines())
+    with open(synthetic + '.json.report.json') as fi:
+        unordered = json.load(fi)
+    # Samples depend on the order the shards are merged in, counts do not
+    assert dict((rule, v['count']) for rule, v in unordered.items()) == \
+        dict((rule, v['count']) for rule, v in report.items())
+
+
+def test_parallel_rejects_serial_options(synthetic):
+    with pytest.raises(ValueError):
+        final_project_code.process_map(synthetic, workers=2, collect=True)
+
+
+def test_imap_bounded_order_and_window():
+    pulled = []
+
+    def tasks():
+        for i in range(20):
+            pulled.append(i)
+            yield i
+
+    with ThreadPool(3) as pool:
+        results = []
+        for result in osm_parallel.imap_bounded(pool, lambda i: i * i, tasks(), 4):
+            # The window is refilled by one task per result consumed
+            assert len(pulled) <= len(results) + 5
+            results.append(result)
+        assert results == [i * i for i in range(20)]
+
+        unordered = osm_parallel.imap_bounded(pool, lambda i: i * i, range(20), 4,
+                                              ordered=False)
+        assert sorted(unordered) == results
+
+
+def fail_on_seven(i):
+    if i == 7:
+        raise KeyError(i)
+    return i
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_imap_bounded_raises(ordered):
+    with ThreadPool(2) as pool:
+        with pytest.raises(KeyError):
+            list(osm_parallel.imap_bounded(pool, fail_on_seven, range(20), 3, ordered))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_pbf against PBF files written by pyosmium (skipped when it is not installed)."""
+
+import pytest
+
+osmium = pytest.importorskip('osmium')
+
+import final_project_code
+import osm_benchmark
+import osm_parallel
+import osm_pbf
+
+TAGS = ('node', 'way', 'relation')
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    """An OSM XML file of several PBF blocks (8000 elements each) and its PBF copy."""
+    directory = tmp_path_factory.mktemp('pbf')
+    xml = str(directory / 'map.osm')
+    pbf = str(directory / 'map.osm.pbf')
+    osm_benchmark.generate_osm(xml, nodes=15000, relations=50, seed=3)
+    writer = osmium.SimpleWriter(pbf)
+
+    class Copy(osmium.SimpleHandler):
+        def node(self, n):
+            writer.add_node(n)
+
+        def way(self, w):
+            writer.add_way(w)
+
+        def relation(self, r):
+            writer.add_relation(r)
+    Copy().apply_file(xml)
+    writer.close()
+    return xml, pbf
+
+
+def attributes(element):
+    attrib = dict(element.attrib)
+    # PBF coordinates are written without the trailing zeros of the XML ones
+    for k in ('lat', 'lon'):
+        if k in attrib:
+            attrib[k] = float(attrib[k])
+    return attrib
+
+
+def as_tuples(elements):
+    return [(e.tag, attributes(e), [(child.tag, dict(child.attrib)) for child in e])
+            for e in elements]
+
+
+@pytest.fixture(scope='module')
+def xml_elements(files):
+    return as_tuples(final_project_code.iter_elements(files[0], tags=TAGS))
+
+
+def test_is_pbf(files):
+    assert osm_pbf.is_pbf(files[1])
+    assert not osm_pbf.is_pbf(files[0])
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_elements_equal_xml(files, xml_elements, workers):
+    pbf_elements = as_tuples(osm_pbf.iter_pbf_elements(files[1], tags=TAGS, workers=workers))
+    assert pbf_elements == xml_elements
+
+
+def test_block_ranges(files, xml_elements):
+    ranges = osm_pbf.find_blocks(files[1])
+    assert len(ranges) > 2
+    assert len(osm_pbf.find_blocks(files[1], shard_size=10 ** 9)) == 1
+    elements = [e for start, end in ranges
+                for e in osm_pbf.iter_range_elements(files[1], start, end, TAGS)]
+    assert as_tuples(elements) == xml_elements
+
+
+def test_process_map_reads_pbf(files):
+    xml, pbf = files
+    assert final_project_code.process_map(pbf, collect=True, encoder='json') == \
+        final_project_code.process_map(xml, collect=True, encoder='json')
+    with open(xml + '.json', 'rb') as fi:
+        output = fi.read()
+    osm_parallel.process_map_parallel(pbf, workers=2, encoder='json')
+    with open(pbf + '.json', 'rb') as fi:
+        assert fi.read() == output
+
+
+def test_unsupported_feature():
+    feature = b'LocationsOnWays'
+    with pytest.raises(ValueError, match='LocationsOnWays'):
+        osm_pbf.check_header(b'\x22' + bytes([len(feature)]) + feature)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_pipeline: same output as process_map, errors and sinks."""
+
+import bz2
+import gzip
+import shutil
+
+import pytest
+
+import final_project_code
+import osm_pipeline
+from conftest import read_bytes
+
+
+class ListSink(object):
+    """Sink keeping the documents, failing on the fail_at-th one if set."""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.docs = []
+        self.closed = False
+
+    def write(self, doc):
+        if len(self.docs) + 1 == self.fail_at:
+            raise RuntimeError('sink failed')
+        self.docs.append(doc)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def serial(synthetic):
+    data = final_project_code.process_map(synthetic, collect=True, encoder='json')
+    return data, read_bytes(synthetic + '.json'), read_bytes(synthetic + '.json.report.json')
+
+
+def test_pipelined_equals_serial(synthetic, serial):
+    data, output, report = serial
+    sink = ListSink()
+    # Small batches and queues make the stages wait on each other
+    collected = osm_pipeline.process_map_pipelined(synthetic, collect=True, sinks=[sink],
+                                                   encoder='json', batch_size=7,
+                                                   queue_size=2)
+    assert read_bytes(synthetic + '.json') == output
+    assert read_bytes(synthetic + '.json.report.json') == report
+    assert collected == data
+    assert sink.docs == data and sink.closed
+
+
+@pytest.mark.parametrize('suffix, opener', [('.gz', gzip.open), ('.bz2', bz2.open)])
+def test_pipelined_compressed_input(synthetic, serial, suffix, opener):
+    compressed = synthetic + suffix
+    with open(synthetic, 'rb') as fi, opener(compressed, 'wb') as fo:
+        shutil.copyfileobj(fi, fo)
+    final_project_code.process_map(compressed, pipelined=True, encoder='json')
+    assert read_bytes(compressed + '.json') == serial[1]
+
+
+def test_pipelined_rejects_pbf(tmp_path):
+    path = tmp_path / 'map.osm.pbf'
+    path.write_bytes(b'\x00\x00\x00\x0e\n\tOSMHeader')
+    with pytest.raises(ValueError, match='PBF'):
+        osm_pipeline.process_map_pipelined(str(path))
+
+
+def test_pipelined_closes_every_sink_on_error(synthetic):
+    failing = ListSink(fail_at=50)
+    other = ListSink()
+    with pytest.raises(RuntimeError, match='sink failed'):
+        osm_pipeline.process_map_pipelined(synthetic, sinks=[other, failing],
+                                           encoder='json', batch_size=10)
+    assert failing.closed and other.closed
+
+
+def test_pipelined_rejects_unsupported_options(synthetic):
+    with pytest.raises(ValueError):
+        final_project_code.process_map(synthetic, pipelined=True, dedup='stream')
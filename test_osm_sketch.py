@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of osm_sketch and of the mergeable approximate auditors of osm_audit."""
+
+from collections import Counter
+import random
+
+import pytest
+
+import osm_audit
+import osm_benchmark
+from osm_sketch import CountMinSketch, HeavyHitters, HyperLogLog
+
+
+def zipf(n, values=2000, seed=1):
+    """n values drawn with frequencies decreasing as 1 / rank."""
+    rng = random.Random(seed)
+    weights = [1.0 / rank for rank in range(1, values + 1)]
+    return ['v{0}'.format(i) for i in rng.choices(range(values), weights, k=n)]
+
+
+@pytest.mark.parametrize('distinct', [100, 50000])
+def test_hyperloglog_error(distinct):
+    hll = HyperLogLog()
+    for i in range(distinct):
+        hll.add('user{0}'.format(i))
+        hll.add('user{0}'.format(i))
+    # Four standard errors
+    assert abs(hll.count() - distinct) <= 4 * hll.error() * distinct + 1
+    assert hll.report()['relative_error'] == pytest.approx(0.0081, abs=1e-4)
+
+
+def test_hyperloglog_merge():
+    left, right, whole = HyperLogLog(10), HyperLogLog(10), HyperLogLog(10)
+    for i in range(5000):
+        (left if i % 2 else right).add(str(i))
+        whole.add(str(i))
+    assert left.merge(right).registers == whole.registers
+    with pytest.raises(ValueError):
+        left.merge(HyperLogLog(11))
+    with pytest.raises(ValueError):
+        HyperLogLog(3)
+
+
+def test_count_min_bounds():
+    values = zipf(20000)
+    sketch = CountMinSketch(width=256, depth=4)
+    for value in values:
+        sketch.add(value)
+    exact = Counter(values)
+    overestimates = [sketch.estimate(value) - count for value, count in exact.items()]
+    assert min(overestimates) >= 0
+    # The bound holds with probability 1 - exp(-4) for each value
+    assert sum(1 for over in overestimates if over > sketch.error_bound()) < 0.05 * len(exact)
+    assert sketch.estimate('missing') <= sketch.error_bound()
+
+    sized = CountMinSketch.from_error(epsilon=0.01, delta=0.01)
+    assert (sized.width, sized.depth) == (272, 5)
+
+
+def test_count_min_merge():
+    values = zipf(5000)
+    halves = CountMinSketch(512, 3), CountMinSketch(512, 3)
+    whole = CountMinSketch(512, 3)
+    for i, value in enumerate(values):
+        halves[i % 2].add(value, 2)
+        whole.add(value, 2)
+    merged = halves[0].merge(halves[1])
+    assert merged.rows == whole.rows and merged.total == whole.total == 10000
+    with pytest.raises(ValueError):
+        merged.merge(CountMinSketch(512, 4))
+
+
+def test_heavy_hitters():
+    values = zipf(30000)
+    exact = [value for value, _ in Counter(values).most_common(10)]
+    chunks = [HeavyHitters(k=10, width=4096) for _ in range(3)]
+    whole = HeavyHitters(k=10, width=4096)
+    for i, value in enumerate(values):
+        chunks[i % 3].add(value)
+        whole.add(value)
+    assert [value for value, _ in whole.most_common(10)] == exact
+    merged = chunks[0].merge(chunks[1]).merge(chunks[2])
+    assert merged.most_common(10) == whole.most_common(10)
+    assert merged.report()['total'] == 30000
+
+
+def test_approximate_audits_merge(synthetic, tmp_path):
+    other = str(tmp_path / 'other.osm')
+    osm_benchmark.generate_osm(other, nodes=1500, relations=10, seed=8)
+    both = str(tmp_path / 'both.osm')
+    with open(synthetic) as first, open(other) as second, open(both, 'w') as fo:
+        fo.write(first.read().rsplit('</osm>', 1)[0])
+        fo.write('<node' + second.read().split('<node', 1)[1])
+
+    whole = osm_audit.AuditEngine(osm_audit.approximate_auditors())
+    whole.run(both)
+    first = osm_audit.AuditEngine(osm_audit.approximate_auditors())
+    first.run(synthetic)
+    second = osm_audit.AuditEngine(osm_audit.approximate_auditors())
+    second.run(other)
+    for auditor, other_auditor, whole_auditor in zip(first.auditors, second.auditors,
+                                                     whole.auditors):
+        merged = auditor.merge(other_auditor).report()
+        if auditor.name == 'tags':
+            # Each file has its own <osm> and <bounds> elements
+            merged['osm'] -= 1
+            merged['bounds'] -= 1
+        assert merged == whole_auditor.report(), auditor.name